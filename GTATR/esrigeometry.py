@@ -0,0 +1,457 @@
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None #everything still works without numpy, big polygon layers just convert slower
+
+#This module converts ESRI JSON geometry to geoJSON. Every geometry is converted on
+#its own type, so a layer can mix points, lines and polygons and still come out right:
+#paths become a LineString or a MultiLineString, and polygon rings are sorted into
+#outer rings (clockwise in ESRI JSON) and holes (counterclockwise), each hole going
+#to the smallest outer ring around it, giving a Polygon or a MultiPolygon. Rings are
+#written counterclockwise outside and clockwise for holes, the way RFC 7946 asks.
+#With numpy installed a chunk of geometries is loaded into flat coordinate arrays
+#with offset arrays, and the ring areas, bounding boxes and hole tests are done on
+#those arrays instead of one vertex at a time. Small chunks are quicker without them.
+
+#geometry type codes used in the offset arrays
+EMPTY = 0
+POINT = 1
+MULTIPOINT = 2
+POLYLINE = 3
+POLYGON = 4
+
+def isEmptyValue(value):
+    """ESRI JSON marks an empty point or envelope with null or "NaN" coordinates"""
+    return value is None or value == "NaN"
+
+def getParts(geometry):
+    """returns the type code of an ESRI JSON geometry and its parts, each part a list of coordinates"""
+    if not geometry:
+        return EMPTY, []
+
+    if "x" in geometry:
+        if isEmptyValue(geometry["x"]):
+            return EMPTY, []
+        if "z" in geometry:
+            return POINT, [[[geometry["x"], geometry["y"], geometry["z"]]]]
+        return POINT, [[[geometry["x"], geometry["y"]]]]
+
+    if "rings" in geometry:
+        return POLYGON, geometry["rings"] or []
+
+    if "paths" in geometry:
+        return POLYLINE, geometry["paths"] or []
+
+    if "points" in geometry:
+        return MULTIPOINT, [geometry["points"]] if geometry["points"] else []
+
+    #an envelope is written out as a clockwise ring like any other ESRI polygon
+    if "xmin" in geometry and not isEmptyValue(geometry["xmin"]):
+        xmin, ymin, xmax, ymax = geometry["xmin"], geometry["ymin"], geometry["xmax"], geometry["ymax"]
+        return POLYGON, [[[xmin, ymin], [xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin]]]
+
+    return EMPTY, []
+
+def ringSignedArea(ring):
+    """shoelace area of a ring, ESRI outer rings are clockwise so they come back negative, holes positive"""
+    area = 0.0
+    for i in range(len(ring) - 1):
+        area += ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1]
+
+    return area / 2.0
+
+def pointInRing(x, y, ring):
+    """ray casting test for whether a point falls inside a ring"""
+    inside = False
+    j = len(ring) - 1
+
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+
+    return inside
+
+def groupRings(rings):
+    """groups ESRI polygon rings into polygons, each one a list of rings with the outer ring first and its holes after"""
+    outerRings = []
+    holes = []
+
+    for ring in rings:
+        if len(ring) < 4:
+            continue #not a valid ring
+
+        area = ringSignedArea(ring)
+        if area <= 0:
+            outerRings.append((ring, area))
+        else:
+            holes.append(ring)
+
+    polygons = [[ring] for ring, area in outerRings]
+
+    #each hole belongs to the smallest outer ring that contains it, so an island inside a hole keeps its own holes
+    for hole in holes:
+        owner = None
+        for i, (ring, area) in enumerate(outerRings):
+            if (owner is None or area > outerRings[owner][1]) and pointInRing(hole[0][0], hole[0][1], ring):
+                owner = i
+
+        if owner is None:
+            #a hole with no owner is really an outer ring drawn the wrong way round, turn it clockwise like the others
+            polygons.append([hole[::-1]])
+        else:
+            polygons[owner].append(hole)
+
+    return polygons
+
+def getCentroid(geometry):
+    """returns an ESRI JSON point at the centre of a geometry (area weighted for polygons), None if it is empty"""
+    kind, parts = getParts(geometry)
+    positions = [position for part in parts for position in part]
+
+    if not positions:
+        return None
+
+    if kind == POLYGON:
+        #holes have the opposite sign to outer rings, so adding every ring up takes them out
+        area = 0.0
+        xSum = 0.0
+        ySum = 0.0
+        for ring in parts:
+            for i in range(len(ring) - 1):
+                cross = ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1]
+                area += cross
+                xSum += (ring[i][0] + ring[i + 1][0]) * cross
+                ySum += (ring[i][1] + ring[i + 1][1]) * cross
+
+        if area != 0:
+            return {"x": xSum / (3.0 * area), "y": ySum / (3.0 * area)}
+
+    #lines, points and flat polygons use the average of their vertices
+    return {"x": sum(position[0] for position in positions) / len(positions),
+            "y": sum(position[1] for position in positions) / len(positions)}
+
+def getEnvelope(geometry):
+    """returns (xmin, ymin, xmax, ymax) around an ESRI JSON geometry or envelope, None if it is empty"""
+    kind, parts = getParts(geometry)
+    positions = [position for part in parts for position in part if not isEmptyValue(position[0]) and not isEmptyValue(position[1])]
+
+    if not positions:
+        return None
+
+    xs = [position[0] for position in positions]
+    ys = [position[1] for position in positions]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def clipRing(ring, envelope):
+    """clips a ring to an envelope one side at a time (Sutherland-Hodgman), returns the closed ring or None if nothing is left"""
+    points = [position[:2] for position in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+
+    xmin, ymin, xmax, ymax = envelope
+    for axis, bound, keepAbove in ((0, xmin, True), (0, xmax, False), (1, ymin, True), (1, ymax, False)):
+        if not points:
+            return None
+
+        clipped = []
+        previous = points[-1]
+        previousInside = previous[axis] >= bound if keepAbove else previous[axis] <= bound
+        for point in points:
+            inside = point[axis] >= bound if keepAbove else point[axis] <= bound
+
+            #the edge crosses this side of the envelope, so it is cut where it crosses
+            if inside != previousInside:
+                t = (bound - previous[axis]) / (point[axis] - previous[axis])
+                crossing = [previous[0] + t * (point[0] - previous[0]), previous[1] + t * (point[1] - previous[1])]
+                crossing[axis] = bound
+                clipped.append(crossing)
+
+            if inside:
+                clipped.append(point)
+
+            previous, previousInside = point, inside
+
+        points = clipped
+
+    if len(points) < 3:
+        return None
+
+    return points + [points[0]]
+
+def clipPolygon(geometry, envelope):
+    """returns the part of an ESRI JSON polygon inside an envelope as a polygon, None if none of it is"""
+    rings = [clipRing(ring, envelope) for ring in geometry.get("rings") or []]
+    rings = [ring for ring in rings if ring is not None and ringSignedArea(ring) != 0]
+
+    #an envelope that falls inside a hole gets the outer ring and the hole cut to the same box, which cancel out
+    xmin, ymin, xmax, ymax = envelope
+    if not rings or abs(sum(ringSignedArea(ring) for ring in rings)) <= 1e-12 * max((xmax - xmin) * (ymax - ymin), 1e-300):
+        return None
+
+    clipped = {"rings": rings}
+    if "spatialReference" in geometry:
+        clipped["spatialReference"] = geometry["spatialReference"]
+    return clipped
+
+def makeGeoJSONGeometry(kind, parts, polygons=None):
+    """builds the geoJSON geometry for one geometry's parts, polygons are the grouped rings already in geoJSON order"""
+    if kind == POINT:
+        return {"type": "Point", "coordinates": list(parts[0][0])}
+
+    if kind == MULTIPOINT:
+        return {"type": "MultiPoint", "coordinates": list(parts[0])}
+
+    if kind == POLYLINE:
+        paths = [list(path) for path in parts if len(path) >= 2]
+        if not paths:
+            return None
+        if len(paths) == 1:
+            return {"type": "LineString", "coordinates": paths[0]}
+        return {"type": "MultiLineString", "coordinates": paths}
+
+    if kind == POLYGON:
+        if not polygons:
+            return None
+        if len(polygons) == 1:
+            return {"type": "Polygon", "coordinates": polygons[0]}
+        return {"type": "MultiPolygon", "coordinates": polygons}
+
+    return None
+
+def toGeoJSONGeometry(geometry):
+    """converts a single ESRI JSON geometry to a geoJSON geometry, None if it is empty"""
+    kind, parts = getParts(geometry)
+
+    polygons = None
+    if kind == POLYGON:
+        #ESRI outer rings are clockwise and holes counterclockwise, geoJSON wants it the other way round
+        polygons = [[ring[::-1] for ring in polygon] for polygon in groupRings(parts)]
+
+    return makeGeoJSONGeometry(kind, parts, polygons)
+
+#below this many vertices in a chunk setting up the arrays costs more than it saves (measured on the States polygons)
+ARRAY_MIN_VERTICES = 5000
+
+def countVertices(geometries, limit):
+    """counts the path and ring vertices in a list of ESRI JSON geometries, stopping once it gets to limit"""
+    count = 0
+    for geometry in geometries:
+        if geometry:
+            for part in geometry.get("rings") or geometry.get("paths") or ():
+                count += len(part)
+            if count >= limit:
+                break
+
+    return count
+
+def toGeoJSONGeometries(geometries):
+    """converts a list of ESRI JSON geometries to geoJSON geometries (None where there is no geometry), using numpy if it is
+    installed and the chunk is big enough to be worth it"""
+    if np is not None and countVertices(geometries, ARRAY_MIN_VERTICES) >= ARRAY_MIN_VERTICES:
+        return GeometryArray(geometries).toGeoJSON()
+
+    return [toGeoJSONGeometry(geometry) for geometry in geometries]
+
+#This class holds a chunk of ESRI geometries as flat arrays: coordinates is every
+#vertex as an (n, 2) array, partOffsets gives where each part (path, ring or point
+#list) starts in it, and geometryOffsets gives where each geometry's parts start.
+#It needs numpy.
+
+class GeometryArray():
+
+    def __init__(self, geometries):
+        """loads a list of ESRI JSON geometries, the coordinates are only read into arrays once they are needed"""
+        kinds = []
+        partCounts = []
+        self.parts = [] #the original coordinate lists, the output is sliced from these so z values come through
+
+        for geometry in geometries:
+            kind, parts = getParts(geometry)
+            kinds.append(kind)
+            partCounts.append(len(parts))
+            self.parts.extend(parts)
+
+        self.kinds = np.array(kinds, dtype=np.int8)
+
+        self.geometryOffsets = np.zeros(len(kinds) + 1, dtype=np.int64)
+        np.cumsum(partCounts, out=self.geometryOffsets[1:])
+
+        self.partOffsets = np.zeros(len(self.parts) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(part) for part in self.parts), dtype=np.int64, count=len(self.parts)), out=self.partOffsets[1:])
+
+        self.coordinates = None
+
+    def getCoordinates(self):
+        """returns every vertex as an (n, 2) array of x/y, reading it from the parts the first time"""
+        if self.coordinates is not None:
+            return self.coordinates
+
+        vertexCount = int(self.partOffsets[-1])
+        dimensions = set(len(part[0]) for part in self.parts if part)
+
+        coordinates = None
+        if len(dimensions) == 1:
+            dimension = dimensions.pop()
+            try:
+                values = np.fromiter(chain.from_iterable(chain.from_iterable(self.parts)), dtype=np.float64, count=vertexCount * dimension)
+                coordinates = values.reshape(vertexCount, dimension)[:, :2]
+            except (TypeError, ValueError):
+                coordinates = None #a null or mixed up coordinate somewhere, take the slow way
+
+        if coordinates is None:
+            coordinates = np.array([[float(position[0]), float(position[1])] for part in self.parts for position in part], dtype=np.float64).reshape(-1, 2)
+
+        self.coordinates = np.ascontiguousarray(coordinates)
+        return self.coordinates
+
+    def ringAreas(self):
+        """returns the signed shoelace area of every part, negative for clockwise rings"""
+        coordinates = self.getCoordinates()
+        x = coordinates[:, 0]
+        y = coordinates[:, 1]
+
+        starts = self.partOffsets[:-1]
+        ends = self.partOffsets[1:]
+        areas = np.zeros(len(starts))
+
+        nonEmpty = ends > starts
+        if not nonEmpty.any():
+            return areas
+
+        #cross products of each vertex with the next, the last vertex of a part closes back to its first
+        cross = np.zeros(len(x))
+        cross[:-1] = x[:-1] * y[1:] - x[1:] * y[:-1]
+
+        first = starts[nonEmpty]
+        last = ends[nonEmpty] - 1
+        cross[last] = x[last] * y[first] - x[first] * y[last]
+
+        areas[nonEmpty] = np.add.reduceat(cross, first) / 2.0
+        return areas
+
+    def ringBounds(self):
+        """returns the xmin, ymin, xmax, ymax arrays of every part (nan for empty parts)"""
+        coordinates = self.getCoordinates()
+        starts = self.partOffsets[:-1]
+        nonEmpty = self.partOffsets[1:] > starts
+
+        bounds = np.full((4, len(starts)), np.nan)
+        if nonEmpty.any():
+            first = starts[nonEmpty]
+            bounds[0][nonEmpty] = np.minimum.reduceat(coordinates[:, 0], first)
+            bounds[1][nonEmpty] = np.minimum.reduceat(coordinates[:, 1], first)
+            bounds[2][nonEmpty] = np.maximum.reduceat(coordinates[:, 0], first)
+            bounds[3][nonEmpty] = np.maximum.reduceat(coordinates[:, 1], first)
+
+        return bounds
+
+    def ringOwners(self):
+        """returns the outer ring each polygon ring belongs to (itself for outer rings, -1 for parts that arent valid rings)
+        and whether each ring is a hole that had no outer ring around it"""
+        partCount = len(self.parts)
+        partGeometry = np.repeat(np.arange(len(self.kinds)), np.diff(self.geometryOffsets))
+
+        areas = self.ringAreas()
+        validRing = (self.kinds[partGeometry] == POLYGON) & (np.diff(self.partOffsets) >= 4)
+        isOuter = validRing & (areas <= 0)
+        isHole = validRing & (areas > 0)
+
+        owners = np.where(isOuter, np.arange(partCount), -1)
+        unowned = np.zeros(partCount, dtype=bool)
+
+        holes = np.nonzero(isHole)[0]
+        if holes.size == 0:
+            return owners, unowned
+
+        coordinates = self.getCoordinates()
+        x = coordinates[:, 0]
+        y = coordinates[:, 1]
+        xmin, ymin, xmax, ymax = self.ringBounds()
+
+        #pair every hole with the outer rings of its own geometry, they come in a run since parts are in geometry order
+        outers = np.nonzero(isOuter)[0]
+        outerGeometry = partGeometry[outers]
+        firstOuter = np.searchsorted(outerGeometry, partGeometry[holes], 'left')
+        outerCounts = np.searchsorted(outerGeometry, partGeometry[holes], 'right') - firstOuter
+
+        pairHoles = np.repeat(np.arange(holes.size), outerCounts)
+        pairOuters = outers[np.repeat(firstOuter - (np.cumsum(outerCounts) - outerCounts), outerCounts) + np.arange(pairHoles.size)]
+
+        #only the outer rings whose box holds the hole's first vertex are worth testing
+        holeX = x[self.partOffsets[holes]][pairHoles]
+        holeY = y[self.partOffsets[holes]][pairHoles]
+        inBox = (xmin[pairOuters] <= holeX) & (holeX <= xmax[pairOuters]) & (ymin[pairOuters] <= holeY) & (holeY <= ymax[pairOuters])
+        pairHoles, pairOuters, holeX, holeY = pairHoles[inBox], pairOuters[inBox], holeX[inBox], holeY[inBox]
+
+        if pairHoles.size:
+            #ray casting over the edges of every candidate ring at once, each vertex paired with the one before it
+            ringStarts = self.partOffsets[pairOuters]
+            ringLengths = self.partOffsets[pairOuters + 1] - ringStarts
+            pairStarts = np.cumsum(ringLengths) - ringLengths
+            edgePairs = np.repeat(np.arange(pairHoles.size), ringLengths)
+            i = np.repeat(ringStarts - pairStarts, ringLengths) + np.arange(edgePairs.size)
+            j = i - 1
+            j[pairStarts] = i[pairStarts + ringLengths - 1]
+
+            #only the edges that span the point's y can cross the ray, the rest are dropped before the division
+            pointY = holeY[edgePairs]
+            spans = np.nonzero((y[i] > pointY) != (y[j] > pointY))[0]
+            i, j, pointY = i[spans], j[spans], pointY[spans]
+            crossings = holeX[edgePairs[spans]] < (x[j] - x[i]) * (pointY - y[i]) / (y[j] - y[i]) + x[i]
+            inside = np.bincount(edgePairs[spans], weights=crossings, minlength=pairHoles.size) % 2 == 1
+
+            #the smallest outer ring around the hole owns it (areas are negative, so the largest value), the first one on a tie
+            pairHoles, pairOuters = pairHoles[inside], pairOuters[inside]
+            order = np.lexsort((pairOuters, -areas[pairOuters], pairHoles))
+            pairHoles, pairOuters = pairHoles[order], pairOuters[order]
+            first = np.ones(pairHoles.size, dtype=bool)
+            first[1:] = pairHoles[1:] != pairHoles[:-1]
+            owners[holes[pairHoles[first]]] = pairOuters[first]
+
+        ownerless = holes[owners[holes] < 0]
+        owners[ownerless] = ownerless
+        unowned[ownerless] = True
+
+        return owners, unowned
+
+    def toGeoJSON(self):
+        """returns the list of geoJSON geometries, None where a feature has no geometry"""
+        kinds = self.kinds.tolist()
+        geometryOffsets = self.geometryOffsets.tolist()
+
+        owners = None
+        if POLYGON in kinds:
+            owners, unowned = self.ringOwners()
+            owners = owners.tolist()
+            unowned = unowned.tolist()
+
+        geometries = []
+        for i, kind in enumerate(kinds):
+            parts = self.parts[geometryOffsets[i]:geometryOffsets[i + 1]]
+
+            polygons = None
+            if kind == POLYGON:
+                #outer rings in the order they came with their holes after them, all turned round for geoJSON,
+                #then the holes that had no owner, which are already counterclockwise
+                ringParts = range(geometryOffsets[i], geometryOffsets[i + 1])
+                polygonRings = {}
+                for part in ringParts:
+                    if owners[part] == part and not unowned[part]:
+                        polygonRings[part] = [self.parts[part][::-1]]
+
+                for part in ringParts:
+                    if owners[part] >= 0 and owners[part] != part:
+                        polygonRings[owners[part]].append(self.parts[part][::-1])
+
+                polygons = list(polygonRings.values())
+                polygons.extend([self.parts[part]] for part in ringParts if unowned[part])
+
+            geometries.append(makeGeoJSONGeometry(kind, parts, polygons))
+
+        return geometries
@@ -0,0 +1,190 @@
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+#This module reads the JSON query responses. A whole response body is decoded with
+#the fastest JSON library that is installed (orjson, then ujson, then the standard
+#library), none of them are required. It can also read a feature query response as
+#it comes off the socket: the 'features' array is decoded one feature at a time and
+#everything else in the body (exceededTransferLimit, fields, ...) is kept, so the
+#raw body is never held in memory next to the features made from it. The fast
+#libraries cant decode part of a document, so that mode uses the standard library's
+#scanner.
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+#whitespace JSON allows between values
+WHITESPACE = ' \t\n\r'
+
+#the standard library's scanner, raw_decode gives back the value and where it ended
+decoder = json.JSONDecoder()
+
+def getBackend(backend='auto'):
+    """returns the name of the JSON library to decode with, 'auto' picks the fastest one installed"""
+    if backend == 'auto':
+        if orjson is not None:
+            return 'orjson'
+        if ujson is not None:
+            return 'ujson'
+        return 'json'
+
+    if backend not in BACKENDS:
+        raise ValueError("Unknown JSON backend " + str(backend) + ", expected one of auto, " + ", ".join(BACKENDS))
+    if (backend == 'orjson' and orjson is None) or (backend == 'ujson' and ujson is None):
+        raise ValueError("JSON backend " + backend + " isnt installed")
+
+    return backend
+
+def loads(content, backend='auto'):
+    """decodes a JSON body (bytes or str) with the given backend"""
+    backend = getBackend(backend)
+
+    if backend != 'json':
+        try:
+            if backend == 'orjson':
+                return orjson.loads(content)
+            return ujson.loads(content)
+        except ValueError:
+            pass #e.g. NaN coordinates, which only the standard library accepts
+
+    return json.loads(content)
+
+#error raised when a streamed body turns out to be an ArcGIS {"error": {...}} response,
+#error is that dictionary
+class ServiceError(ValueError):
+
+    def __init__(self, error):
+        ValueError.__init__(self, "Service error " + str(error.get("code") if isinstance(error, dict) else error) + " " +
+                            str(error.get("message") if isinstance(error, dict) else ""))
+        self.error = error
+
+#This class reads a feature query response from an iterable of byte chunks (such as
+#requests' iter_content). Iterating over it yields each feature as soon as it has
+#been read, the rest of the top level object is in data once it is done
+
+class FeatureStream():
+
+    def __init__(self, chunks, readSize=65536):
+        self.chunks = iter(chunks)
+        self.readSize = readSize
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+        self.byteCount = 0 #size of the body read so far, for the chunk sizer
+        self.data = {} #every top level key except features
+        self.hasFeatures = False
+
+    def readMore(self, minimum=0):
+        """adds the next chunks to the buffer, at least minimum characters if there are that many, False at the end of the body"""
+        if self.finished:
+            return False
+
+        #drop what has already been decoded so the buffer only holds the current value
+        if self.position:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+
+        added = []
+        addedLength = 0
+        while True:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.finished = True
+                added.append(self.utf8.decode(b"", final=True))
+                break
+
+            self.byteCount += len(chunk)
+            text = self.utf8.decode(chunk)
+            added.append(text)
+            addedLength += len(text)
+            if addedLength >= max(minimum, 1):
+                break
+
+        self.buffer += "".join(added)
+        return True
+
+    def skipWhitespace(self):
+        """moves past whitespace, returns the next character or '' at the end of the body"""
+        while True:
+            buffer = self.buffer
+            position = self.position
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            self.position = position
+
+            if position < len(buffer):
+                return buffer[position]
+            if not self.readMore():
+                return ''
+
+    def expect(self, characters):
+        """reads one of the given characters, raises ValueError on anything else"""
+        character = self.skipWhitespace()
+        if not character or character not in characters:
+            raise ValueError("Expecting one of " + repr(characters) + " at byte " + str(self.byteCount) + ", got " + repr(character[:1]))
+        self.position += 1
+        return character
+
+    def readValue(self):
+        """decodes the next JSON value, reading more of the body until it is complete"""
+        self.skipWhitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+                #a number at the very end of the buffer might carry on in the next chunk
+                if end < len(self.buffer) or self.finished:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.finished:
+                    raise
+
+            #read at least as much again as is waiting, so a big feature isnt decoded over and over
+            self.readMore(max(self.readSize, len(self.buffer) - self.position))
+
+    def __iter__(self):
+        self.expect('{')
+        if self.skipWhitespace() == '}':
+            self.position += 1
+            return
+
+        while True:
+            key = self.readValue()
+            self.expect(':')
+
+            if key == 'features' and self.skipWhitespace() == '[':
+                self.position += 1
+                self.hasFeatures = True
+                if self.skipWhitespace() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield self.readValue()
+                        if self.expect(',]') == ']':
+                            break
+            elif key == 'error':
+                #the server sent an error instead of features, theres nothing more to read
+                raise ServiceError(self.readValue())
+            else:
+                self.data[key] = self.readValue()
+
+            if self.expect(',}') == '}':
+                break
+
+    def readAll(self):
+        """reads the whole response, returns the same dictionary json.loads would"""
+        features = list(self)
+        data = dict(self.data)
+        if self.hasFeatures:
+            data['features'] = features
+        return data
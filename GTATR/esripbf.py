@@ -0,0 +1,338 @@
+import struct
+
+#This module reads the Protocol Buffer (f=pbf) query responses that newer ArcGIS
+#feature services can send instead of JSON. The message layout is ESRI's
+#FeatureCollectionPBuffer; only the parts a feature query returns are read, and
+#the result is the same dictionary r.json() would give for f=json (fields,
+#features with attributes and ESRI JSON geometry, exceededTransferLimit), so the
+#rest of the library doesnt need to know which format came back. It is written
+#by hand so there is nothing extra to install.
+
+#protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+GEOMETRY_TYPES = {0: 'esriGeometryPoint',
+                  1: 'esriGeometryMultipoint',
+                  2: 'esriGeometryPolyline',
+                  3: 'esriGeometryPolygon',
+                  4: 'esriGeometryMultiPatch',
+                  127: 'esriGeometryNone'}
+
+FIELD_TYPES = ['esriFieldTypeSmallInteger', 'esriFieldTypeInteger', 'esriFieldTypeSingle', 'esriFieldTypeDouble',
+               'esriFieldTypeString', 'esriFieldTypeDate', 'esriFieldTypeOID', 'esriFieldTypeGeometry', 'esriFieldTypeBlob',
+               'esriFieldTypeRaster', 'esriFieldTypeGUID', 'esriFieldTypeGlobalID', 'esriFieldTypeXML', 'esriFieldTypeBigInteger',
+               'esriFieldTypeDateOnly', 'esriFieldTypeTimeOnly', 'esriFieldTypeTimestampOffset']
+
+#quantizeOriginPostion values, with upperLeft the y values count down from the top of the extent
+UPPER_LEFT = 0
+
+def readVarint(buffer, position):
+    """reads a base 128 varint, returns the value and the position after it"""
+    byte = buffer[position]
+    if byte < 0x80:
+        return byte, position + 1 #most keys and lengths are a single byte
+
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+def zigzag(value):
+    """undoes the zigzag encoding protobuf uses for signed (sint32/sint64) values"""
+    return (value >> 1) ^ -(value & 1)
+
+def iterFields(buffer, start, end):
+    """yields (field number, wire type, value) for every field of a message, length delimited values come back as (start, end)"""
+    position = start
+    while position < end:
+        key, position = readVarint(buffer, position)
+        wireType = key & 7
+
+        if wireType == VARINT:
+            value, position = readVarint(buffer, position)
+        elif wireType == LENGTH_DELIMITED:
+            length, position = readVarint(buffer, position)
+            value = (position, position + length)
+            position += length
+        elif wireType == FIXED64:
+            value = buffer[position:position + 8]
+            position += 8
+        elif wireType == FIXED32:
+            value = buffer[position:position + 4]
+            position += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type " + str(wireType))
+
+        yield key >> 3, wireType, value
+
+def readPackedVarints(buffer, start, end):
+    """reads a packed repeated varint field"""
+    values = []
+    position = start
+    while position < end:
+        result = 0
+        shift = 0
+        while True:
+            byte = buffer[position]
+            position += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(result)
+
+    return values
+
+def readRepeatedVarints(buffer, wireType, value):
+    """a repeated varint field is normally packed, but a single unpacked value is allowed too"""
+    if wireType == LENGTH_DELIMITED:
+        return readPackedVarints(buffer, value[0], value[1])
+    return [value]
+
+def readString(buffer, value):
+    return buffer[value[0]:value[1]].decode("utf-8")
+
+def readDouble(value):
+    return struct.unpack("<d", value)[0]
+
+def readFloat(value):
+    """a single precision value, given back with the shortest digits that still read back the same"""
+    number = struct.unpack("<f", value)[0]
+    for precision in range(6, 10):
+        shortened = float("%.*g" % (precision, number))
+        if struct.unpack("<f", struct.pack("<f", shortened))[0] == number:
+            return shortened
+
+    return number
+
+def readSigned64(value):
+    """int64 values are sent as two's complement varints"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def decodeValue(buffer, start, end):
+    """decodes an attribute Value message, a message with nothing set is a null"""
+
+    #a Value holds one field, so it is read directly rather than through iterFields, there is one per attribute
+    if start >= end:
+        return None
+
+    key, position = readVarint(buffer, start)
+    fieldNumber = key >> 3
+
+    if fieldNumber == 1:
+        length, position = readVarint(buffer, position)
+        return buffer[position:position + length].decode("utf-8")
+    if fieldNumber == 3:
+        return struct.unpack_from("<d", buffer, position)[0]
+    if fieldNumber == 2:
+        return readFloat(buffer[position:position + 4])
+
+    value, position = readVarint(buffer, position)
+    if fieldNumber in (4, 8):
+        return zigzag(value) #sint32/sint64
+    if fieldNumber == 6:
+        return readSigned64(value) #int64
+    if fieldNumber == 9:
+        return bool(value)
+
+    return value #uint32/uint64
+
+def decodeField(buffer, start, end):
+    """decodes a Field message into the field dictionary f=json gives"""
+    field = {}
+    for fieldNumber, wireType, value in iterFields(buffer, start, end):
+        if fieldNumber == 1:
+            field["name"] = readString(buffer, value)
+        elif fieldNumber == 2:
+            field["type"] = FIELD_TYPES[value] if value < len(FIELD_TYPES) else "esriFieldType" + str(value)
+        elif fieldNumber == 3:
+            field["alias"] = readString(buffer, value)
+
+    return field
+
+def decodeTransform(buffer, start, end):
+    """decodes the quantization Transform, returns (origin, scale, translate) with scale/translate as x, y, z, m"""
+    origin = UPPER_LEFT
+    scale = [1.0, 1.0, 1.0, 1.0]
+    translate = [0.0, 0.0, 0.0, 0.0]
+
+    #the Scale and Translate messages list x, y, m, z in that order
+    slots = {1: 0, 2: 1, 3: 3, 4: 2}
+    for fieldNumber, wireType, value in iterFields(buffer, start, end):
+        if fieldNumber == 1:
+            origin = value
+        elif fieldNumber in (2, 3):
+            target = scale if fieldNumber == 2 else translate
+            for innerNumber, innerType, innerValue in iterFields(buffer, value[0], value[1]):
+                if innerNumber in slots:
+                    target[slots[innerNumber]] = readDouble(innerValue)
+
+    return origin, scale, translate
+
+def decodeGeometry(buffer, start, end, geometryType, hasZ, hasM, transform):
+    """decodes a Geometry message into ESRI JSON, the coordinates are delta encoded and quantized"""
+    lengths = []
+    coordinates = []
+    for fieldNumber, wireType, value in iterFields(buffer, start, end):
+        if fieldNumber == 2:
+            lengths.extend(readRepeatedVarints(buffer, wireType, value))
+        elif fieldNumber == 3:
+            coordinates = [zigzag(number) for number in readRepeatedVarints(buffer, wireType, value)]
+
+    if not coordinates:
+        return None
+
+    origin, scale, translate = transform
+    dimension = 2 + hasZ + hasM
+    ySign = -1.0 if origin == UPPER_LEFT else 1.0
+
+    #each value is the change from the same value of the vertex before it
+    positions = []
+    x = y = z = m = 0
+    for i in range(0, len(coordinates) - dimension + 1, dimension):
+        x += coordinates[i]
+        y += coordinates[i + 1]
+        position = [translate[0] + x * scale[0], translate[1] + ySign * y * scale[1]]
+
+        if hasZ:
+            z += coordinates[i + 2]
+            position.append(translate[2] + z * scale[2])
+        if hasM:
+            m += coordinates[i + dimension - 1]
+            position.append(translate[3] + m * scale[3])
+
+        positions.append(position)
+
+    if geometryType == 'esriGeometryPoint':
+        geometry = {"x": positions[0][0], "y": positions[0][1]}
+        if hasZ:
+            geometry["z"] = positions[0][2]
+        if hasM:
+            geometry["m"] = positions[0][len(positions[0]) - 1]
+        return geometry
+
+    #split the vertices into the parts, a missing length list means one part
+    parts = []
+    first = 0
+    for length in lengths or [len(positions)]:
+        parts.append(positions[first:first + length])
+        first += length
+
+    if geometryType == 'esriGeometryMultipoint':
+        return {"points": [position for part in parts for position in part]}
+    if geometryType == 'esriGeometryPolyline':
+        return {"paths": parts}
+    return {"rings": parts}
+
+def decodeFeatureResult(buffer, start, end):
+    """decodes a FeatureResult message into the dictionary f=json gives"""
+    data = {"fields": [], "features": []}
+    hasZ = False
+    hasM = False
+    transform = (UPPER_LEFT, [1.0, 1.0, 1.0, 1.0], [0.0, 0.0, 0.0, 0.0])
+    featureMessages = []
+
+    #the features are read last, they need the fields, geometry type and transform which can come in any order
+    for fieldNumber, wireType, value in iterFields(buffer, start, end):
+        if fieldNumber == 1:
+            data["objectIdFieldName"] = readString(buffer, value)
+        elif fieldNumber == 3:
+            data["globalIdFieldName"] = readString(buffer, value)
+        elif fieldNumber == 7:
+            data["geometryType"] = GEOMETRY_TYPES.get(value, 'esriGeometryNone')
+        elif fieldNumber == 8:
+            spatialReference = {}
+            for innerNumber, innerType, innerValue in iterFields(buffer, value[0], value[1]):
+                if innerNumber == 1:
+                    spatialReference["wkid"] = innerValue
+                elif innerNumber == 2:
+                    spatialReference["latestWkid"] = innerValue
+                elif innerNumber == 5:
+                    spatialReference["wkt"] = readString(buffer, innerValue)
+            data["spatialReference"] = spatialReference
+        elif fieldNumber == 9:
+            data["exceededTransferLimit"] = bool(value)
+        elif fieldNumber == 10:
+            hasZ = bool(value)
+        elif fieldNumber == 11:
+            hasM = bool(value)
+        elif fieldNumber == 12:
+            transform = decodeTransform(buffer, value[0], value[1])
+        elif fieldNumber == 13:
+            data["fields"].append(decodeField(buffer, value[0], value[1]))
+        elif fieldNumber == 15:
+            featureMessages.append(value)
+
+    if hasZ:
+        data["hasZ"] = True
+    if hasM:
+        data["hasM"] = True
+
+    fieldNames = [field.get("name") for field in data["fields"]]
+    geometryType = data.get("geometryType", 'esriGeometryNone')
+
+    for featureStart, featureEnd in featureMessages:
+        values = []
+        geometry = None
+        centroid = None
+
+        #every field of a Feature is length delimited, attributes are field 1, the geometry field 2 and the centroid field 4
+        position = featureStart
+        while position < featureEnd:
+            key, position = readVarint(buffer, position)
+            if key & 7 != LENGTH_DELIMITED:
+                raise ValueError("Unexpected wire type in a PBF feature")
+
+            length, position = readVarint(buffer, position)
+            if key >> 3 == 1:
+                values.append(decodeValue(buffer, position, position + length))
+            elif key >> 3 == 2:
+                geometry = decodeGeometry(buffer, position, position + length, geometryType, hasZ, hasM, transform)
+            elif key >> 3 == 4:
+                centroid = decodeGeometry(buffer, position, position + length, 'esriGeometryPoint', False, False, transform)
+            position += length
+
+        feature = {"attributes": dict(zip(fieldNames, values))}
+        if geometry is not None:
+            feature["geometry"] = geometry
+        if centroid is not None:
+            feature["centroid"] = centroid
+        data["features"].append(feature)
+
+    return data
+
+def decodeFeatureCollection(content):
+    """decodes an f=pbf query response into the same dictionary f=json would have given"""
+    buffer = bytes(content) #indexing bytes is quicker than a memoryview
+
+    for fieldNumber, wireType, value in iterFields(buffer, 0, len(buffer)):
+        if fieldNumber != 2:
+            continue #version
+
+        #QueryResult holds one of a feature result, a count or the object IDs
+        for resultNumber, resultType, resultValue in iterFields(buffer, value[0], value[1]):
+            if resultNumber == 1:
+                return decodeFeatureResult(buffer, resultValue[0], resultValue[1])
+            if resultNumber == 2:
+                for countNumber, countType, count in iterFields(buffer, resultValue[0], resultValue[1]):
+                    if countNumber == 1:
+                        return {"count": count}
+                return {"count": 0}
+            if resultNumber == 3:
+                data = {"objectIds": []}
+                for idsNumber, idsType, idsValue in iterFields(buffer, resultValue[0], resultValue[1]):
+                    if idsNumber == 1:
+                        data["objectIdFieldName"] = readString(buffer, idsValue)
+                    elif idsNumber == 3:
+                        data["objectIds"].extend(readRepeatedVarints(buffer, idsType, idsValue))
+                return data
+
+    raise ValueError("No query result found in the PBF response")
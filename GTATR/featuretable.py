@@ -0,0 +1,354 @@
+import sys
+from array import array
+from itertools import chain
+
+import esrigeometry
+
+#This module holds downloaded features column by column instead of as a list of
+#dictionaries, so the field names and the Python object for every value arent
+#repeated for each feature. Number and date fields are kept in typed arrays, text
+#fields are dictionary encoded (each distinct value stored once, the rows keep a
+#small code), and the geometry is kept as one flat coordinate array with part and
+#geometry offsets. RESTConnector.getFeatureTable fills one straight from each
+#chunk as it arrives.
+
+#ESRI field types and the array type code they are kept in
+INTEGER_TYPES = ('esriFieldTypeOID', 'esriFieldTypeInteger', 'esriFieldTypeSmallInteger', 'esriFieldTypeBigInteger', 'esriFieldTypeDate')
+FLOAT_TYPES = ('esriFieldTypeDouble', 'esriFieldTypeSingle')
+TEXT_TYPES = ('esriFieldTypeString', 'esriFieldTypeGUID', 'esriFieldTypeGlobalID', 'esriFieldTypeDateOnly', 'esriFieldTypeTimeOnly', 'esriFieldTypeTimestampOffset')
+
+#this class keeps a number field in a typed array, with a null mask that is only made once a null turns up
+class NumberColumn():
+
+    def __init__(self, typeCode, values=None, nulls=None):
+        self.typeCode = typeCode
+        self.values = values if values is not None else array(typeCode)
+        self.nulls = nulls
+
+    def append(self, value):
+        """adds a value, raises TypeError/OverflowError if it doesnt fit the array type"""
+        if value is None:
+            if self.nulls is None:
+                self.nulls = bytearray(len(self.values))
+            self.values.append(0)
+            self.nulls.append(1)
+            return
+
+        self.values.append(value)
+        if self.nulls is not None:
+            self.nulls.append(0)
+
+    def get(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.values[i]
+
+    def toList(self):
+        values = self.values.tolist()
+        if self.nulls is not None:
+            values = [None if isNull else value for value, isNull in zip(values, self.nulls)]
+        return values
+
+    def slice(self, start, stop):
+        return NumberColumn(self.typeCode, self.values[start:stop], self.nulls[start:stop] if self.nulls is not None else None)
+
+    def nbytes(self):
+        return self.values.buffer_info()[1] * self.values.itemsize + (len(self.nulls) if self.nulls is not None else 0)
+
+#this class dictionary encodes a text field, each distinct value is stored once and the rows keep its code
+class TextColumn():
+
+    def __init__(self, codes=None, lookup=None, distinctValues=None):
+        self.codes = codes if codes is not None else array('l')
+        self.lookup = lookup if lookup is not None else {}
+        self.distinctValues = distinctValues if distinctValues is not None else []
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.distinctValues)
+            self.lookup[value] = code
+            self.distinctValues.append(value)
+
+        self.codes.append(code)
+
+    def get(self, i):
+        code = self.codes[i]
+        return None if code < 0 else self.distinctValues[code]
+
+    def toList(self):
+        distinctValues = self.distinctValues
+        return [None if code < 0 else distinctValues[code] for code in self.codes]
+
+    def slice(self, start, stop):
+        #the slice shares the distinct values, they arent changed once added
+        return TextColumn(self.codes[start:stop], self.lookup, self.distinctValues)
+
+    def nbytes(self):
+        return (self.codes.buffer_info()[1] * self.codes.itemsize + sys.getsizeof(self.lookup) + sys.getsizeof(self.distinctValues)
+                + sum(sys.getsizeof(value) for value in self.distinctValues))
+
+#this class is a plain list for field types that arent numbers or text, or a typed column that got a value it couldnt hold
+class ListColumn():
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else []
+
+    def append(self, value):
+        self.values.append(value)
+
+    def get(self, i):
+        return self.values[i]
+
+    def toList(self):
+        return list(self.values)
+
+    def slice(self, start, stop):
+        return ListColumn(self.values[start:stop])
+
+    def nbytes(self):
+        return sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values)
+
+def makeColumn(fieldType):
+    """returns an empty column for an ESRI field type"""
+    if fieldType in INTEGER_TYPES:
+        return NumberColumn('q')
+    if fieldType in FLOAT_TYPES:
+        return NumberColumn('d')
+    if fieldType in TEXT_TYPES:
+        return TextColumn()
+    return ListColumn()
+
+def inferColumn(values):
+    """returns an empty column for a field with no type, picked from its values in the first chunk"""
+    types = set(type(value) for value in values if value is not None)
+    if types == {int}:
+        return NumberColumn('q')
+    if types == {float}:
+        return NumberColumn('d')
+    if types == {str}:
+        return TextColumn()
+    return ListColumn()
+
+def toCoordinate(value):
+    """coordinates can come back as null or "NaN", both are stored as nan"""
+    if value is None or value == "NaN":
+        return float("nan")
+    return float(value)
+
+#this class keeps the geometry of every feature as flat buffers: the coordinates of every vertex one after
+#the other, where each part (ring, path or list of points) starts in them, and where each feature's parts start
+class GeometryColumn():
+
+    def __init__(self, dimension=None, kinds=None, geometryOffsets=None, partOffsets=None, coordinates=None):
+        self.dimension = dimension #2 for x/y, 3 or 4 with z/m, set from the first geometry that has coordinates
+        self.kinds = kinds if kinds is not None else array('b')
+        self.geometryOffsets = geometryOffsets if geometryOffsets is not None else array('q', [0])
+        self.partOffsets = partOffsets if partOffsets is not None else array('q', [0])
+        self.coordinates = coordinates if coordinates is not None else array('d')
+
+    def append(self, geometry):
+        kind, parts = esrigeometry.getParts(geometry)
+        if not any(parts):
+            #only empty parts (like {"rings": [[]]}) is stored as a null geometry
+            kind, parts = esrigeometry.EMPTY, []
+
+        if parts and self.dimension is None:
+            for part in parts:
+                if part:
+                    self.dimension = min(max(len(part[0]), 2), 4)
+                    break
+
+        coordinates = self.coordinates
+        dimension = self.dimension
+        for part in parts:
+            #the quick way works when every position has the same number of values as the column
+            start = len(coordinates)
+            try:
+                coordinates.extend(chain.from_iterable(part))
+            except TypeError:
+                pass #a null or "NaN" somewhere
+
+            if len(coordinates) - start != len(part) * dimension:
+                del coordinates[start:]
+                for position in part:
+                    position = [toCoordinate(value) for value in position[:dimension]]
+                    coordinates.extend(position + [float("nan")] * (dimension - len(position)))
+
+            self.partOffsets.append(len(coordinates) // dimension)
+
+        self.kinds.append(kind)
+        self.geometryOffsets.append(len(self.partOffsets) - 1)
+
+    def getParts(self, i):
+        """returns the parts of a geometry as lists of coordinates"""
+        parts = []
+        for part in range(self.geometryOffsets[i], self.geometryOffsets[i + 1]):
+            values = self.coordinates[self.partOffsets[part] * self.dimension:self.partOffsets[part + 1] * self.dimension].tolist()
+            parts.append([values[j:j + self.dimension] for j in range(0, len(values), self.dimension)])
+
+        return parts
+
+    def get(self, i):
+        """rebuilds the ESRI JSON geometry of a feature, None if it had none"""
+        kind = self.kinds[i]
+
+        if kind == esrigeometry.EMPTY:
+            return None
+
+        parts = self.getParts(i)
+
+        if kind == esrigeometry.POINT:
+            geometry = {"x": parts[0][0][0], "y": parts[0][0][1]}
+            if self.dimension > 2:
+                geometry["z"] = parts[0][0][2]
+            return geometry
+
+        if kind == esrigeometry.MULTIPOINT:
+            return {"points": parts[0]}
+
+        if kind == esrigeometry.POLYLINE:
+            return {"paths": parts}
+
+        return {"rings": parts}
+
+    def slice(self, start, stop):
+        firstPart, lastPart = self.geometryOffsets[start], self.geometryOffsets[stop]
+        firstVertex, lastVertex = self.partOffsets[firstPart], self.partOffsets[lastPart]
+        dimension = self.dimension or 2
+
+        return GeometryColumn(self.dimension,
+                              self.kinds[start:stop],
+                              array('q', (offset - firstPart for offset in self.geometryOffsets[start:stop + 1])),
+                              array('q', (offset - firstVertex for offset in self.partOffsets[firstPart:lastPart + 1])),
+                              self.coordinates[firstVertex * dimension:lastVertex * dimension])
+
+    def nbytes(self):
+        return sum(buffer.buffer_info()[1] * buffer.itemsize for buffer in (self.kinds, self.geometryOffsets, self.partOffsets, self.coordinates))
+
+def getTableFields(layerInfo, fields):
+    """returns the layer's field definitions for a comma separated field list ('*' for all), None if the layer has no field list"""
+    if not layerInfo or not layerInfo.get("fields"):
+        return None
+
+    requestedFields = [field.strip().lower() for field in fields.split(",")]
+
+    return [field for field in layerInfo["fields"]
+            if field.get("type") != "esriFieldTypeGeometry" and ("*" in requestedFields or field["name"].lower() in requestedFields)]
+
+#this class is the table itself, one column per field plus an optional geometry column
+class FeatureTable():
+
+    def __init__(self, fields=None, geometry=False):
+        """fields is the layer's field list (dictionaries with name and type), None takes the field names from the first feature"""
+        self.fieldNames = []
+        self.columns = []
+        self.rowCount = 0
+        self.geometry = GeometryColumn() if geometry else None
+
+        if fields is not None:
+            for field in fields:
+                self.fieldNames.append(field["name"])
+                self.columns.append(makeColumn(field.get("type")))
+
+    def append(self, features):
+        """adds a chunk of ESRI JSON features (attributes and geometry) as returned by the service"""
+        for feature in features:
+            attributes = feature["attributes"]
+
+            #without the layer's field list the names come from the first feature and the types from the first chunk
+            if not self.fieldNames and not self.rowCount:
+                self.fieldNames = list(attributes.keys())
+                self.columns = [inferColumn([feature["attributes"].get(name) for feature in features]) for name in self.fieldNames]
+
+            for j, name in enumerate(self.fieldNames):
+                value = attributes.get(name)
+                try:
+                    self.columns[j].append(value)
+                except (TypeError, OverflowError):
+                    #the value doesnt fit the field's array type, keep the column as a plain list from here on
+                    column = ListColumn(self.columns[j].toList())
+                    column.append(value)
+                    self.columns[j] = column
+
+            if self.geometry is not None:
+                self.geometry.append(feature.get("geometry"))
+
+            self.rowCount += 1
+
+    def __len__(self):
+        return self.rowCount
+
+    def getRow(self, i):
+        """returns one feature as a dictionary of its attributes, plus a 'geometry' key if the table has geometry"""
+        if i < 0:
+            i += self.rowCount
+        if i < 0 or i >= self.rowCount:
+            raise IndexError("FeatureTable index out of range")
+
+        row = {name: column.get(i) for name, column in zip(self.fieldNames, self.columns)}
+        if self.geometry is not None:
+            row["geometry"] = self.geometry.get(i)
+
+        return row
+
+    def __getitem__(self, index):
+        """an index gives one row as a dictionary, a slice gives a new FeatureTable"""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.rowCount)
+            if step != 1:
+                raise ValueError("FeatureTable slices can't have a step")
+            return self.slice(start, max(start, stop))
+
+        return self.getRow(index)
+
+    def slice(self, start, stop):
+        """returns the rows from start up to stop as a new FeatureTable"""
+        table = FeatureTable()
+        table.fieldNames = list(self.fieldNames)
+        table.columns = [column.slice(start, stop) for column in self.columns]
+        table.geometry = self.geometry.slice(start, stop) if self.geometry is not None else None
+        table.rowCount = stop - start
+
+        return table
+
+    def __iter__(self):
+        """yields each row as a dictionary, only one row is built at a time"""
+        for i in range(self.rowCount):
+            yield self.getRow(i)
+
+    def iterRows(self):
+        """yields each row's attribute values as a tuple in field order, cheaper than dictionaries"""
+        return zip(*[column.toList() for column in self.columns]) if self.columns else iter(())
+
+    def column(self, name):
+        """returns every value of one field as a list"""
+        return self.columns[self.fieldNames.index(name)].toList()
+
+    def geometries(self):
+        """returns the ESRI JSON geometry of every row"""
+        if self.geometry is None:
+            return [None] * self.rowCount
+        return [self.geometry.get(i) for i in range(self.rowCount)]
+
+    def to_dicts(self):
+        """returns the rows as a list of dictionaries, the same shape getFeatures/getFeaturesWithGeometry return"""
+        columnValues = [column.toList() for column in self.columns]
+        rows = [dict(zip(self.fieldNames, values)) for values in zip(*columnValues)] if columnValues else [{} for i in range(self.rowCount)]
+
+        if self.geometry is not None:
+            for i, row in enumerate(rows):
+                row["geometry"] = self.geometry.get(i)
+
+        return rows
+
+    def nbytes(self):
+        """roughly how much memory the table's data takes"""
+        total = sum(column.nbytes() for column in self.columns)
+        if self.geometry is not None:
+            total += self.geometry.nbytes()
+        return total
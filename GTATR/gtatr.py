@@ -3,6 +3,510 @@
 ########################################
 
 import requests #REST requests
+from requests.adapters import HTTPAdapter
+import threading #per-host request limits
+import time
+import json
+import math
+import random #jitter for retry backoff
+from email.utils import parsedate_to_datetime #Retry-After dates
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor #parallel chunk fetching
+from urllib.parse import urlparse
+
+import esrigeometry #ESRI JSON to geoJSON geometry, uses numpy when it is installed
+import featuretable #compact column store for downloaded features
+import esripbf #reads f=pbf query responses
+import esrijson #fast and incremental JSON decoding of query responses
+import spatialindex #exact intersects test for the tiles of a polygon query
+
+#This class limits the number of requests in flight to one host, used as a with block
+#around each request. There is one per host, shared by every RESTConnector, so two
+#connectors on the same server still obey the limit
+
+class HostLimiter():
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def lowerLimit(self, limit):
+        """a connector asking for fewer requests at once lowers the limit for every connector on the host"""
+        with self.condition:
+            self.limit = min(self.limit, limit)
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+hostLimiters = {}
+hostLimitersLock = threading.Lock()
+
+def getHostLimiter(URL, limit):
+    """returns the shared HostLimiter for the host in the URL, the host keeps the lowest limit any connector has asked for"""
+    host = urlparse(URL).netloc.lower()
+
+    with hostLimitersLock:
+        #the limiter is never replaced, a new one would let requests through on top of the ones holding the old one
+        if host not in hostLimiters:
+            hostLimiters[host] = HostLimiter(limit)
+        hostLimiters[host].lowerLimit(limit)
+        return hostLimiters[host]
+
+#token buckets limiting the request rate to each host, shared the same way as the HostLimiters
+hostRateLimiters = {}
+hostRateLimitersLock = threading.Lock()
+
+def getHostRateLimiter(URL, requestsPerSecond, burst=None):
+    """returns the shared rate limiter for the host in the URL, new settings for the host replace the old ones"""
+    host = urlparse(URL).netloc.lower()
+
+    with hostRateLimitersLock:
+        if host not in hostRateLimiters or hostRateLimiters[host][0] != (requestsPerSecond, burst):
+            hostRateLimiters[host] = ((requestsPerSecond, burst), RateLimiter(requestsPerSecond, burst))
+        return hostRateLimiters[host][1]
+
+#error raised when a request still fails after all of its retries
+class RESTError(Exception):
+    pass
+
+def getArcGISError(r):
+    """ArcGIS often sends errors back with a 200 status and an error JSON body, this returns that error dictionary or None"""
+
+    #error bodies are small, dont parse big feature responses just to look for one
+    contentLength = r.headers.get('Content-Length')
+    if contentLength and contentLength.isdigit():
+        if int(contentLength) > 4096:
+            return None
+    elif not getattr(r, '_content_consumed', True):
+        #a streamed body of unknown size (chunked or gzipped) would have to be read in full to find out, so it is
+        #left for the caller's decoder, esrijson.FeatureStream raises ServiceError on an error body
+        return None
+    if len(r.content) > 4096 or b'"error"' not in r.content:
+        return None
+
+    try:
+        data = r.json()
+    except:
+        return None
+
+    if isinstance(data, dict) and isinstance(data.get("error"), dict):
+        return data["error"]
+    return None
+
+#This class decides whether a failed request should be tried again and how long to
+#wait first, using exponential backoff with jitter and the server's Retry-After header
+
+class RetryPolicy():
+
+    def __init__(self, maxRetries=5, backoffFactor=0.5, maxBackoff=60.0, jitter=True, retryStatuses=(429, 500, 502, 503, 504)):
+        """maxRetries is the number of tries after the first, the wait doubles from backoffFactor up to maxBackoff seconds"""
+        self.maxRetries = maxRetries
+        self.backoffFactor = backoffFactor
+        self.maxBackoff = maxBackoff
+        self.jitter = jitter
+        self.retryStatuses = set(retryStatuses)
+
+    def shouldRetry(self, r, error=None):
+        """returns a short reason if the response (or connection error) is worth retrying, otherwise None"""
+        if error is not None:
+            return type(error).__name__
+
+        if r.status_code in self.retryStatuses:
+            return "HTTP " + str(r.status_code)
+
+        #ArcGIS error JSON with a server side code, e.g. {"error": {"code": 503, ...}}
+        arcgisError = getArcGISError(r)
+        if arcgisError and arcgisError.get("code") in self.retryStatuses:
+            return "ArcGIS error " + str(arcgisError.get("code")) + " " + str(arcgisError.get("message"))
+
+        return None
+
+    def getDelay(self, attempt, r=None):
+        """seconds to wait before retry number attempt (starting at 0), a Retry-After header from the server wins"""
+        if r is not None and r.headers.get("Retry-After"):
+            retryAfter = r.headers["Retry-After"]
+            try:
+                return min(self.maxBackoff, max(0.0, float(retryAfter)))
+            except ValueError:
+                try:
+                    return min(self.maxBackoff, max(0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time()))
+                except:
+                    pass
+
+        delay = min(self.maxBackoff, self.backoffFactor * (2 ** attempt))
+
+        #full jitter spreads the retries of parallel workers out so they dont all hit the server at once
+        if self.jitter:
+            delay = random.uniform(0, delay)
+
+        return delay
+
+#This class is a named set of output parameters for feature queries. Full precision
+#geometry in outSr 4326 is far more than a map needs, so a profile can round the
+#coordinates (geometryPrecision), let the server generalize them (maxAllowableOffset,
+#in degrees), snap them to a grid on PBF requests (quantizationParameters), or ask
+#for just a centroid point per feature. Profiles are given to the feature methods
+#by name (see outputProfiles) or as an OutputProfile
+
+class OutputProfile():
+
+    def __init__(self, name, geometryPrecision=None, maxAllowableOffset=None, quantizationTolerance=None, centroidOnly=False):
+        """an empty profile (e.g. OutputProfile("analysis")) leaves the geometry at full precision"""
+        self.name = name
+        self.geometryPrecision = geometryPrecision
+        self.maxAllowableOffset = maxAllowableOffset
+        self.quantizationTolerance = quantizationTolerance
+        self.centroidOnly = centroidOnly
+
+    def getParameters(self, requestFormat, supportsCentroid=False):
+        """returns the query parameters for this profile, quantization is only asked for on PBF requests since they
+        come back with the transform needed to read them"""
+        PARAMS = {}
+
+        if self.geometryPrecision is not None:
+            PARAMS['geometryPrecision'] = self.geometryPrecision
+
+        if self.maxAllowableOffset:
+            PARAMS['maxAllowableOffset'] = self.maxAllowableOffset
+
+        if self.quantizationTolerance and requestFormat == 'pbf':
+            PARAMS['quantizationParameters'] = json.dumps({'mode': 'view',
+                                                           'originPosition': 'upperLeft',
+                                                           'tolerance': self.quantizationTolerance,
+                                                           'extent': {'xmin': -180, 'ymin': -90, 'xmax': 180, 'ymax': 90,
+                                                                      'spatialReference': {'wkid': 4326}}})
+
+        #the server sends a centroid instead of the whole shape, layers that cant do that send the shape generalized
+        if self.centroidOnly and supportsCentroid:
+            PARAMS['returnGeometry'] = 'false'
+            PARAMS['returnCentroid'] = 'true'
+
+        return PARAMS
+
+def displayProfile(scale, dpi=96):
+    """returns a profile for drawing at a map scale (e.g. 24000 for 1:24,000), detail smaller than a pixel is dropped"""
+    #a pixel on the ground in meters, then in degrees (a degree is about 111,320 meters at the equator)
+    pixelDegrees = scale * 0.0254 / dpi / 111320.0
+
+    return OutputProfile("display 1:" + str(scale),
+                         geometryPrecision=max(0, int(math.ceil(-math.log10(pixelDegrees)))) + 1,
+                         maxAllowableOffset=pixelDegrees,
+                         quantizationTolerance=pixelDegrees)
+
+#the built in profiles, more can be added to the dictionary
+outputProfiles = {'analysis': OutputProfile("analysis"),
+                  'display': displayProfile(24000),
+                  'overview': displayProfile(1000000),
+                  'centroid': OutputProfile("centroid", geometryPrecision=6, maxAllowableOffset=0.001, centroidOnly=True)}
+
+def getOutputProfile(profile):
+    """returns the OutputProfile for a profile name, an OutputProfile is passed straight through"""
+    if profile is None or isinstance(profile, OutputProfile):
+        return profile
+
+    if profile not in outputProfiles:
+        raise ValueError("Unknown output profile " + str(profile) + ", expected one of " + ", ".join(outputProfiles))
+
+    return outputProfiles[profile]
+
+#This class is a token bucket that limits how fast requests are sent to one host. When
+#the server pushes back (429/503) the rate is halved, and it creeps back up towards the
+#configured rate as requests succeed, so it settles near what the server tolerates
+
+class RateLimiter():
+
+    def __init__(self, requestsPerSecond, burst=None):
+        """requestsPerSecond is the most the limiter will ever allow, burst is how many can go at once after a quiet spell"""
+        self.maxRate = float(requestsPerSecond)
+        self.rate = self.maxRate
+        self.capacity = float(burst) if burst else max(1.0, self.maxRate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """blocks until a request is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def slowDown(self):
+        """the server is pushing back, so halve the rate"""
+        with self.lock:
+            self.rate = max(self.maxRate / 64.0, self.rate / 2.0)
+
+    def speedUp(self):
+        """a request went through, so let the rate recover a little"""
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 20.0)
+
+def getLayerURL(URL):
+    """strips the /query endpoint and any parameters off a URL to get back to the layer, e.g. .../MapServer/5"""
+    layerURL = URL.split("?")[0].rstrip("/")
+
+    if layerURL.endswith("/query"):
+        layerURL = layerURL[:-len("/query")]
+
+    return layerURL
+
+def getFeatureOID(feature, oidField):
+    """returns the object ID of a feature from either an ESRI JSON or a geoJSON response"""
+    if 'attributes' in feature:
+        return feature['attributes'].get(oidField)
+
+    if feature.get('id') is not None:
+        return feature['id']
+
+    return (feature.get('properties') or {}).get(oidField)
+
+def exceededTransferLimit(data):
+    """checks if the server cut a query response short, geoJSON responses keep the flag under properties"""
+    return bool(data.get('exceededTransferLimit') or (data.get('properties') or {}).get('exceededTransferLimit'))
+
+#how many times a chunk that came back cut short is split again before the download gives up on it
+maxChunkSplits = 20
+
+#spatial relationships where the features of the whole area are just the features of each tile put together
+tileSpatialRelations = ('esriSpatialRelIntersects', 'esriSpatialRelEnvelopeIntersects', 'esriSpatialRelIndexIntersects')
+
+#a query geometry longer than this wont fit in a URL, so the request goes as a form POST instead
+maxGETGeometryLength = 2000
+
+def getRequestMethod(PARAMS):
+    """GET for most queries, POST when a long polygon filter would make the URL too long for the server"""
+    return 'POST' if len(str(PARAMS.get('geometry') or '')) > maxGETGeometryLength else 'GET'
+
+def parseQueryGeometry(geometryToUse):
+    """returns the query geometry as an ESRI JSON dictionary, it can be given as one, as JSON text, or as "xmin,ymin,xmax,ymax" """
+    if isinstance(geometryToUse, dict):
+        return geometryToUse
+
+    geometryText = str(geometryToUse).strip()
+    if geometryText.startswith("{"):
+        return json.loads(geometryText)
+
+    try:
+        xmin, ymin, xmax, ymax = [float(value) for value in geometryText.split(",")]
+    except ValueError:
+        #a single "x,y" point or something else the server understands but we dont
+        return None
+
+    return {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
+
+def splitEnvelope(envelope):
+    """splits (xmin, ymin, xmax, ymax) into its four quadrants"""
+    xmin, ymin, xmax, ymax = envelope
+    xmid = (xmin + xmax) / 2.0
+    ymid = (ymin + ymax) / 2.0
+
+    return [(xmin, ymin, xmid, ymid), (xmid, ymin, xmax, ymid), (xmin, ymid, xmid, ymax), (xmid, ymid, xmax, ymax)]
+
+#This class works out how many features to ask for in each chunk. It starts
+#from the configured size (never more than the layer's maxRecordCount) and then
+#tunes it from how long each response took and how big it was, so fast servers
+#get fewer, bigger requests and slow ones stay clear of their timeouts
+
+class ChunkSizer():
+
+    def __init__(self, chunkSize=300, minChunkSize=25, maxChunkSize=2000, targetSeconds=2.0, maxChunkBytes=8*1024*1024, maxRecordCount=None):
+        """sets the starting chunk size and the bounds it is allowed to move between"""
+        if maxRecordCount:
+            maxChunkSize = min(maxChunkSize, int(maxRecordCount))
+
+        self.minChunkSize = max(1, min(minChunkSize, maxChunkSize))
+        self.maxChunkSize = max(self.minChunkSize, maxChunkSize)
+        self.targetSeconds = targetSeconds
+        self.maxChunkBytes = maxChunkBytes
+
+        self.chunkSize = float(self.clamp(chunkSize))
+        self.lock = threading.Lock()
+
+    def clamp(self, size):
+        """keeps a size inside the min and max bounds"""
+        return max(self.minChunkSize, min(self.maxChunkSize, int(size)))
+
+    def nextSize(self):
+        """returns the number of OIDs to put in the next chunk"""
+        with self.lock:
+            return self.clamp(self.chunkSize)
+
+    def limitTo(self, size):
+        """the server cut a response short (exceededTransferLimit), so never ask for more than it returned"""
+        with self.lock:
+            self.maxChunkSize = max(self.minChunkSize, min(self.maxChunkSize, int(size)))
+            self.chunkSize = min(self.chunkSize, self.maxChunkSize)
+
+    def record(self, featureCount, seconds, nBytes):
+        """updates the chunk size from a finished response"""
+        if featureCount <= 0:
+            return
+
+        #the size that would have hit the target time, and the size that would have hit the byte limit
+        idealSize = featureCount * self.targetSeconds / max(seconds, 0.001)
+        if nBytes > 0:
+            idealSize = min(idealSize, featureCount * self.maxChunkBytes / float(nBytes))
+
+        #move half way to the new size so one odd response doesnt swing it too far
+        with self.lock:
+            self.chunkSize = max(self.minChunkSize, min(self.maxChunkSize, (self.chunkSize + idealSize) / 2.0))
+
+def isTokenError(r):
+    """checks if the server rejected the request because the token is invalid or expired (ArcGIS codes 498/499)"""
+    if r.status_code in (498, 499):
+        return True
+
+    arcgisError = getArcGISError(r)
+    if arcgisError is None:
+        return False
+
+    return arcgisError.get("code") in (498, 499) or "invalid token" in str(arcgisError.get("message")).lower()
+
+#This class looks after an ArcGIS token for a connector. It remembers when the token
+#expires and gets a new one a little ahead of time, under a lock so parallel workers
+#share a single refresh instead of each asking for their own
+
+class TokenManager():
+
+    def __init__(self, username, password, tokenURL, referer, sendRequest, expiration=60, refreshMargin=300):
+        """expiration is the token lifetime in minutes to ask for, refreshMargin the seconds before expiry to renew it"""
+        self.username = username
+        self.password = password
+        self.tokenURL = tokenURL
+        self.referer = referer
+        self.sendRequest = sendRequest
+        self.expiration = expiration
+        self.refreshMargin = refreshMargin
+
+        #first check if token is a arcgis style or portal style, tokenURL = "https://mydomain.net/arcgis/tokens/"
+        #this logic could be improved
+        self.tokenStyle = "arcgis"
+        if "/portal/sharing/rest/generateToken" in tokenURL:
+            self.tokenStyle = "Portal"
+
+        self.token = None
+        self.expires = 0 #seconds since the epoch
+        self.lock = threading.RLock()
+
+    def requestToken(self):
+        """asks the token service for a new token, returns (token, expiry in seconds since the epoch)"""
+        if self.tokenStyle == "Portal":
+            PARAMS = {'username':self.username, 
+                    'password':self.password,
+                    'client' : 'referer', #this is critical for authentication, other ways dont work
+                    'referer': self.referer,
+                    'f' : 'JSON',
+                    'expiration': self.expiration,} 
+        else:
+            # data to be sent to api 
+            PARAMS = {'username':self.username, 
+                    'password':self.password,
+                    'client' : 'requestip', #this is critical for authentication, other ways dont work
+                    'referer': self.referer,
+                    'format' : 'JSON',
+                    'expiration': self.expiration,} 
+
+        requestTime = time.time()
+        r = self.sendRequest(self.tokenURL, {}, PARAMS, method='POST')
+
+        #portal returns the token as a dictionary with its expiry in milliseconds, some servers just send the token text
+        try:
+            data = r.json()
+        except:
+            data = None
+
+        if isinstance(data, dict):
+            if "token" not in data:
+                raise RESTError("Token request failed -- " + str(data.get("error", data)))
+
+            expires = data.get("expires")
+            if expires:
+                return data["token"], float(expires) / 1000.0
+
+            return data["token"], requestTime + self.expiration * 60
+
+        return r.text.strip(), requestTime + self.expiration * 60
+
+    def refresh(self, failedToken=None):
+        """gets a new token, if another worker already replaced failedToken that one is used instead"""
+        with self.lock:
+            if failedToken is not None and self.token is not None and self.token != failedToken:
+                return self.token
+
+            self.token, self.expires = self.requestToken()
+            print("Token refreshed, expires at " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.expires)))
+
+            return self.token
+
+    def getToken(self):
+        """returns a token that is good for at least refreshMargin seconds, refreshing it if needed"""
+        if self.token is not None and time.time() < self.expires - self.refreshMargin:
+            return self.token
+
+        #check again under the lock, the first worker in does the refresh and the rest pick it up
+        with self.lock:
+            if self.token is not None and time.time() < self.expires - self.refreshMargin:
+                return self.token
+
+            return self.refresh()
+
+#This class holds the download plan the connector picked for a query from a
+#pre-flight probe of the layer, explain() gives a readable summary of it
+
+class QueryPlan():
+
+    def __init__(self, layerURL, queryText):
+        """starts an empty plan, RESTConnector.planQuery fills in the rest"""
+        self.layerURL = layerURL
+        self.queryText = queryText
+
+        #what the probe found out about the layer
+        self.count = None
+        self.extent = None
+        self.maxRecordCount = None
+        self.geometryType = None
+        self.objectIdField = None
+        self.supportsPagination = False
+        self.supportsStatistics = False
+
+        #what the connector will do about it
+        self.strategy = 'oids'
+        self.chunkSize = None
+        self.concurrency = 1
+        self.estimatedRequests = None
+        self.reason = ""
+
+    def explain(self):
+        """returns a description of the plan and why it was chosen"""
+        lines = ["Query plan for " + str(self.layerURL) + " where " + str(self.queryText),
+                 "  features: " + str(self.count) + " (maxRecordCount " + str(self.maxRecordCount) + ", geometry " + str(self.geometryType) + ")",
+                 "  capabilities: paging " + str(self.supportsPagination) + ", statistics " + str(self.supportsStatistics) + ", object IDs " + str(self.objectIdField),
+                 "  strategy: " + self.strategy + " - " + self.reason,
+                 "  chunk size: " + str(self.chunkSize) + ", concurrency: " + str(self.concurrency) + ", estimated requests: " + str(self.estimatedRequests)]
+
+        if self.extent:
+            lines.insert(2, "  extent: " + ", ".join(str(self.extent.get(key)) for key in ('xmin', 'ymin', 'xmax', 'ymax')))
+
+        return "\n".join(lines)
 
 #This class is used for reading and bulk downloading data
 #from ArcGIS REST Services, it uses regular rest requests
@@ -11,11 +515,40 @@ import requests #REST requests
 
 class RESTConnector():
        
-    def __init__(self, baseURL, tokenNo = ""): #base url is like https://maps.foresitegroup.net/arcgis
+    def __init__(self, baseURL, tokenNo = "", maxWorkers = 4, perHostLimit = None): #base url is like https://maps.foresitegroup.net/arcgis
         """basic construction, creates basic startup for the future REST connections"""
                 
         self.baseURL = baseURL
         self.tokenNo = tokenNo #optional, but if the user knows the token - can pass it in
+        self.tokenManager = None #set up by getRESTToken so the token can be refreshed when it expires
+
+        #keep-alive session, so every chunk reuses an open connection instead of a new TCP/TLS handshake
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+        #number of chunks fetched at the same time, and the most requests allowed in flight to one host
+        self.setConcurrency(maxWorkers, perHostLimit)
+
+        #starting chunk size and the bounds it can be tuned between while downloading
+        self.setChunkSizing()
+
+        #how failed requests are retried, and no request rate limit until one is set
+        self.setRetryPolicy()
+        self.setRateLimit(None)
+
+        #no response cache unless one is given with setCache
+        self.cache = None
+
+        #feature queries are sent as JSON, setPBF(True) asks for Protocol Buffers on layers that support it
+        self.setPBF(False)
+        self.noPBFLayers = set()
+
+        #JSON responses are read in one go with the fastest JSON library installed
+        self.setJSONDecoding()
+
+        #layer metadata (fields, maxRecordCount, capabilities) only needs to be read once per layer
+        self.layerInfo = {}
+        self.layerInfoLock = threading.Lock()
 
         self.userAgent = 'my-app/0.0.1'
         
@@ -35,6 +568,292 @@ class RESTConnector():
         print("Custom Headers Added...")
 
     
+    def setConcurrency(self, maxWorkers, perHostLimit = None):
+        """sets how many chunks are downloaded at once, perHostLimit caps the requests sent to a single server"""
+
+        #1 worker keeps the old behaviour of one request at a time
+        self.maxWorkers = max(1, int(maxWorkers))
+
+        if perHostLimit is None:
+            perHostLimit = self.maxWorkers
+        self.perHostLimit = max(1, int(perHostLimit))
+
+        #size the connection pool so no connection gets thrown away after a request, mapChunks runs inside mapChunks
+        #(tiles at maxDepth download by object ID) and a streamed body holds its connection after the host slot is
+        #given back, so there can be a connection in use for every worker of every inner pool
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(self.perHostLimit, self.maxWorkers * self.maxWorkers))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def setRetryPolicy(self, retryPolicy=None, requestTimeout=120):
+        """sets the RetryPolicy for failed requests (None for the default one) and the seconds to wait on a response"""
+        self.retryPolicy = retryPolicy or RetryPolicy()
+        self.requestTimeout = requestTimeout
+
+    def setRateLimit(self, requestsPerSecond, burst=None):
+        """limits the requests per second sent to each host, shared by every connector on that host, None turns it off"""
+        self.requestsPerSecond = requestsPerSecond
+        self.rateBurst = burst
+
+    def setJSONDecoding(self, backend='auto', incremental=False):
+        """sets the JSON library for query responses ('auto', 'orjson', 'ujson' or 'json'), incremental reads the
+        features of a chunk as they arrive instead of holding the whole body first"""
+        self.jsonBackend = esrijson.getBackend(backend)
+        self.incrementalJSON = incremental
+
+    def setPBF(self, usePBF=True):
+        """turns requesting f=pbf for feature queries on or off, it is only used on layers that list PBF as a query format.
+        The responses are about a sixth of the size of JSON but are decoded in Python, so it only pays off on a slow connection"""
+        self.usePBF = usePBF
+
+    def supportsPBF(self, URL, useCustomHeaders=False):
+        """checks the layer metadata to see if the layer can answer queries with f=pbf"""
+        if getLayerURL(URL) in self.noPBFLayers:
+            return False
+
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+
+        if not layerInfo:
+            return False
+
+        return "pbf" in str(layerInfo.get('supportedQueryFormats', '')).lower()
+
+    def supportsCentroid(self, URL, useCustomHeaders=False):
+        """checks the layer metadata to see if the server can send polygon centroids (returnCentroid)"""
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+
+        if not layerInfo or layerInfo.get('geometryType') != 'esriGeometryPolygon':
+            return False
+
+        advancedCapabilities = layerInfo.get('advancedQueryCapabilities') or {}
+        return bool(advancedCapabilities.get('supportsReturningGeometryCentroid', False))
+
+    def setCache(self, cache):
+        """turns on response caching with a restcache.ResponseCache (or anything with the same methods), None turns it off"""
+        self.cache = cache
+
+    def close(self):
+        """closes the pooled connections, the connector can also be used in a with statement"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def setChunkSizing(self, chunkSize=300, minChunkSize=25, maxChunkSize=2000, targetSeconds=2.0, maxChunkBytes=8*1024*1024):
+        """sets the starting chunk size and the bounds it can be tuned between, it is also capped by each layer's maxRecordCount"""
+        self.chunkSizing = {'chunkSize': chunkSize,
+                            'minChunkSize': minChunkSize,
+                            'maxChunkSize': maxChunkSize,
+                            'targetSeconds': targetSeconds,
+                            'maxChunkBytes': maxChunkBytes}
+
+    def createChunkSizer(self, URL, useCustomHeaders=False, chunkSize=None):
+        """returns a new ChunkSizer for a layer using the connector's settings and the layer's maxRecordCount"""
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+
+        maxRecordCount = None
+        if layerInfo:
+            maxRecordCount = layerInfo.get('maxRecordCount')
+
+        chunkSizing = dict(self.chunkSizing)
+        if chunkSize:
+            chunkSizing['chunkSize'] = chunkSize
+
+        return ChunkSizer(maxRecordCount=maxRecordCount, **chunkSizing)
+
+    def getObjectIdField(self, URL, useCustomHeaders=False):
+        """returns the name of the layer's object ID field, falling back to OBJECTID"""
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+
+        if layerInfo and layerInfo.get('objectIdField'):
+            return layerInfo['objectIdField']
+
+        return 'OBJECTID'
+
+    def iterOIDChunks(self, OIDs, chunkSizer):
+        """breaks a list of object IDs into chunks, asking the sizer for each chunk's size as it goes"""
+        i = 0
+        while i < len(OIDs):
+            chunkSize = chunkSizer.nextSize()
+            yield OIDs[i:i + chunkSize]
+            i += chunkSize
+
+    def mapChunks(self, fetchChunk, chunks, maxWorkers=None):
+        """runs fetchChunk over every chunk on a worker pool and yields the results back in chunk (OID) order"""
+
+        #a plan can ask for fewer workers than the connector allows
+        if maxWorkers is None:
+            maxWorkers = self.maxWorkers
+
+        if maxWorkers == 1:
+            for chunk in chunks:
+                yield fetchChunk(chunk)
+            return
+
+        #keep a bounded window of chunks in flight, results are handed back in the order they were submitted
+        window = maxWorkers * 2
+        pending = deque()
+
+        executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(fetchChunk, chunk))
+
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            #if the caller stops early, dont keep downloading chunks nobody will read
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def getHeaders(self, useCustomHeaders=False):
+        """returns the headers for a request, including the custom headers if asked for"""
+        if useCustomHeaders:
+            HEADERS = self.HEADERS.copy()
+            HEADERS.update(self.customHEADERS)
+        else:
+            HEADERS = self.HEADERS
+
+        return HEADERS
+
+    def applyManagedToken(self, PARAMS, HEADERS):
+        """returns copies of the parameters and headers carrying the token manager's current token"""
+        tokenNo = self.tokenManager.getToken()
+
+        if tokenNo != self.tokenNo:
+            self.setToken(tokenNo)
+
+        PARAMS = dict(PARAMS)
+        PARAMS['token'] = tokenNo
+
+        if 'Authorization' in HEADERS:
+            HEADERS = dict(HEADERS)
+            HEADERS['Authorization'] = "Bearer " + tokenNo
+
+        return PARAMS, HEADERS
+
+    def sendRequest(self, URL, HEADERS, PARAMS, method='GET', stream=False):
+        """sends a request to the REST service, waiting for the host's rate and request limits and retrying failures,
+        with stream the body is left on the connection for the caller to read"""
+        rateLimiter = None
+        if self.requestsPerSecond:
+            rateLimiter = getHostRateLimiter(URL, self.requestsPerSecond, self.rateBurst)
+
+        #a fresh cached copy means no request at all, a stale one with an ETag/Last-Modified gets a conditional request
+        useCache = self.cache is not None and method == 'GET'
+        if useCache:
+            cached = self.cache.getFresh(URL, PARAMS)
+            if cached is not None:
+                return cached
+
+            validators = self.cache.getValidators(URL, PARAMS)
+            if validators:
+                HEADERS = dict(HEADERS)
+                HEADERS.update(validators)
+
+            #the cache needs the whole body to store it
+            stream = False
+
+        attempt = 0
+        tokenRefreshed = False
+        while True:
+            #swap in a fresh token if the managed one is about to expire
+            if self.tokenManager and 'token' in PARAMS:
+                PARAMS, HEADERS = self.applyManagedToken(PARAMS, HEADERS)
+
+            if rateLimiter:
+                rateLimiter.acquire()
+
+            r = None
+            error = None
+            with getHostLimiter(URL, self.perHostLimit):
+                try:
+                    if method == 'POST':
+                        r = self.session.post(url = URL, headers = HEADERS, data = PARAMS, timeout = self.requestTimeout, stream = stream)
+                    else:
+                        r = self.session.get(url = URL, headers = HEADERS, params = PARAMS, timeout = self.requestTimeout, stream = stream)
+                except (requests.ConnectionError, requests.Timeout) as ex:
+                    error = ex
+
+            #the token was rejected, get a new one (once) and send the request again straight away
+            if r is not None and self.tokenManager and 'token' in PARAMS and not tokenRefreshed and isTokenError(r):
+                print("Token rejected, refreshing and retrying...")
+                self.tokenManager.refresh(PARAMS['token'])
+                tokenRefreshed = True
+                r.close()
+                continue
+
+            reason = self.retryPolicy.shouldRetry(r, error)
+            if reason is None:
+                if rateLimiter:
+                    rateLimiter.speedUp()
+
+                if useCache:
+                    if r.status_code == 304:
+                        cached = self.cache.revalidated(URL, PARAMS)
+                        if cached is not None:
+                            return cached
+                    elif r.status_code == 200 and getArcGISError(r) is None:
+                        self.cache.store(URL, PARAMS, r)
+
+                return r
+
+            #429 and 503 mean the server wants us to back off
+            if rateLimiter and r is not None:
+                if r.status_code in (429, 503) or (getArcGISError(r) or {}).get("code") in (429, 503):
+                    rateLimiter.slowDown()
+
+            if attempt >= self.retryPolicy.maxRetries:
+                if error is not None:
+                    raise RESTError("Request failed after " + str(attempt + 1) + " tries (" + reason + "): " + str(URL))
+                #hand back the last response, the caller reports what the server said
+                return r
+
+            delay = self.retryPolicy.getDelay(attempt, r)
+            print("Request failed (" + reason + "), retrying in " + str(round(delay, 1)) + " seconds...")
+
+            #give an unread streamed response's connection back before trying again
+            if r is not None:
+                r.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def getLayerInfo(self, URL, useCustomHeaders=False):
+        """returns the layer metadata (fields, geometryType, maxRecordCount, etc), URL can be the layer or its /query endpoint"""
+        layerURL = getLayerURL(URL)
+
+        with self.layerInfoLock:
+            if layerURL in self.layerInfo:
+                return self.layerInfo[layerURL]
+
+        PARAMS = {'f':'json', 
+                'token' : self.tokenNo
+              } 
+
+        r = self.sendRequest(layerURL, self.getHeaders(useCustomHeaders), PARAMS)
+
+        try:
+            data = r.json()
+        except:
+            print("JSON Response Error reading layer info " + str(r) + " - - " + str(r.text))
+            return None
+
+        if "error" in data:
+            print("Error reading layer info -- " + str(data["error"]))
+            return None
+
+        with self.layerInfoLock:
+            self.layerInfo[layerURL] = data
+
+        return data
+
     def create_chunks(self, list_name, n):
         """small function to break a list into chunks, this is used for breaking larger requests up to fall under the cache limit"""
         for i in range(0, len(list_name), n):
@@ -50,46 +869,17 @@ class RESTConnector():
                 'Authorization': "Bearer " + self.tokenNo}
 
 
-    def getRESTToken(self, username, password, tokenURL):
+    def getRESTToken(self, username, password, tokenURL, expiration=60):
         """pass in the credentials for authentication, and should get an ArcGIS token back"""
 
         #First step is to authenticate with REST Service and get a token for future calls
         #this has been modified to take a hosted AGOL service, or a private poral service
 
-        #first check if token is a arcgis style or portal style
-        tokenStyle = "arcgis" #tokenURL = "https://mydomain.net/arcgis/tokens/"
-
-        #this logic could be improved
-        if "/portal/sharing/rest/generateToken" in tokenURL:
-            tokenStyle = "Portal"
-
-        if tokenStyle == "Portal":
-             
-            PARAMS = {'username':username, 
-                    'password':password,
-                    'client' : 'referer', #this is critical for authentication, other ways dont work
-                    'referer': self.baseURL + "/" + "rest",
-                    'f' : 'JSON',
-                    'expiration': 60,} 
-        else:
-            # data to be sent to api 
-            PARAMS = {'username':username, 
-                    'password':password,
-                    'client' : 'requestip', #this is critical for authentication, other ways dont work
-                    'referer': self.baseURL + "/" + "rest",
-                    'format' : 'JSON',
-                    'expiration': 60,} 
- 
-        # sending post request and saving response as response object 
-        r = requests.post(url = tokenURL, data = PARAMS) 
+        #the token manager keeps the credentials so the token is renewed before it expires, even mid download
+        self.tokenManager = TokenManager(username, password, tokenURL, self.baseURL + "/" + "rest",
+                                         self.sendRequest, expiration=expiration)
 
-        #portal returns the token as a dictionary, so we need to extract the string
-        if tokenStyle == "Portal":
-            # extracting response text  
-            tokenNo = r.text.split(':"',1)[1].rsplit('","ex',1)[0]
-        else:
-            # extracting response text  
-            tokenNo = r.text 
+        tokenNo = self.tokenManager.refresh()
         
         print("The token is:%s"%tokenNo)
 
@@ -97,30 +887,26 @@ class RESTConnector():
 
         return tokenNo
 
-    def getOIDsFromService(self, URL, queryText, useCustomHeaders=False, additionalParameters=None):      
-        """returns a list of object IDs from a given Feature Layer URL, this will return results over the 5K limit"""
+    def getObjectIDs(self, URL, queryText, useCustomHeaders=False, additionalParameters=None):      
+        """returns the full sorted list of object IDs matching the query, raises RESTError if the service didnt answer with them"""
         # data to be sent to api - "where 1=1" pulls all features, we want objectIDs only
         PARAMS = {'f':'pjson', 
                 'where':queryText,
                 'outSr' : '4326',
                 'returnIdsOnly':'true',
                 'returnGeometry' : 'false',
-                'orderByFields' : 'OBJECTID ASC',
+                'orderByFields' : self.getObjectIdField(URL, useCustomHeaders) + ' ASC',
                 'token' : self.tokenNo
               } 
 
         #add additional key/values to the parameters if given by user
         if additionalParameters:
-            PARAMS = PARAMS.update(additionalParameters)
+            PARAMS.update(additionalParameters)
        
-        if useCustomHeaders:
-            HEADERS = self.HEADERS.copy()
-            HEADERS.update(self.customHEADERS)
-        else:
-            HEADERS = self.HEADERS
+        HEADERS = self.getHeaders(useCustomHeaders)
            
         #get the objects ids from the REST response
-        r = requests.get(url = URL, headers = HEADERS, params = PARAMS )
+        r = self.sendRequest(URL, HEADERS, PARAMS, method=getRequestMethod(PARAMS))
         # print("respones : " + str(r.text))
         print("Reading OIDs...")
 
@@ -129,9 +915,10 @@ class RESTConnector():
         #
 
         try:
-            data = r.json() #make sure we do the parantheses or its acts a little weird
+            data = esrijson.loads(r.content, self.jsonBackend) #a big layer can send millions of IDs
         except:
             print("JSON Response Error " + str(r) + " - - " + str(r.text))
+            data = None
 
             #def assertJsonSuccess(data):
             #obj = json.loads(data)
@@ -154,276 +941,592 @@ class RESTConnector():
                     print("data with objectIDs, " + str(r) + " - - " + str(r.text) + "--DATA: " + str(data))
             except:
                 print("data with objectIDs, " + str(r) + " - - " + str(r.text) + "--DATA: " + str(data))
-            OIDs = None            
 
+            #a failed request isnt the same as a query that matched nothing
+            raise RESTError("Object ID query failed for " + str(URL) + " where " + str(queryText) + " -- " + str(r.status_code) + " " + str(r.text)[:200])
+
+        #servers send null rather than an empty list when nothing matches
         if OIDs is None:
-            print("No Object Ids Returned...")
-            chunks = None
-        else:
-            print("ObjectIDs Pulled:" + str(len(OIDs)))
-    
-            #set the chunkSize, and break the list into chunks
-            chunkSize = 300 #lets try 300 at a time, maximum is 1000
-            chunks = list(self.create_chunks(OIDs, chunkSize))
+            OIDs = []
+        print("ObjectIDs Pulled:" + str(len(OIDs)))
+
+        #the chunk where clauses rely on the IDs being in order
+        OIDs.sort()
+
+        return OIDs
 
-            print("Number of Chunks:" + str(len(chunks)))
+    def getOIDsFromService(self, URL, queryText, useCustomHeaders=False, additionalParameters=None):      
+        """returns a list of object IDs from a given Feature Layer URL, this will return results over the 5K limit"""
+        OIDs = self.getObjectIDs(URL, queryText, useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters)
+
+        #set the chunkSize from the connector settings and the layer's maxRecordCount, and break the list into chunks
+        chunkSize = self.createChunkSizer(URL, useCustomHeaders).nextSize()
+        chunks = list(self.create_chunks(OIDs, chunkSize))
+
+        print("Number of Chunks:" + str(len(chunks)))
 
         return chunks
 
-    def getFeatures(self,URL, fields, queryText, useCustomHeaders=False, additionalParameters=False):
-        """this will return a list of features from given URL with requested attributes, it uses chunking to break the request into parts"""
+    def supportsPagination(self, URL, useCustomHeaders=False):
+        """checks the layer metadata to see if the layer can page with resultOffset/resultRecordCount"""
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders)
 
-        #get a list of all the features by using the objectIDs which have no limit, then break into chunks
-        chunks = self.getOIDsFromService(URL,queryText, useCustomHeaders=useCustomHeaders)
-                                      
-        #initialize a master list, we will append each querie's features to this
-        featureList = []
+        if not layerInfo:
+            return False
 
-        if chunks is None:
-            print("No features found....")
-            return featureList
+        #newer servers list it under advancedQueryCapabilities, some older ones at the top level
+        advancedCapabilities = layerInfo.get('advancedQueryCapabilities') or {}
+        return bool(advancedCapabilities.get('supportsPagination', layerInfo.get('supportsPagination', False)))
 
-        #now we will iterate through all the chunks
-        for chunk in chunks:
-    
-            #get the OIDs for start and end of each chunk
-            chunkStart = chunk[0]
-            chunkEnd = chunk[len(chunk)-1]
-    
-            print("Chunk Start:" + str(chunkStart) + " - Chunk End:" + str(chunkEnd))
+    def getFeatureCount(self, URL, queryText, useCustomHeaders=False, additionalParameters=None):
+        """returns the number of features matching the query using returnCountOnly, or None if the service didnt answer"""
+        PARAMS = {'f':'json', 
+                'where':queryText,
+                'returnCountOnly' : 'true',
+                'token' : self.tokenNo
+              } 
 
-           
-            # data to be sent to api - constrained by start and end OID for chunk
-            PARAMS = {'f':'json', 
-                    'where':'OBJECTID>=' +str(chunkStart)+ " AND OBJECTID <=" + str(chunkEnd) + " AND " + queryText,
-                    'outSr' : '4326',
-                    'outFields':fields,
-                    'returnGeometry' : 'false',
-                    'token' : self.tokenNo
-                  } 
+        #add additional key/values to the parameters if given by user
+        if additionalParameters:
+            PARAMS.update(additionalParameters)
 
-            #add additional key/values to the parameters if given by user
-            if additionalParameters:
-                PARAMS = PARAMS.update(additionalParameters)
+        r = self.sendRequest(URL, self.getHeaders(useCustomHeaders), PARAMS, method=getRequestMethod(PARAMS))
+
+        try:
+            return int(r.json()['count'])
+        except Exception as ex:
+            print("Feature count not available -- " + str(ex) + " -- " + str(r.text)[:200])
+            return None
+
+    def getCountAndExtent(self, URL, queryText, useCustomHeaders=False, additionalParameters=None):
+        """returns (count, extent) for the query in one request, the extent is None if the service wont give it"""
+        PARAMS = {'f':'json', 
+                'where':queryText,
+                'returnCountOnly' : 'true',
+                'returnExtentOnly' : 'true',
+                'outSr' : '4326',
+                'token' : self.tokenNo
+              } 
+
+        #add additional key/values to the parameters if given by user
+        if additionalParameters:
+            PARAMS.update(additionalParameters)
 
-            if useCustomHeaders:
-                HEADERS = self.HEADERS.copy()
-                HEADERS.update(self.customHEADERS)
+        r = self.sendRequest(URL, self.getHeaders(useCustomHeaders), PARAMS, method=getRequestMethod(PARAMS))
+
+        try:
+            data = r.json()
+            return int(data['count']), data.get('extent')
+        except:
+            #not every server can do both at once, so just ask for the count
+            return self.getFeatureCount(URL, queryText, useCustomHeaders, additionalParameters), None
+
+    def planQuery(self, URL, queryText, returnGeometry=False, useCustomHeaders=False, additionalParameters=None, largeLayerCount=100000):
+        """probes the layer (count, extent, capabilities, maxRecordCount, geometry type) and picks how to download it"""
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders) or {}
+        advancedCapabilities = layerInfo.get('advancedQueryCapabilities') or {}
+
+        plan = QueryPlan(getLayerURL(URL), queryText)
+        plan.maxRecordCount = layerInfo.get('maxRecordCount')
+        plan.geometryType = layerInfo.get('geometryType')
+        plan.objectIdField = layerInfo.get('objectIdField')
+        plan.supportsPagination = self.supportsPagination(URL, useCustomHeaders)
+        plan.supportsStatistics = bool(advancedCapabilities.get('supportsStatistics', layerInfo.get('supportsStatistics', False)))
+
+        plan.count, plan.extent = self.getCountAndExtent(URL, queryText, useCustomHeaders, additionalParameters)
+
+        #heavy geometry starts at the configured chunk size, attributes and points can start at the largest chunk allowed
+        chunkSizer = self.createChunkSizer(URL, useCustomHeaders)
+        if returnGeometry and plan.geometryType in ('esriGeometryPolygon', 'esriGeometryPolyline', 'esriGeometryMultiPatch'):
+            plan.chunkSize = chunkSizer.nextSize()
+        else:
+            plan.chunkSize = chunkSizer.maxChunkSize
+
+        if plan.count is None:
+            if plan.objectIdField:
+                plan.strategy = 'oids'
+                plan.reason = "the feature count is unknown, so read the object IDs and chunk them"
+            elif plan.supportsPagination:
+                plan.strategy = 'pages'
+                plan.reason = "the feature count is unknown and there are no object IDs, but the layer can page"
             else:
-                HEADERS = self.HEADERS
+                plan.strategy = 'single'
+                plan.reason = "the feature count is unknown and there is no paging or object IDs, only one request is possible (results may be cut off)"
+        elif plan.maxRecordCount is None or plan.count <= min(plan.maxRecordCount, chunkSizer.maxChunkSize):
+            plan.strategy = 'single'
+            plan.reason = "everything fits in one request"
+        elif plan.objectIdField and plan.supportsStatistics and plan.count >= largeLayerCount:
+            plan.strategy = 'oidRanges'
+            plan.reason = "large layer, split the object ID range without downloading every ID"
+        elif plan.supportsPagination:
+            plan.strategy = 'pages'
+            plan.reason = "the layer supports resultOffset paging"
+        elif plan.objectIdField:
+            plan.strategy = 'oids'
+            plan.reason = "no paging, so read the object IDs and chunk them"
+        else:
+            plan.strategy = 'single'
+            plan.reason = "no paging or object IDs, only one request is possible (results may be cut off)"
 
-            #make the request
-            r = requests.get(url = URL, headers = HEADERS, params = PARAMS )
-    
-            #get the data back and convert the JSON response into a dictionary
-            data = r.json() #make sure we do the parantheses or its acts a little weird
-            try:
-                features = data['features']
-            except:
-                print("URL Requested: " + str(URL))
-                print(data)
+        #no point in more workers than there are requests to make
+        if plan.strategy == 'single':
+            plan.estimatedRequests = 1
+        elif plan.count is not None:
+            plan.estimatedRequests = max(1, int(math.ceil(plan.count / float(plan.chunkSize))))
 
-            #loop through all the results in this chunk and append to master list
-            for feature in features:
-                attributes = feature['attributes']
-                featureList.append(attributes)
-         
-        print(str(len(featureList)) + " features pulled from REST Service")
+        plan.concurrency = min(self.maxWorkers, plan.estimatedRequests or self.maxWorkers)
+
+        return plan
+
+    def iterPages(self, count, chunkSizer):
+        """yields (offset, size) pages covering count records, asking the sizer for each page's size as it goes"""
+        offset = 0
+        while offset < count:
+            pageSize = chunkSizer.nextSize()
+            yield (offset, min(pageSize, count - offset))
+            offset += pageSize
+
+    def getOIDStatistics(self, URL, queryText, useCustomHeaders=False, additionalParameters=None):
+        """returns (min OID, max OID, count) for the query using outStatistics, or None if the service cant do statistics"""
+        oidField = self.getObjectIdField(URL, useCustomHeaders)
+
+        statistics = [{'statisticType': 'min', 'onStatisticField': oidField, 'outStatisticFieldName': 'minOID'},
+                      {'statisticType': 'max', 'onStatisticField': oidField, 'outStatisticFieldName': 'maxOID'},
+                      {'statisticType': 'count', 'onStatisticField': oidField, 'outStatisticFieldName': 'countOID'}]
 
-        return featureList
-    
-    def getTableData(self, URL, fields, queryText, useCustomHeaders=False, additionalParameters=False):
-        """sometimes there are no ObjectIDs or geometry, its just table data"""
-        #initialize a master list, we will append each querie's features to this
-        featureList = []
-        
-        # data to be sent to api - constrained by start and end OID for chunk
         PARAMS = {'f':'json', 
-                'where': queryText,           
-                'outFields':fields,
+                'where':queryText,
+                'outStatistics' : json.dumps(statistics),
                 'returnGeometry' : 'false',
                 'token' : self.tokenNo
-                } 
+              } 
 
         #add additional key/values to the parameters if given by user
         if additionalParameters:
-            PARAMS = PARAMS.update(additionalParameters)
+            PARAMS.update(additionalParameters)
 
-        if useCustomHeaders:
-            HEADERS = self.HEADERS.copy()
-            HEADERS.update(self.customHEADERS)
-        else:
-            HEADERS = self.HEADERS
+        r = self.sendRequest(URL, self.getHeaders(useCustomHeaders), PARAMS, method=getRequestMethod(PARAMS))
+        print("Reading OID statistics...")
 
-        #make the request
-        r = requests.get(url = URL, headers = HEADERS, params = PARAMS )
-    
-        #get the data back and convert the JSON response into a dictionary
-        data = r.json() #make sure we do the parantheses or its acts a little weird
-        features = data['features']
+        try:
+            #some servers change the case of the statistic names
+            attributes = r.json()['features'][0]['attributes']
+            attributes = dict((key.lower(), value) for key, value in attributes.items())
 
-        #loop through all the results in this chunk and append to master list
-        for feature in features:
-            attributes = feature['attributes']
-            featureList.append(attributes)
-         
-        print(str(len(featureList)) + " features pulled from ROK")
+            count = int(attributes['countoid'] or 0)
+            if count == 0:
+                return (0, -1, 0)
 
-        return featureList
+            return (int(attributes['minoid']), int(attributes['maxoid']), count)
+        except Exception as ex:
+            print("OID statistics not available -- " + str(ex) + " -- " + str(r.text)[:200])
+            return None
 
-    def getFeaturesWithGeometry(self,URL, fields, queryText, useCustomHeaders=False, additionalParameters=None):
-        """returns the feature Geometry along with the raw data results given a Feature Layer URL"""
+    def iterOIDRanges(self, minOID, maxOID, count, chunkSizer):
+        """splits the OID space into ranges expected to hold about one chunk of features each, using the average density"""
+        density = count / float(maxOID - minOID + 1)
 
-         #get a list of all the features by using the objectIDs which have no limit, then break into chunks
-        chunks = self.getOIDsFromService(URL,queryText, useCustomHeaders=useCustomHeaders)
+        start = minOID
+        while start <= maxOID:
+            width = max(1, int(math.ceil(chunkSizer.nextSize() / density)))
+            end = min(maxOID, start + width - 1)
+            yield (start, end)
+            start = end + 1
 
-        #initialize a master list, we will append each querie's features to this
-        featureList = []
-        
-        #now we will iterate through all the chunks
-        for chunk in chunks:
-    
-            #get the OIDs for start and end of each chunk
-            chunkStart = chunk[0]
-            chunkEnd = chunk[len(chunk)-1]
+    def iterSpooledBatches(self, URL, fields, queryText, spool, returnGeometry=False, outFormat='json', useCustomHeaders=False, additionalParameters=None, profile=None):
+        """generator that saves each chunk to a ChunkSpool before yielding the chunks back in OID order, a rerun only fetches what is missing"""
+
+        oidField = self.getObjectIdField(URL, useCustomHeaders)
+
+        #the spool only resumes the exact same job, anything else starts it over
+        signature = [getLayerURL(URL), queryText, fields, returnGeometry, outFormat, additionalParameters, profile.name if profile else None]
+        chunkSize = spool.open(signature, self.createChunkSizer(URL, useCustomHeaders).nextSize())
+
+        #the object ID list decides what is missing, chunks are fixed ranges of it so they line up from run to run
+        OIDs = self.getObjectIDs(URL, queryText, useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters)
+
+        if not OIDs:
+            print("No features found....")
+            return
+
+        def fetchChunk(chunk):
+            print("Chunk Start:" + str(chunk[0]) + " - Chunk End:" + str(chunk[len(chunk)-1]))
+
+            whereText = oidField + '>=' + str(chunk[0]) + " AND " + oidField + " <=" + str(chunk[len(chunk)-1])
+            if queryText != "1=1":
+                whereText = whereText + " AND (" + queryText + ")"
+
+            features = []
+            for batch in self.iterFeatureBatches(URL, fields, whereText, returnGeometry=returnGeometry, outFormat=outFormat,
+                                                 useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters, strategy='single', profile=profile):
+                features.extend(batch)
+
+            spool.addChunk(chunk[0], chunk[len(chunk)-1], features)
+
+            return len(features)
+
+        fetchedCount = sum(self.mapChunks(fetchChunk, spool.iterPendingChunks(OIDs, chunkSize)))
+        print(str(fetchedCount) + " features fetched, " + str(spool.featureCount()) + " in the spool")
+
+        #every chunk is on disk now, hand them back in order
+        for features in spool.iterBatches():
+            yield features
+
+    def iterFeatureBatches(self, URL, fields, queryText, returnGeometry=False, outFormat='json', useCustomHeaders=False, additionalParameters=None, strategy='auto', spool=None, profile=None):
+        """generator that yields the list of features from each chunk as it arrives, only the chunks in flight are held in memory"""
+
+        #strategy 'oids' pulls the full object ID list first and chunks it, 'oidRanges' only asks for the min/max/count
+        #of the object IDs and splits that space into ranges so the download can start straight away, 'pages' uses
+        #resultOffset paging on layers that support it (no object ID list needed at all), 'single' is one request,
+        #and 'auto' lets planQuery pick one of those from a quick probe of the layer
+
+        #profile is an output profile name (see outputProfiles) or an OutputProfile, None is full precision
+        profile = getOutputProfile(profile)
+
+        #with a spool (restspool.ChunkSpool) the chunks are saved to disk as they arrive so an interrupted run can resume
+        if spool is not None:
+            layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+            if layerInfo is None or layerInfo.get('objectIdField'):
+                for features in self.iterSpooledBatches(URL, fields, queryText, spool, returnGeometry, outFormat, useCustomHeaders, additionalParameters, profile):
+                    yield features
+                return
+
+            print("Layer has no object IDs to resume from, downloading without the spool...")
+
+        HEADERS = self.getHeaders(useCustomHeaders)
+        oidField = self.getObjectIdField(URL, useCustomHeaders)
+
+        plan = None
+        if strategy == 'auto':
+            plan = self.planQuery(URL, queryText, returnGeometry=returnGeometry, useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters)
+            print(plan.explain())
+            strategy = plan.strategy
+
+        #centroids can only be swapped in for ESRI JSON geometry, the server sends them itself if the layer supports it
+        centroidOnly = bool(profile and profile.centroidOnly and returnGeometry and outFormat == 'json')
+        supportsCentroid = centroidOnly and self.supportsCentroid(URL, useCustomHeaders)
+
+        #the chunk size starts under the layer's maxRecordCount and is tuned from each response
+        chunkSizer = self.createChunkSizer(URL, useCustomHeaders, chunkSize=plan.chunkSize if plan else None)
+        maxWorkers = plan.concurrency if plan else None
+
+        def runQuery(whereText, pagingParameters=None, allowStream=True):
+            """sends one chunk query, returns the features and whether the server flagged exceededTransferLimit"""
+
+            #the compact Protocol Buffer format is decoded back to the same dictionary as JSON
+            requestFormat = outFormat
+            if outFormat == 'json' and self.usePBF and self.supportsPBF(URL, useCustomHeaders):
+                requestFormat = 'pbf'
+
+            # data to be sent to api
+            PARAMS = {'f':requestFormat, 
+                    'where':whereText,
+                    'outSr' : '4326',
+                    'outFields':fields,
+                    'returnGeometry' : 'true' if returnGeometry else 'false',
+                    'token' : self.tokenNo
+                  } 
+
+            if pagingParameters:
+                PARAMS.update(pagingParameters)
+
+            #the output profile's precision, generalization and centroid settings
+            if profile and returnGeometry:
+                PARAMS.update(profile.getParameters(requestFormat, supportsCentroid))
+
+            #add additional key/values to the parameters if given by user
+            if additionalParameters:
+                PARAMS.update(additionalParameters)
+
+            #make the request, timing it for the chunk sizer
+            requestStart = time.time()
+            stream = allowStream and self.incrementalJSON and PARAMS['f'] != 'pbf'
+            r = self.sendRequest(URL, HEADERS, PARAMS, method=getRequestMethod(PARAMS), stream=stream)
+            bodySize = None
     
+            #a PBF request that came back with a JSON error or couldnt be decoded is sent again as JSON,
+            #and the layer stays on JSON from then on
+            if PARAMS['f'] == 'pbf':
+                try:
+                    if r.content[:1] == b'{':
+                        raise ValueError(r.text[:200])
+                    data = esripbf.decodeFeatureCollection(r.content)
+                    features = data['features']
+                except Exception as ex:
+                    print("PBF query failed (" + str(ex) + "), switching the layer to JSON...")
+                    self.noPBFLayers.add(getLayerURL(URL))
+                    return runQuery(whereText, pagingParameters)
+
+            else:
+                #get the data back and convert the JSON response into a dictionary, a chunk that cant be read
+                #is an error rather than being skipped, otherwise the download would silently be missing features
+                data = None
+                try:
+                    if stream:
+                        #the features are decoded as the body comes in, so the raw body is never held in full
+                        featureStream = esrijson.FeatureStream(r.iter_content(65536))
+                        data = featureStream.readAll()
+                        bodySize = featureStream.byteCount
+                    else:
+                        data = esrijson.loads(r.content, self.jsonBackend)
+                    features = data['features']
+                except esrijson.ServiceError as ex:
+                    #the error wasnt seen before the body was read, so send it again unstreamed where the
+                    #retries and token refresh can deal with it
+                    r.close()
+                    print("Streamed query failed (" + str(ex) + "), sending it again...")
+                    return runQuery(whereText, pagingParameters, allowStream=False)
+                except Exception as ex:
+                    #a streamed body has been read already, so show what was decoded from it
+                    responseText = str(data) if stream else r.text
+                    r.close()
+                    print("Error Reading JSON Data -- " + str(ex) + "-- " +  str(r.status_code) + "--" + str(r.reason) + "--" + responseText[:1000])
+                    print("URL " + str(URL) + " where " + str(whereText))
+                    raise RESTError("Chunk query failed for " + str(URL) + " where " + str(whereText) + " -- " + str(r.status_code) + " " + responseText[:200])
+
+            chunkSizer.record(len(features), time.time() - requestStart, bodySize if bodySize is not None else len(r.content))
+
+            #a centroid profile gives back one point per feature, worked out here if the server couldnt send it
+            if centroidOnly:
+                for feature in features:
+                    centroid = feature.pop('centroid', None)
+                    feature['geometry'] = centroid if centroid is not None else esrigeometry.getCentroid(feature.get('geometry'))
+
+            return features, exceededTransferLimit(data) and len(features) > 0
+
+        def queryRange(chunkStart, chunkEnd):
+            """requests the features with OIDs from chunkStart to chunkEnd, returns the features and whether the server cut them short"""
             print("Chunk Start:" + str(chunkStart) + " - Chunk End:" + str(chunkEnd))
 
-            if queryText == "1=1":  
-                # data to be sent to api - constrained by start and end OID for chunk
-                PARAMS = {'f':'json', 
-                        'where':'OBJECTID>=' +str(chunkStart)+ " AND OBJECTID <=" + str(chunkEnd),
-                        'outSr' : '4326',
-                        'outFields':fields,
-                        'returnGeometry' : 'true',
-                        'returnExtentsOnly' : 'false',
-                        'geometryType' : 'esriGeometryEnvelope',
-                        'returnCountOnly' : 'false',
-                        'token' : self.tokenNo
-                      } 
+            #constrain by start and end OID for chunk, no need to add the query when pulling everything
+            whereText = oidField + '>=' +str(chunkStart)+ " AND " + oidField + " <=" + str(chunkEnd)
+            if queryText != "1=1":
+                whereText = whereText + " AND (" + queryText + ")"
+
+            features, exceeded = runQuery(whereText)
+
+            if exceeded:
+                print("Transfer limit exceeded at " + str(len(features)) + " features, splitting chunk...")
+                chunkSizer.limitTo(len(features))
+
+            return features, exceeded
+
+        def fetchPage(page):
+            offset, pageSize = page
+            print("Page Offset:" + str(offset) + " - Page Size:" + str(pageSize))
+
+            #paging needs a stable order, tables without an object ID keep the server's order
+            pagingParameters = {'resultOffset': offset,
+                                'resultRecordCount': pageSize}
+            if pageOrderField:
+                pagingParameters['orderByFields'] = pageOrderField + ' ASC'
+
+            features, exceeded = runQuery(queryText, pagingParameters)
+
+            #exceededTransferLimit on a page just means there are more pages, a short page means the server capped it
+            if exceeded and 0 < len(features) < pageSize:
+                print("Page cut short at " + str(len(features)) + " features, fetching the rest...")
+                chunkSizer.limitTo(len(features))
+                features.extend(fetchPage((offset + len(features), pageSize - len(features))))
+
+            return features
+
+        def fetchOIDChunk(chunk, splits=0):
+            features, exceeded = queryRange(chunk[0], chunk[len(chunk)-1])
+
+            #the server only sent part of the chunk, so go back for the rest in smaller chunks
+            if exceeded:
+                returnedOIDs = set(getFeatureOID(feature, oidField) for feature in features)
+                remainingOIDs = [OID for OID in chunk if OID not in returnedOIDs]
+
+                #a chunk that gets no smaller, or keeps getting cut short, would be split forever
+                if len(remainingOIDs) == len(chunk) or splits >= maxChunkSplits:
+                    raise RESTError("Transfer limit exceeded on the chunk " + str(chunk[0]) + " to " + str(chunk[len(chunk)-1]) +
+                                    " after " + str(splits) + " splits, it cant be split any further")
+
+                for part in self.create_chunks(remainingOIDs, len(features)):
+                    features.extend(fetchOIDChunk(part, splits + 1))
+
+                features.sort(key=lambda feature: getFeatureOID(feature, oidField))
+
+            return features
+
+        def fetchOIDRange(OIDRange):
+            chunkStart, chunkEnd = OIDRange
+            features, exceeded = queryRange(chunkStart, chunkEnd)
+
+            #this range is denser than average, so split it in half and fetch both halves
+            if exceeded:
+                #one object ID cant hold more than one feature, the server is answering outside the range
+                if chunkStart == chunkEnd:
+                    if len(features) > 1:
+                        raise RESTError("Transfer limit exceeded on the single object ID " + str(chunkStart) + " with " + str(len(features)) + " features")
+                    return features
+
+                middle = (chunkStart + chunkEnd) // 2
+                features = fetchOIDRange((chunkStart, middle)) + fetchOIDRange((middle + 1, chunkEnd))
+
+            return features
+
+        if strategy == 'single':
+            features, exceeded = runQuery(queryText)
+
+            if not exceeded:
+                yield features
+                return
+
+            #the layer grew since the probe, or the count was wrong, tables without object IDs cant be chunked
+            layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+            if layerInfo is None or layerInfo.get('objectIdField'):
+                print("More features than one request can hold, falling back to object ID chunks...")
+                strategy = 'oids'
             else:
-                 ## data to be sent to api - constrained by start and end OID for chunk
-                PARAMS = {'f':'json', 
-                        'where':'OBJECTID>=' +str(chunkStart)+ " AND OBJECTID <=" + str(chunkEnd) + " AND " + queryText,
-                        'outSr' : '4326',
-                        'outFields':fields,
-                        'returnGeometry' : 'true',
-                        'token' : self.tokenNo
-                      } 
+                print("Warning - results were cut off at the server limit of " + str(len(features)) + " records")
+                yield features
+                return
+
+        chunks = None
+        if strategy == 'pages':
+            count = None
+            if plan and plan.strategy == 'pages':
+                count = plan.count
+            elif self.supportsPagination(URL, useCustomHeaders):
+                count = self.getFeatureCount(URL, queryText, useCustomHeaders, additionalParameters)
+
+            if count is None:
+                print("Layer does not support paging, falling back to object ID chunks...")
+            else:
+                print("Paging through " + str(count) + " features")
 
-            #add additional key/values to the parameters if given by user
-            if additionalParameters:
-                PARAMS = PARAMS.update(additionalParameters)
+                layerInfo = self.getLayerInfo(URL, useCustomHeaders) or {}
+                pageOrderField = layerInfo.get('objectIdField')
+
+                #the pages are fetched in parallel, every offset is known once we have the count
+                chunks = self.iterPages(count, chunkSizer)
+                fetchChunk = fetchPage
+
+        if strategy == 'oidRanges':
+            OIDStatistics = self.getOIDStatistics(URL, queryText, useCustomHeaders, additionalParameters)
 
-            if useCustomHeaders:
-                HEADERS = self.HEADERS.copy()
-                HEADERS.update(self.customHEADERS)
+            if OIDStatistics is None:
+                print("Falling back to reading all the object IDs...")
             else:
-                HEADERS = self.HEADERS
+                minOID, maxOID, count = OIDStatistics
+                print("OID range " + str(minOID) + " to " + str(maxOID) + " with " + str(count) + " features")
 
-            #make the request
-            r = requests.get(url = URL, headers = HEADERS, params = PARAMS )
-    
-            try:
-                data = r.json() #make sure we do the parantheses or its acts a little weird
-            except Exception as ex:
-                print("Error Reading JSON Data -- " + str(ex) + "-- " +  str(r.status_code) + "--" + str(r.reason) + "--" + str(r.content) + "--" + r.text)
-                print("URL " + str(URL) + " PARAMs " + str(PARAMS))
-                data = None
+                chunks = self.iterOIDRanges(minOID, maxOID, count, chunkSizer) if count else []
+                fetchChunk = fetchOIDRange
+
+        if chunks is None:
+            #get a list of all the features by using the objectIDs which have no limit, they are chunked as the download goes
+            OIDs = self.getObjectIDs(URL,queryText, useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters)
+
+            if not OIDs:
+                print("No features found....")
+                return
+
+            chunks = self.iterOIDChunks(OIDs, chunkSizer)
+            fetchChunk = fetchOIDChunk
 
+        #now we will fetch all the chunks on the worker pool, they come back in OID order
+        for features in self.mapChunks(fetchChunk, chunks, maxWorkers):
+            yield features
 
-            features = data['features']
-                #loop through all the results in this chunk and append to master list
-            for feature in features:      
+    def iterFeatures(self, URL, fields, queryText, returnGeometry=False, useCustomHeaders=False, additionalParameters=None, strategy='auto', spool=None, profile=None):
+        """generator that yields each feature's attributes (plus a 'geometry' key if returnGeometry) as the chunks arrive"""
+
+        for features in self.iterFeatureBatches(URL, fields, queryText, returnGeometry=returnGeometry, useCustomHeaders=useCustomHeaders,
+                                                additionalParameters=additionalParameters, strategy=strategy, spool=spool, profile=profile):
+            for feature in features:
                 attributes = feature['attributes']
+
                 #for the geometry - attributes is a dictionary with the attribute data, we will add a new key/value with the geometry
-                attributes.update({'geometry' : feature['geometry']})
-     
-                featureList.append(attributes)
+                if returnGeometry:
+                    attributes['geometry'] = feature.get('geometry')
+
+                yield attributes
 
+    def iterFeaturesAsGeoJSON(self, URL, fields, queryText, useCustomHeaders=False, additionalParameters=None, strategy='auto', spool=None, profile=None):
+        """generator that yields geoJSON features straight from the service as the chunks arrive"""
+
+        #the server's geoJSON has no centroids, so a centroid profile gets ESRI JSON and converts it here
+        if getOutputProfile(profile) and getOutputProfile(profile).centroidOnly:
+            for features in self.iterFeatureBatches(URL, fields, queryText, returnGeometry=True, useCustomHeaders=useCustomHeaders,
+                                                    additionalParameters=additionalParameters, strategy=strategy, spool=spool, profile=profile):
+                featuresWithGeometry = [dict(feature['attributes'], geometry=feature.get('geometry')) for feature in features]
+                for feature in (self.convertESRIGeometry(featuresWithGeometry) or {"features": []})["features"]:
+                    yield feature
+            return
+
+        for features in self.iterFeatureBatches(URL, fields, queryText, returnGeometry=True, outFormat='geojson', useCustomHeaders=useCustomHeaders,
+                                                additionalParameters=additionalParameters, strategy=strategy, spool=spool, profile=profile):
+            for feature in features:
+                yield feature
+
+    def getFeatures(self,URL, fields, queryText, useCustomHeaders=False, additionalParameters=False):
+        """this will return a list of features from given URL with requested attributes, it uses chunking to break the request into parts"""
+
+        featureList = list(self.iterFeatures(URL, fields, queryText, useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters))
+         
         print(str(len(featureList)) + " features pulled from REST Service")
 
         return featureList
+    
+    def getTableData(self, URL, fields, queryText, useCustomHeaders=False, additionalParameters=False):
+        """sometimes there are no ObjectIDs or geometry, its just table data"""
 
-    def getFeaturesAsGeoJSON(self,URL, fields, queryText, useCustomHeaders=False,additionalParameters=None):
-        """return a geoJSON results from Feature Layer URL with requested attributes"""
+        #the planner pages through tables that support it so nothing is lost past the server's record limit,
+        #small tables and tables that cant page are pulled in a single request
+        featureList = list(self.iterFeatures(URL, fields, queryText, useCustomHeaders=useCustomHeaders,
+                                             additionalParameters=additionalParameters))
+         
+        print(str(len(featureList)) + " features pulled from ROK")
 
-        #initialize the starter file, just set to None for now
-        geoJSON = None
-        print("Custom Headers: " + str(useCustomHeaders))
+        return featureList
 
-        #get a list of all the features by using the objectIDs which have no limit, then break into chunks
-        chunks = self.getOIDsFromService(URL,queryText, useCustomHeaders=useCustomHeaders)
+    def getFeaturesWithGeometry(self,URL, fields, queryText, useCustomHeaders=False, additionalParameters=None, profile=None):
+        """returns the feature Geometry along with the raw data results given a Feature Layer URL, profile trims the geometry (see outputProfiles)"""
 
-        if chunks:
+        featureList = list(self.iterFeatures(URL, fields, queryText, returnGeometry=True, useCustomHeaders=useCustomHeaders,
+                                             additionalParameters=additionalParameters, profile=profile))
 
-            #now we will iterate through all the chunks
-            for chunk in chunks:
-    
-                #get the OIDs for start and end of each chunk
-                chunkStart = chunk[0]
-                chunkEnd = chunk[len(chunk)-1]
-    
-                print("Chunk Start:" + str(chunkStart) + " - Chunk End:" + str(chunkEnd))
-              
-    
-                # data to be sent to api - constrained by start and end OID for chunk
-                PARAMS = {'f':'geojson', 
-                        'where':'OBJECTID>=' +str(chunkStart)+ " AND OBJECTID <=" + str(chunkEnd) + " AND " + queryText,
-                        'outSr' : '4326',
-                        'outFields':fields,
-                        'returnGeometry' : 'true',
-                        'token' : self.tokenNo
-                      } 
+        print(str(len(featureList)) + " features pulled from REST Service")
 
-                #add additional key/values to the parameters if given by user
-                if additionalParameters:
-                    PARAMS = PARAMS.update(additionalParameters)
+        return featureList
 
-               
-                if useCustomHeaders:
-                    HEADERS = self.HEADERS.copy()
-                    HEADERS.update(self.customHEADERS)
-                else:
-                    HEADERS = self.HEADERS
+    def getFeatureTable(self, URL, fields, queryText, returnGeometry=False, useCustomHeaders=False, additionalParameters=None, strategy='auto', profile=None):
+        """returns the features as a FeatureTable, a column store filled chunk by chunk that takes far less memory than a list of dictionaries"""
 
-                #make the request
-                r = requests.get(url = URL, headers = HEADERS, params = PARAMS )
-    
-                #get the data back and convert the JSON response into a dictionary
-                try:
-                    data = r.json() #make sure we do the parantheses or its acts a little weird
-                except Exception as ex:
-                    print("Error Reading JSON Data -- " + str(ex) + "-- " +  str(r.status_code) + "--" + str(r.reason) + "--" + str(r.content) + "--" + r.text)
-                    print("URL " + str(URL) + " PARAMs " + str(PARAMS))
-                    data = None
-       
-                #check if this is the first chunk or subsequent part
-                if geoJSON is None:   
-                    geoJSON = data #if this is the first chunk, initialize the geoJSON data
-                    try:
-                        a = str(len(geoJSON["features"]))
-                    except Exception as ex:
-                        print("Error loading reading features -- " + str(ex) + "-- " +  str(r.status_code) + "--" + str(r.reason) + "--" + str(r.content) + "--" + r.text)
-                        print("URL " + str(URL) + " PARAMs " + str(PARAMS))
+        #the columns are typed from the layer's field list, without one they are taken from the first feature
+        layerInfo = self.getLayerInfo(URL, useCustomHeaders)
+        table = featuretable.FeatureTable(featuretable.getTableFields(layerInfo, fields), geometry=returnGeometry)
 
-                else:
-                    #if this is a subsequent chunk, we just add new features -not all the data
-                    try:
-                        featuresToAdd = data["features"] #get the "Features" part of the JSON
-                        for feature in featuresToAdd:
-                            geoJSON["features"].append(feature) #loop through and append new features to the master JSON
-                    except Exception as ex:
-                        print("Error loading reading features -- " + str(ex) + "-- " +  r.text + " -- " + str(r.status_code) + "--" + str(r.reason) + "--" + str(r.content))
+        for features in self.iterFeatureBatches(URL, fields, queryText, returnGeometry=returnGeometry, useCustomHeaders=useCustomHeaders,
+                                                additionalParameters=additionalParameters, strategy=strategy, profile=profile):
+            table.append(features)
 
+        print(str(len(table)) + " features pulled from REST Service")
 
+        return table
 
-            try:
-                print(str(len(geoJSON["features"])) + " geojson features pulled from REST Service")
-            except:
-                print("Bad or No geoJson returned")
+    def getFeaturesAsGeoJSON(self,URL, fields, queryText, useCustomHeaders=False,additionalParameters=None, spool=None, profile=None):
+        """return a geoJSON results from Feature Layer URL with requested attributes, a ChunkSpool makes the download resumable
+        and profile trims the geometry (see outputProfiles)"""
+
+        print("Custom Headers: " + str(useCustomHeaders))
+
+        features = list(self.iterFeaturesAsGeoJSON(URL, fields, queryText, useCustomHeaders=useCustomHeaders, additionalParameters=additionalParameters,
+                                                   spool=spool, profile=profile))
+
+        if not features:
+            print("Bad or No geoJson returned")
+            return None
+
+        geoJSON = {"type" : "FeatureCollection",
+                   "features": features}
+
+        print(str(len(geoJSON["features"])) + " geojson features pulled from REST Service")
 
-       # print("geojson pulled from REST Service")
         return geoJSON
 
     def getTestQueryResponse(self, URL, queryText, fields):
@@ -435,23 +1538,23 @@ class RESTConnector():
                 'outSr' : '4326',           
                 'returnGeometry' : 'false',
                 'outFields':fields,
-                'orderByFields' : 'OBJECTID ASC',
+                'orderByFields' : self.getObjectIdField(URL) + ' ASC',
                 'token' : self.tokenNo
               } 
         
         #get the objects ids from the REST response
-        r = requests.get(url = URL, headers = self.HEADERS, params = PARAMS )
+        r = self.sendRequest(URL, self.HEADERS, PARAMS)
         print("response : " + str(r.text))    
         try:
             data = r.json() #make sure we do the parantheses or its acts a little weird
         except:
             print("JSON Response Error " + str(r) + " - - " + str(r.text))
 
-    def getFeaturesFromServiceByGeometry(self,URL, queryText, geometryToUse, geometryType, spatialQueryType, fields, useCustomHeaders=False, additionalParameters=None):
-        """This will do a spatial query on the REST service using ESRI geometry and relationship (e.g. inside a polygon)"""
-       
-        #initialize a master list, we will append each querie's features to this
-        featureList = []
+    def getFeaturesFromServiceByGeometry(self,URL, queryText, geometryToUse, geometryType, spatialQueryType, fields, useCustomHeaders=False, additionalParameters=None,
+                                         returnGeometry=False, maxDepth=8):
+        """This will do a spatial query on the REST service using ESRI geometry and relationship (e.g. inside a polygon),
+        big areas are split into tiles so the server's record limit doesnt cut the results short"""
+
         #for geometry type, see http://resources.esri.com/help/9.3/arcgisengine/ArcObjects/esriGeometry/esriGeometryType.htm
 
         #geometry types can be esriGeometryPoint,esriGeometryLine,esriGeometryPolygon,esriGeometryPolyline
@@ -459,44 +1562,145 @@ class RESTConnector():
 
         #esriSpatialRelIntersects | esriSpatialRelContains | esriSpatialRelCrosses | esriSpatialRelEnvelopeIntersects | esriSpatialRelIndexIntersects | esriSpatialRelOverlaps | esriSpatialRelTouches | esriSpatialRelWithin
 
-        # data to be sent to api - "where 1=1" pulls all features, we want objectIDs only
-        PARAMS = {'f':'json', 
-                'where': queryText, #queryText,
-                'geometryType': geometryType, #geometryType,
-                'inSR': '4326',
-                'geometry' : geometryToUse,            
-                'spatialRel' : spatialQueryType, #queryType
-                'outSr' : '4326',
-                'outFields':fields,
-                'returnGeometry' : 'false',
-                'orderByFields' : 'OBJECTID ASC',
-                'token' : self.tokenNo
-              } 
-    
-        #add additional key/values to the parameters if given by user
-        if additionalParameters:
-            PARAMS = PARAMS.update(additionalParameters)
+        #envelopes and polygons with an intersects relationship are split into an adaptive quadtree: each tile is queried
+        #on its own (in parallel), a tile the server cuts short is split into four, and features that cross tiles are
+        #only kept once. Tiles still cut short at maxDepth, and every other query, are downloaded by object ID instead
 
-        if useCustomHeaders:
-                HEADERS = self.HEADERS.copy()
-                HEADERS.update(self.customHEADERS)
-        else:
-            HEADERS = self.HEADERS
+        geometry = parseQueryGeometry(geometryToUse)
+        oidField = self.getObjectIdField(URL, useCustomHeaders)
+        HEADERS = self.getHeaders(useCustomHeaders)
 
-        #get the objects ids from the REST response
-        r = requests.get(url = URL, headers = HEADERS, params = PARAMS )
-        data = r.json() #make sure we do the parantheses or its acts a little weird   
-        print(r.json())
-        try:
-            features = data['features']
-        except:
+        def getSpatialParameters(queryGeometry, queryGeometryType):
+            #the geometry goes in as JSON unless it was given as text we couldnt read
+            spatialParameters = {'geometryType': queryGeometryType,
+                                 'inSR': '4326',
+                                 'geometry': json.dumps(queryGeometry) if queryGeometry is not None else geometryToUse,
+                                 'spatialRel': spatialQueryType}
+
+            #add additional key/values to the parameters if given by user
+            if additionalParameters:
+                spatialParameters.update(additionalParameters)
+
+            return spatialParameters
+
+        def fetchByObjectID(queryGeometry, queryGeometryType, withGeometry=returnGeometry):
             features = []
-        #    print("Error - no features " + str(r) + " - - " + str(r.text))
-    
+            for batch in self.iterFeatureBatches(URL, fields, queryText, returnGeometry=withGeometry, useCustomHeaders=useCustomHeaders,
+                                                 additionalParameters=getSpatialParameters(queryGeometry, queryGeometryType)):
+                features.extend(batch)
+            return features
+
+        envelope = esrigeometry.getEnvelope(geometry) if geometry else None
+        isEnvelope = bool(geometry) and 'xmin' in geometry
+        canTile = envelope is not None and spatialQueryType in tileSpatialRelations and (isEnvelope or 'rings' in geometry)
+
+        if not canTile:
+            print("Spatial query can't be split into tiles, downloading by object ID...")
+            features = fetchByObjectID(geometry, geometryType)
+
+        else:
+            layerInfo = self.getLayerInfo(URL, useCustomHeaders) or {}
+            maxRecordCount = layerInfo.get('maxRecordCount')
+            spatialReference = geometry.get('spatialReference') or {'wkid': 4326}
+
+            #start deep enough that the average tile fits in one response, so a dense area isnt fetched and thrown away level by level
+            startDepth = 0
+            count = self.getFeatureCount(URL, queryText, useCustomHeaders, getSpatialParameters(geometry, 'esriGeometryEnvelope' if isEnvelope else 'esriGeometryPolygon'))
+            if count and maxRecordCount:
+                while startDepth < maxDepth and count > maxRecordCount * 4 ** startDepth:
+                    startDepth += 1
+
+            #clipping a concave polygon to a tile can leave zero width edges along the tile's border, which select features
+            #outside the polygon, so the features of a polygon's tiles are checked against the whole polygon
+            refine = not isEnvelope and spatialQueryType == 'esriSpatialRelIntersects'
+
+            def refineFeatures(features):
+                if not refine:
+                    return features
+                return [feature for feature in features if spatialindex.geometriesIntersect(feature.get('geometry'), geometry)]
+
+            def fetchTile(tile):
+                """queries one tile, returns its features and whether it needs splitting"""
+                tileEnvelope, depth = tile
+
+                if isEnvelope:
+                    tileGeometry = dict(zip(('xmin', 'ymin', 'xmax', 'ymax'), tileEnvelope), spatialReference=spatialReference)
+                    tileGeometryType = 'esriGeometryEnvelope'
+                else:
+                    #the part of the polygon inside the tile, a tile outside the polygon needs no request at all
+                    tileGeometry = esrigeometry.clipPolygon(geometry, tileEnvelope)
+                    tileGeometryType = 'esriGeometryPolygon'
+                    if tileGeometry is None:
+                        return [], False
+                    tileGeometry['spatialReference'] = spatialReference
+
+                #the smallest tiles are downloaded by object ID rather than split again
+                if depth >= maxDepth:
+                    return refineFeatures(fetchByObjectID(tileGeometry, tileGeometryType, returnGeometry or refine)), False
+
+                PARAMS = {'f':'json', 
+                        'where': queryText,
+                        'outSr' : '4326',
+                        'outFields':fields,
+                        'returnGeometry' : 'true' if returnGeometry or refine else 'false',
+                        'orderByFields' : oidField + ' ASC',
+                        'token' : self.tokenNo
+                      } 
+                PARAMS.update(getSpatialParameters(tileGeometry, tileGeometryType))
+
+                #a long polygon wont fit in a URL
+                r = self.sendRequest(URL, HEADERS, PARAMS, method=getRequestMethod(PARAMS))
+
+                try:
+                    data = esrijson.loads(r.content, self.jsonBackend)
+                    features = data['features']
+                except Exception as ex:
+                    print("Error Reading JSON Data -- " + str(ex) + "-- " +  str(r.status_code) + "--" + str(r.reason) + "--" + r.text[:1000])
+                    raise RESTError("Tile query failed for " + str(URL) + " in " + str(tileEnvelope) + " -- " + str(r.status_code) + " " + r.text[:200])
+
+                #some servers stop at maxRecordCount without setting exceededTransferLimit
+                exceeded = exceededTransferLimit(data) or bool(maxRecordCount and len(features) >= maxRecordCount)
+                return refineFeatures(features), exceeded
+
+            tiles = [(envelope, 0)]
+            for depth in range(startDepth):
+                tiles = [(quadrant, depth + 1) for tile in tiles for quadrant in splitEnvelope(tile[0])]
+
+            #features that cross a tile edge come back from each tile they touch, they are kept once by object ID
+            featuresByOID = {}
+            unidentified = []
+            tileCount = 0
+
+            #each level of tiles is fetched in parallel, the ones that were cut short make up the next level
+            while tiles:
+                print("Querying " + str(len(tiles)) + " tiles at depth " + str(tiles[0][1]))
+                nextTiles = []
+
+                for tile, (features, exceeded) in zip(tiles, self.mapChunks(fetchTile, tiles)):
+                    tileCount += 1
+
+                    if exceeded:
+                        nextTiles.extend((quadrant, tile[1] + 1) for quadrant in splitEnvelope(tile[0]))
+                        continue
 
-        #loop through all the results in this query and append to master list
+                    for feature in features:
+                        OID = getFeatureOID(feature, oidField)
+                        if OID is None:
+                            unidentified.append(feature)
+                        else:
+                            featuresByOID.setdefault(OID, feature)
+
+                tiles = nextTiles
+
+            print(str(tileCount) + " tiles queried")
+            features = [featuresByOID[OID] for OID in sorted(featuresByOID)] + unidentified
+
+        #hand back the attributes, with the geometry alongside them if it was asked for
+        featureList = []
         for feature in features:
-            attributes = feature['attributes']          
+            attributes = feature['attributes']
+            if returnGeometry:
+                attributes['geometry'] = feature.get('geometry')
             featureList.append(attributes)
 
         print(str(len(featureList)) + " features pulled from REST Service")
@@ -504,79 +1708,24 @@ class RESTConnector():
         return featureList
  
     def convertESRIGeometry(self, featureList):
-        """This will take a list of returned features with geometry and try to convert to a different format"""
-
-        #default the geometrytype to something that will catch attention if an error
-        geometryType = "unk"
+        """This will take a list of returned features with geometry and convert them to a geoJSON FeatureCollection"""
 
-        
-        #get the first feature in the list as an example
-        try:
-            firstFeature = featureList[0]
-            geo = firstFeature["geometry"]
-        except:
-            print("no geometry found, unable to convert")
+        if not featureList:
+            print("no features found, unable to convert")
             return None
 
-        #check the geometry type first, try to guess point/line/poly
-        try:
-            x = geo["x"]
-            geometryType = "Point"        
-        
-        except:
-            print("No X coordinate - probably not a point, attempting line conversion...")
-
-            #now lets check if a line
-            try:              
-                paths = geo["paths"][0]      
-                geometryType = "LineString" #paths has an extra list
-
-            except:
-                print("No line path - probably not a line either, attempting polygon conversion...")
-
-                #last shot - see if its a polygon
-                try:
-                    rings = geo["rings"]     
-                    geometryType = "Polygon" #paths has an extra list
-
-                except:
-                    print("Error getting rings - not a polygon either")
+        #each feature's geometry is converted on its own type, so a layer with mixed or empty geometry still comes out right
+        geometries = esrigeometry.toGeoJSONGeometries([feature.get("geometry") for feature in featureList])
 
         #set up the base structure for a geoJSON file
         geoJSONFile = {"type" : "FeatureCollection",
                        "features": []}
 
         #go through all the ESRI feature and add them to the geoJSON
-        for feature in featureList:
-
-            #set the geometry type based on the logic from above
-            geometryInGeoJSON = {"type" : geometryType}
-
-            if geometryType == "Point":
-                #encode the lat long from ESRI JSON to geoJSON
-                geometryInGeoJSON["coordinates"] = [feature["geometry"]["x"], feature["geometry"]["y"]]
+        for feature, geometryInGeoJSON in zip(featureList, geometries):
 
-            if geometryType == "LineString":
-             #   features['geometry']['paths'] #returns a list
-
-                try:
-                    geometryInGeoJSON["coordinates"] = feature["geometry"]["paths"][0]
-                except: # if it fails, but some dummy coordinates in
-                    geometryInGeoJSON["coordinates"] = [[102.0, 0.0], [103.0, 1.0]]
-                    print("Null geometry encountered")
-
-            if geometryType == "Polygon":           
-
-                try:
-                    geometryInGeoJSON["coordinates"] = feature["geometry"]["rings"]
-                except: #if it fails, but some dummy coordinates in
-                    geometryInGeoJSON["coordinates"] = [[100.0, 0.0], [101.0, 0.0], [101.0, 1.0],[100.0, 1.0], [100.0, 0.0]]
-                    print("Null geometry encountered")
-   
-            #the attribute data is really just our feature data, so set it as a varible
-            propertiesInGeoJSON = feature
-            #remove the ESRI geometry, no longer needed
-            del propertiesInGeoJSON["geometry"]
+            #the attribute data is really just our feature data, leaving out the ESRI geometry (the caller's dictionary is left alone)
+            propertiesInGeoJSON = {key: value for key, value in feature.items() if key != "geometry"}
 
             #finalize the geoJSON format
             featureInGeoJSON = {"type" : "Feature", 
@@ -587,5 +1736,3 @@ class RESTConnector():
             geoJSONFile["features"].append(featureInGeoJSON)
 
         return geoJSONFile
-
-
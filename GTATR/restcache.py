@@ -0,0 +1,195 @@
+import sqlite3 #the cache is a single sqlite file
+import hashlib
+import json
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+#This module is an optional on-disk cache for GTATR query responses. Hand one to
+#RESTConnector.setCache and repeated runs will read OID lists and chunks from disk
+#instead of the server. Entries are keyed by the URL and the request parameters
+#(the token is left out, it changes every run), expire after a time to live that
+#can be set per layer, and the least recently used entries are dropped once the
+#cache grows past its size limit. Stale entries that came with an ETag or
+#Last-Modified header are revalidated with a conditional request.
+
+class ResponseCache():
+
+    def __init__(self, path, defaultTTL=86400, maxBytes=1024*1024*1024):
+        """opens (or creates) the cache file, defaultTTL is in seconds and maxBytes caps the total size of the stored responses"""
+        self.path = path
+        self.defaultTTL = defaultTTL
+        self.maxBytes = maxBytes
+
+        #per layer time to live, the longest matching URL prefix wins
+        self.layerTTLs = {}
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                            key TEXT PRIMARY KEY,
+                            url TEXT,
+                            body BLOB,
+                            contentType TEXT,
+                            etag TEXT,
+                            lastModified TEXT,
+                            stored REAL,
+                            accessed REAL,
+                            size INTEGER)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responsesAccessed ON responses (accessed)")
+        self.db.commit()
+
+        #the size limit may have been lowered since the cache was last opened
+        self.totalBytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.evict()
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def setTTL(self, layerURL, seconds):
+        """sets the time to live for everything under a layer (or service) URL, 0 turns caching off for it"""
+        self.layerTTLs[layerURL.split("?")[0].rstrip("/")] = seconds
+
+    def getTTL(self, URL):
+        """returns the time to live for a URL"""
+        bestMatch = None
+        for prefix in self.layerTTLs:
+            if URL.startswith(prefix) and (bestMatch is None or len(prefix) > len(bestMatch)):
+                bestMatch = prefix
+
+        if bestMatch is None:
+            return self.defaultTTL
+        return self.layerTTLs[bestMatch]
+
+    def makeKey(self, URL, PARAMS):
+        """builds the cache key from the URL and the parameters, leaving the token out"""
+        parameters = sorted((str(key), str(value).strip()) for key, value in (PARAMS or {}).items() if str(key).lower() != 'token')
+        keyText = URL.split("?")[0].rstrip("/") + "?" + json.dumps(parameters)
+
+        return hashlib.sha256(keyText.encode("utf-8")).hexdigest()
+
+    def makeResponse(self, URL, row):
+        """rebuilds a requests Response from a stored row, so callers cant tell it came from the cache"""
+        body, contentType, etag, lastModified = row
+
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = "OK"
+        r.url = URL
+        r._content = bytes(body)
+        r.encoding = "utf-8"
+        r.headers = CaseInsensitiveDict({'Content-Type': contentType or 'application/json'})
+        if etag:
+            r.headers['ETag'] = etag
+        if lastModified:
+            r.headers['Last-Modified'] = lastModified
+
+        return r
+
+    def getFresh(self, URL, PARAMS):
+        """returns the cached response if there is one that hasnt expired yet, otherwise None"""
+        ttl = self.getTTL(URL)
+        if ttl <= 0:
+            return None
+
+        key = self.makeKey(URL, PARAMS)
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute("SELECT body, contentType, etag, lastModified, stored FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None or now - row[4] > ttl:
+                self.misses += 1
+                return None
+
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+
+        return self.makeResponse(URL, row[:4])
+
+    def getValidators(self, URL, PARAMS):
+        """returns the conditional request headers for a stale entry that can be revalidated, or an empty dictionary"""
+        if self.getTTL(URL) <= 0:
+            return {}
+
+        with self.lock:
+            row = self.db.execute("SELECT etag, lastModified FROM responses WHERE key = ?", (self.makeKey(URL, PARAMS),)).fetchone()
+
+        validators = {}
+        if row is not None:
+            if row[0]:
+                validators['If-None-Match'] = row[0]
+            if row[1]:
+                validators['If-Modified-Since'] = row[1]
+
+        return validators
+
+    def revalidated(self, URL, PARAMS):
+        """the server answered 304 Not Modified, so the stored response is good for another time to live"""
+        key = self.makeKey(URL, PARAMS)
+        now = time.time()
+
+        with self.lock:
+            self.db.execute("UPDATE responses SET stored = ?, accessed = ? WHERE key = ?", (now, now, key))
+            self.db.commit()
+            row = self.db.execute("SELECT body, contentType, etag, lastModified FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        self.hits += 1
+        return self.makeResponse(URL, row)
+
+    def store(self, URL, PARAMS, r):
+        """saves a successful response, then evicts the least recently used entries if the cache is over its size"""
+        if self.getTTL(URL) <= 0:
+            return
+
+        body = r.content
+        if len(body) > self.maxBytes:
+            return #would push everything else out
+
+        key = self.makeKey(URL, PARAMS)
+        now = time.time()
+
+        with self.lock:
+            oldSize = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if oldSize is not None:
+                self.totalBytes -= oldSize[0]
+
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (key, URL.split("?")[0], sqlite3.Binary(body), r.headers.get('Content-Type'),
+                             r.headers.get('ETag'), r.headers.get('Last-Modified'), now, now, len(body)))
+            self.totalBytes += len(body)
+
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """drops the least recently used responses until the cache is back under its size limit, call with the lock held"""
+        while self.totalBytes > self.maxBytes:
+            row = self.db.execute("SELECT key, size FROM responses ORDER BY accessed ASC LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self.totalBytes -= row[1]
+
+    def clear(self, layerURL=None):
+        """removes every cached response, or just the ones under a layer URL"""
+        with self.lock:
+            if layerURL is None:
+                self.db.execute("DELETE FROM responses")
+            else:
+                self.db.execute("DELETE FROM responses WHERE url LIKE ?", (layerURL.split("?")[0].rstrip("/") + "%",))
+            self.db.commit()
+
+            self.totalBytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        """closes the cache file"""
+        with self.lock:
+            self.db.close()
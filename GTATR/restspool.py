@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from bisect import bisect_right
+
+#This module lets a long GTATR download pick up where it left off. Hand a ChunkSpool
+#to RESTConnector.iterFeatureBatches and every chunk that comes back is written to
+#the spool directory and recorded in a manifest with its object ID range, feature
+#count and checksum. If the run dies, running the same job again only fetches the
+#object IDs that arent inside a finished range, then the output is assembled from
+#the chunk files in object ID order.
+
+class ChunkSpool():
+
+    def __init__(self, spoolDir):
+        """opens (or creates) a spool directory, the manifest from an earlier run is read back if there is one"""
+        self.spoolDir = spoolDir
+        self.manifestPath = os.path.join(spoolDir, "manifest.json")
+        self.lock = threading.Lock()
+
+        os.makedirs(spoolDir, exist_ok=True)
+
+        self.manifest = {"signature": None, "chunkSize": None, "chunks": []}
+        if os.path.exists(self.manifestPath):
+            try:
+                with open(self.manifestPath) as manifestFile:
+                    self.manifest = json.load(manifestFile)
+            except ValueError:
+                print("Spool manifest in " + spoolDir + " can't be read, starting over")
+
+    def open(self, signature, chunkSize):
+        """starts or resumes a job, a spool left behind by a different job is cleared first, returns the chunk size to use"""
+        if self.manifest["signature"] != signature:
+            self.clear()
+            self.manifest = {"signature": signature, "chunkSize": chunkSize, "chunks": []}
+            self.save()
+            return chunkSize
+
+        #chunk files that went missing or were cut short get fetched again
+        goodChunks = []
+        for chunk in self.manifest["chunks"]:
+            chunkPath = os.path.join(self.spoolDir, chunk["file"])
+            if os.path.exists(chunkPath) and os.path.getsize(chunkPath) == chunk["bytes"]:
+                goodChunks.append(chunk)
+
+        with self.lock:
+            self.manifest["chunks"] = goodChunks
+            self.save()
+
+        print("Resuming from spool with " + str(len(goodChunks)) + " chunks (" + str(self.featureCount()) + " features) already saved")
+
+        #keep the chunk size of the first run so the manifest stays consistent
+        return self.manifest["chunkSize"] or chunkSize
+
+    def save(self):
+        """writes the manifest, through a temporary file so a crash never leaves half a manifest"""
+        tempPath = self.manifestPath + ".tmp"
+        with open(tempPath, 'w') as manifestFile:
+            json.dump(self.manifest, manifestFile)
+        os.replace(tempPath, self.manifestPath)
+
+    def featureCount(self):
+        """returns the number of features saved in the spool"""
+        return sum(chunk["count"] for chunk in self.manifest["chunks"])
+
+    def iterPendingChunks(self, OIDs, chunkSize):
+        """breaks the sorted object IDs that arent in a finished range into chunks, a chunk never spans a finished range"""
+        ranges = sorted((chunk["start"], chunk["end"]) for chunk in self.manifest["chunks"])
+        rangeStarts = [start for start, end in ranges]
+
+        chunk = []
+        chunkGap = None
+        for OID in OIDs:
+            #the finished ranges dont overlap, so the number of them starting at or before OID says which gap it is in
+            gap = bisect_right(rangeStarts, OID)
+            if gap and OID <= ranges[gap - 1][1]:
+                continue #already saved
+
+            if chunk and (gap != chunkGap or len(chunk) >= chunkSize):
+                yield chunk
+                chunk = []
+
+            chunk.append(OID)
+            chunkGap = gap
+
+        if chunk:
+            yield chunk
+
+    def addChunk(self, start, end, features):
+        """writes a finished chunk to disk and records it in the manifest"""
+        body = json.dumps(features).encode("utf-8")
+        fileName = "chunk_" + str(start) + "_" + str(end) + ".json"
+        chunkPath = os.path.join(self.spoolDir, fileName)
+
+        tempPath = chunkPath + ".tmp"
+        with open(tempPath, 'wb') as chunkFile:
+            chunkFile.write(body)
+        os.replace(tempPath, chunkPath)
+
+        with self.lock:
+            self.manifest["chunks"].append({"start": start,
+                                            "end": end,
+                                            "count": len(features),
+                                            "bytes": len(body),
+                                            "checksum": hashlib.sha256(body).hexdigest(),
+                                            "file": fileName})
+            self.save()
+
+    def readChunk(self, chunk):
+        """reads a chunk file back, a chunk that fails its checksum is dropped from the manifest so the next run fetches it again"""
+        with open(os.path.join(self.spoolDir, chunk["file"]), 'rb') as chunkFile:
+            body = chunkFile.read()
+
+        if hashlib.sha256(body).hexdigest() != chunk["checksum"]:
+            with self.lock:
+                self.manifest["chunks"].remove(chunk)
+                self.save()
+            raise IOError("Spool chunk " + chunk["file"] + " is corrupt, run the job again to fetch it")
+
+        return json.loads(body.decode("utf-8"))
+
+    def iterBatches(self):
+        """yields the features of each saved chunk in object ID order"""
+        for chunk in sorted(self.manifest["chunks"], key=lambda chunk: chunk["start"]):
+            yield self.readChunk(chunk)
+
+    def clear(self):
+        """removes every chunk and the manifest"""
+        with self.lock:
+            for fileName in os.listdir(self.spoolDir):
+                if fileName.startswith("chunk_") or fileName.startswith("manifest.json"):
+                    os.remove(os.path.join(self.spoolDir, fileName))
+            self.manifest = {"signature": None, "chunkSize": None, "chunks": []}
+
+    def remove(self):
+        """deletes the spool directory, once the output has been assembled it isnt needed"""
+        shutil.rmtree(self.spoolDir, ignore_errors=True)
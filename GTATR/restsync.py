@@ -0,0 +1,328 @@
+import gtatr as gt
+import featuretable
+import whereclause #answers where clauses from the snapshot without the server
+import sqlite3 #the local snapshot is a single sqlite file
+import json
+import time
+import datetime
+
+#This module keeps a local copy (snapshot) of a layer up to date without pulling the
+#whole layer every run. The first sync downloads everything, after that only the
+#features edited since the last run are fetched, either through the service's
+#extractChanges operation or by querying the editor tracking date field, and
+#deleted features are found by comparing the object IDs on the server with the
+#ones in the snapshot. The snapshot keeps each feature as ESRI JSON so the output
+#files can be rewritten from it without going back to the server, and query answers
+#where clauses from it locally.
+
+class LayerSnapshot():
+
+    def __init__(self, path):
+        """opens (or creates) the snapshot file"""
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS features (oid INTEGER PRIMARY KEY, editDate INTEGER, feature TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+        #the features loaded into a FeatureTable for local queries, and the field indexes on it, kept until the snapshot changes
+        self.table = None
+        self.indexes = {}
+
+    def getMeta(self, key, default=None):
+        """reads a saved setting such as the high water mark, values are stored as JSON"""
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def setMeta(self, key, value):
+        """saves a setting"""
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+        self.db.commit()
+
+    def reset(self):
+        """empties the snapshot, used when the layer or query it was built from changes"""
+        self.db.execute("DELETE FROM features")
+        self.db.execute("DELETE FROM meta")
+        self.db.commit()
+        self.clearTable()
+
+    def upsert(self, features, oidField, editDateField=None):
+        """adds or replaces ESRI JSON features, returns how many were new and how many actually changed"""
+        added = 0
+        updated = 0
+
+        for feature in features:
+            attributes = feature['attributes']
+            OID = attributes.get(oidField)
+            editDate = attributes.get(editDateField) if editDateField else None
+            featureText = json.dumps(feature, sort_keys=True)
+
+            #features fetched again but not changed dont count as updates
+            row = self.db.execute("SELECT feature FROM features WHERE oid = ?", (OID,)).fetchone()
+            if row is not None and row[0] == featureText:
+                continue
+
+            self.db.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?)", (OID, editDate, featureText))
+
+            if row is None:
+                added += 1
+            else:
+                updated += 1
+
+        self.db.commit()
+        if added or updated:
+            self.clearTable()
+
+        return added, updated
+
+    def delete(self, OIDs):
+        """removes features by object ID, returns how many were removed"""
+        deleted = 0
+        for OID in OIDs:
+            deleted += self.db.execute("DELETE FROM features WHERE oid = ?", (OID,)).rowcount
+        self.db.commit()
+        if deleted:
+            self.clearTable()
+
+        return deleted
+
+    def getOIDs(self):
+        """returns the set of object IDs in the snapshot"""
+        return set(row[0] for row in self.db.execute("SELECT oid FROM features"))
+
+    def count(self):
+        """returns the number of features in the snapshot"""
+        return self.db.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def maxEditDate(self):
+        """returns the latest edit date in the snapshot (milliseconds since the epoch), or None"""
+        return self.db.execute("SELECT MAX(editDate) FROM features").fetchone()[0]
+
+    def iterBatches(self, batchSize=1000):
+        """yields the snapshot's features in object ID order, batchSize at a time, in the same form the connector returns"""
+        lastOID = None
+        while True:
+            if lastOID is None:
+                rows = self.db.execute("SELECT oid, feature FROM features ORDER BY oid LIMIT ?", (batchSize,)).fetchall()
+            else:
+                rows = self.db.execute("SELECT oid, feature FROM features WHERE oid > ? ORDER BY oid LIMIT ?", (lastOID, batchSize)).fetchall()
+
+            if not rows:
+                return
+
+            lastOID = rows[-1][0]
+            yield [json.loads(row[1]) for row in rows]
+
+    def clearTable(self):
+        """drops the loaded FeatureTable and its indexes, the next query loads the snapshot again"""
+        self.table = None
+        self.indexes = {}
+
+    def getFeatureTable(self):
+        """returns the snapshot's features as a FeatureTable (with geometry), typed by the layer fields saved at sync"""
+        if self.table is None:
+            table = featuretable.FeatureTable(self.getMeta("fields"), geometry=True)
+            for features in self.iterBatches():
+                table.append(features)
+            self.table = table
+
+        return self.table
+
+    def createIndex(self, fieldName):
+        """indexes a field so =, IN, BETWEEN and range tests on it dont look at every row"""
+        if fieldName.lower() not in self.indexes:
+            self.indexes[fieldName.lower()] = whereclause.FieldIndex(self.getFeatureTable(), fieldName)
+
+    def query(self, queryText):
+        """returns the ESRI JSON features that match a where clause, worked out locally instead of by the server"""
+        table = self.getFeatureTable()
+        positions = whereclause.WhereClause(queryText).filterTable(table, list(self.indexes.values()))
+
+        features = []
+        for i in positions:
+            row = table.getRow(i)
+            geometry = row.pop("geometry")
+            features.append({"attributes": row, "geometry": geometry} if geometry is not None else {"attributes": row})
+
+        return features
+
+    def close(self):
+        """closes the snapshot file"""
+        self.db.close()
+
+#small helper that turns an ArcGIS date (milliseconds since the epoch, UTC) into a where clause timestamp
+def toTimestamp(editDate):
+    return datetime.datetime.fromtimestamp(editDate / 1000.0, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+#this function reads the change tracking generation for a layer from its service, None if the service doesnt track changes
+def getServerGen(RConnect, baseURL):
+
+    layerURL = gt.getLayerURL(baseURL)
+    serviceURL, layerId = layerURL.rsplit("/", 1)
+
+    r = RConnect.sendRequest(serviceURL, RConnect.getHeaders(), {'f': 'json', 'token': RConnect.tokenNo})
+
+    try:
+        serviceInfo = r.json()
+    except:
+        return None
+
+    if "ChangeTracking" not in str(serviceInfo.get("capabilities", "")):
+        return None
+
+    for layerGen in (serviceInfo.get("changeTrackingInfo") or {}).get("layerServerGens", []):
+        if str(layerGen.get("id")) == layerId:
+            return layerGen.get("serverGen")
+
+    return None
+
+#this function asks the service for everything that changed since serverGen, returns (adds and updates, deleted OIDs,
+#new serverGen) or None if the service didnt answer with the changes, so the caller can fall back to the edit dates
+def extractChanges(RConnect, baseURL, queryText, serverGen, fields="*"):
+
+    layerURL = gt.getLayerURL(baseURL)
+    serviceURL, layerId = layerURL.rsplit("/", 1)
+
+    PARAMS = {'f': 'json',
+              'layers': json.dumps([int(layerId)]),
+              'layerServerGens': json.dumps([{'id': int(layerId), 'serverGen': serverGen}]),
+              'layerQueries': json.dumps({layerId: {'where': queryText, 'fields': fields, 'useFilter': True, 'includeRelated': False, 'queryOption': 'useFilter'}}),
+              'returnInserts': 'true',
+              'returnUpdates': 'true',
+              'returnDeletes': 'true',
+              'returnIdsOnly': 'false',
+              'returnExtentOnly': 'false',
+              'dataFormat': 'json',
+              'outSR': '4326',
+              'token': RConnect.tokenNo}
+
+    r = RConnect.sendRequest(serviceURL + "/extractChanges", RConnect.getHeaders(), PARAMS, method='POST')
+
+    try:
+        data = r.json()
+        edits = [edit for edit in data["edits"] if str(edit.get("id")) == layerId][0]["features"]
+        newServerGen = [gen for gen in data["layerServerGens"] if str(gen.get("id")) == layerId][0]["serverGen"]
+    except Exception as ex:
+        #large change sets come back asynchronously, or the server cant do it, either way use the edit dates instead
+        print("extractChanges not usable -- " + str(ex))
+        return None
+
+    changed = (edits.get("adds") or []) + (edits.get("updates") or [])
+
+    #servers that ignore the fields send every attribute, keep only the requested ones so the snapshot has the same columns throughout
+    if "*" not in fields:
+        requestedFields = set(field.strip().lower() for field in fields.split(","))
+        changed = [dict(feature, attributes={name: value for name, value in feature["attributes"].items() if name.lower() in requestedFields})
+                   for feature in changed]
+
+    return changed, edits.get("deleteIds") or [], newServerGen
+
+#this function brings a local snapshot of a layer up to date and returns a summary of what changed
+def syncLayer(RConnect, baseURL, queryText, attributes, snapshotPath, useExtractChanges=True, reconcileDeletes=True):
+
+    #example baseURL "http://sampleserver1.arcgisonline.com/ArcGIS/rest/services/Demographics/ESRI_Census_USA/MapServer/5"
+    #example queryText "STATE_NAME = 'Alaska'"
+    #example attributes 'MALES, FEMALES, MED_AGE'
+    #example snapshotPath 'states.snapshot'
+
+    URL = baseURL + "/query?"
+
+    layerInfo = RConnect.getLayerInfo(baseURL) or {}
+    oidField = RConnect.getObjectIdField(baseURL)
+    editDateField = (layerInfo.get("editFieldsInfo") or {}).get("editDateField")
+
+    #the object ID and edit date are needed to keep the snapshot in step, even if they werent asked for
+    fields = attributes
+    if "*" not in attributes:
+        requestedFields = [field.strip().lower() for field in attributes.split(",")]
+        for neededField in (oidField, editDateField):
+            if neededField and neededField.lower() not in requestedFields:
+                fields = fields + ", " + neededField
+
+    summary = {"mode": None, "added": 0, "updated": 0, "deleted": 0, "total": 0}
+
+    snapshot = LayerSnapshot(snapshotPath)
+    try:
+        #a snapshot built from a different layer or query cant be updated, start it over
+        signature = [gt.getLayerURL(baseURL), queryText, fields]
+        if snapshot.getMeta("signature") != signature:
+            snapshot.reset()
+            snapshot.setMeta("signature", signature)
+
+        #the field types let local queries keep number and text fields in typed columns
+        snapshot.setMeta("fields", featuretable.getTableFields(layerInfo, fields))
+
+        def addFeatures(batches):
+            for features in batches:
+                added, updated = snapshot.upsert(features, oidField, editDateField)
+                summary["added"] += added
+                summary["updated"] += updated
+
+        #read the change tracking generation before downloading, so nothing edited during the download is missed next time
+        serverGen = getServerGen(RConnect, baseURL) if useExtractChanges else None
+        handledDeletes = False
+
+        if snapshot.getMeta("synced") is None:
+            print("No snapshot yet, downloading the full layer...")
+            summary["mode"] = "full"
+            addFeatures(RConnect.iterFeatureBatches(URL, fields, queryText, returnGeometry=True))
+            handledDeletes = True
+
+        else:
+            changes = None
+            lastServerGen = snapshot.getMeta("serverGen")
+            if serverGen is not None and lastServerGen is not None:
+                changes = extractChanges(RConnect, baseURL, queryText, lastServerGen, fields)
+
+            if changes is not None:
+                summary["mode"] = "extractChanges"
+                changed, deletedOIDs, serverGen = changes
+                addFeatures([changed])
+                summary["deleted"] += snapshot.delete(deletedOIDs)
+                handledDeletes = not reconcileDeletes
+
+            elif editDateField and snapshot.maxEditDate() is not None:
+                #>= so edits in the same millisecond as the last run are picked up, upserting them twice is harmless
+                highWaterMark = snapshot.maxEditDate()
+                print("Fetching features edited since " + toTimestamp(highWaterMark) + " UTC...")
+                summary["mode"] = "editDate"
+
+                whereText = editDateField + " >= TIMESTAMP '" + toTimestamp(highWaterMark) + "'"
+                if queryText != "1=1":
+                    whereText = "(" + queryText + ") AND " + whereText
+
+                addFeatures(RConnect.iterFeatureBatches(URL, fields, whereText, returnGeometry=True))
+
+            else:
+                #no way to tell what changed, so refresh everything in place
+                print("Layer has no editor tracking, refreshing every feature...")
+                summary["mode"] = "full"
+                addFeatures(RConnect.iterFeatureBatches(URL, fields, queryText, returnGeometry=True))
+
+        #the object IDs on the server tell us what was deleted, and catch anything new the edit dates missed
+        if not handledDeletes:
+            #a failed request raises RESTError, an empty list really means every feature is gone
+            serverOIDs = set(RConnect.getObjectIDs(URL, queryText))
+            snapshotOIDs = snapshot.getOIDs()
+
+            summary["deleted"] += snapshot.delete(snapshotOIDs - serverOIDs)
+
+            missingOIDs = sorted(serverOIDs - snapshotOIDs)
+            for chunk in RConnect.create_chunks(missingOIDs, 250):
+                whereText = oidField + " IN (" + ",".join(str(OID) for OID in chunk) + ")"
+                addFeatures(RConnect.iterFeatureBatches(URL, fields, whereText, returnGeometry=True, strategy='single'))
+
+        if serverGen is not None:
+            snapshot.setMeta("serverGen", serverGen)
+        snapshot.setMeta("synced", time.time())
+
+        summary["total"] = snapshot.count()
+    finally:
+        snapshot.close()
+
+    print("Sync complete (" + str(summary["mode"]) + "): " + str(summary["added"]) + " added, " + str(summary["updated"]) + " updated, "
+          + str(summary["deleted"]) + " deleted, " + str(summary["total"]) + " in snapshot")
+
+    return summary
@@ -0,0 +1,558 @@
+import json
+import math
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None #point in polygon and intersects tests are done one at a time without numpy
+
+import esrigeometry
+
+#This module answers spatial questions about features that have already been
+#downloaded (what is in this box, which polygon is this point in, which landmarks
+#fall in which state) without going back to the server. The envelope of every
+#feature goes into an R-tree packed with the Sort-Tile-Recursive method: the
+#envelopes are sorted into vertical slices by x, each slice is sorted by y and cut
+#into nodes of NODE_CAPACITY, and the nodes are packed the same way level by level
+#up to the root. A search only opens the nodes whose envelope overlaps, and the
+#exact tests are then done on the few features left. With numpy the point in
+#polygon and intersects tests run over every candidate at once. The index can be
+#saved next to the output file, with the envelope of every feature and where it
+#sits in the file, and is read back by the next run as long as the file hasnt
+#changed since. A loaded index reads only the features a search needs.
+
+NODE_CAPACITY = 16
+
+#index file format, a file written with a different version is rebuilt
+INDEX_VERSION = 2
+
+#the standard library's scanner, raw_decode gives back the value and where it ended
+decoder = json.JSONDecoder()
+
+def fromGeoJSONGeometry(geometry):
+    """converts a geoJSON geometry to ESRI JSON, multi part polygons become one polygon with all of their rings"""
+    if not geometry or not geometry.get("coordinates"):
+        return None
+
+    geometryType = geometry["type"]
+    coordinates = geometry["coordinates"]
+
+    if geometryType == "Point":
+        return {"x": coordinates[0], "y": coordinates[1]}
+    if geometryType == "MultiPoint":
+        return {"points": coordinates}
+    if geometryType == "LineString":
+        return {"paths": [coordinates]}
+    if geometryType == "MultiLineString":
+        return {"paths": coordinates}
+    if geometryType == "Polygon":
+        return {"rings": coordinates}
+    if geometryType == "MultiPolygon":
+        return {"rings": [ring for polygon in coordinates for ring in polygon]}
+
+    return None
+
+def getGeometry(feature):
+    """returns the ESRI JSON geometry of a geoJSON feature, an ESRI JSON feature, or a getFeaturesWithGeometry row"""
+    geometry = feature.get("geometry")
+    if geometry and "type" in geometry:
+        return fromGeoJSONGeometry(geometry)
+    return geometry
+
+def pointsInPolygon(xs, ys, rings):
+    """even-odd test of many points against a polygon's rings (holes and all), returns a list of booleans"""
+    rings = [ring for ring in rings if len(ring) >= 3]
+    if not rings or not len(xs):
+        return [False] * len(xs)
+
+    if np is None:
+        return [sum(esrigeometry.pointInRing(x, y, ring) for ring in rings) % 2 == 1 for x, y in zip(xs, ys)]
+
+    #every edge of every ring, from each vertex to the one before it like pointInRing
+    x1, y1, x2, y2 = [], [], [], []
+    for ring in rings:
+        coordinates = np.asarray([position[:2] for position in ring], dtype=float)
+        x1.append(coordinates[:, 0])
+        y1.append(coordinates[:, 1])
+        x2.append(np.roll(coordinates[:, 0], 1))
+        y2.append(np.roll(coordinates[:, 1], 1))
+    x1, y1, x2, y2 = [np.concatenate(values)[:, None] for values in (x1, y1, x2, y2)]
+
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    inside = np.zeros(len(xs), dtype=bool)
+
+    #the points are tested in batches so the edges by points table stays around a million entries
+    batchSize = max(1, 1000000 // len(x1))
+    for start in range(0, len(xs), batchSize):
+        x = xs[None, start:start + batchSize]
+        y = ys[None, start:start + batchSize]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossings = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+
+        inside[start:start + batchSize] = np.count_nonzero(crossings, axis=0) % 2 == 1
+
+    return inside.tolist()
+
+def segmentsIntersect(a, b, c, d):
+    """checks if segment a-b touches segment c-d, a segment can be a single point"""
+    def orientation(p, q, r):
+        value = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (value > 0) - (value < 0)
+
+    def onSegment(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+
+    o1 = orientation(a, b, c)
+    o2 = orientation(a, b, d)
+    o3 = orientation(c, d, a)
+    o4 = orientation(c, d, b)
+
+    if o1 != o2 and o3 != o4:
+        return True
+
+    #the collinear cases, one end lying on the other segment
+    return ((o1 == 0 and onSegment(a, b, c)) or (o2 == 0 and onSegment(a, b, d)) or
+            (o3 == 0 and onSegment(c, d, a)) or (o4 == 0 and onSegment(c, d, b)))
+
+def getSegments(kind, parts, envelope):
+    """returns the segments of a geometry that reach into an envelope, points count as segments of no length"""
+    xmin, ymin, xmax, ymax = envelope
+    segments = []
+
+    for part in parts:
+        if kind in (esrigeometry.POINT, esrigeometry.MULTIPOINT) or len(part) == 1:
+            pairs = [(position, position) for position in part]
+        else:
+            pairs = zip(part[:-1], part[1:])
+
+        for start, end in pairs:
+            if (min(start[0], end[0]) <= xmax and max(start[0], end[0]) >= xmin and
+                    min(start[1], end[1]) <= ymax and max(start[1], end[1]) >= ymin):
+                segments.append((start, end))
+
+    return segments
+
+def geometriesIntersect(geometry, otherGeometry):
+    """checks if two ESRI JSON geometries touch or overlap"""
+    envelope = esrigeometry.getEnvelope(geometry)
+    otherEnvelope = esrigeometry.getEnvelope(otherGeometry)
+    if envelope is None or otherEnvelope is None or not envelopesIntersect(envelope, otherEnvelope):
+        return False
+
+    kind, parts = esrigeometry.getParts(geometry)
+    otherKind, otherParts = esrigeometry.getParts(otherGeometry)
+
+    #one geometry inside a polygon has its first vertex inside it (or is crossed by an edge, tested below)
+    if otherKind == esrigeometry.POLYGON and any(pointsInPolygon([part[0][0] for part in parts], [part[0][1] for part in parts], otherParts)):
+        return True
+    if kind == esrigeometry.POLYGON and any(pointsInPolygon([part[0][0] for part in otherParts], [part[0][1] for part in otherParts], parts)):
+        return True
+
+    #otherwise an edge of one has to touch an edge of the other, only the edges inside the other's envelope can
+    otherSegments = getSegments(otherKind, otherParts, envelope)
+    for a, b in getSegments(kind, parts, otherEnvelope):
+        for c, d in otherSegments:
+            if segmentsIntersect(a, b, c, d):
+                return True
+
+    return False
+
+def segmentsTouchAny(segments, otherSegments):
+    """checks each segment against all of otherSegments at once, both are numpy arrays of (x1, y1, x2, y2) rows,
+    returns an array of booleans, the same test as segmentsIntersect"""
+    touching = np.zeros(len(segments), dtype=bool)
+    if not len(segments) or not len(otherSegments):
+        return touching
+
+    cx, cy, dx, dy = [otherSegments[None, :, i] for i in range(4)]
+
+    def orientation(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+
+    def onSegment(px, py, qx, qy, rx, ry):
+        return (np.minimum(px, qx) <= rx) & (rx <= np.maximum(px, qx)) & (np.minimum(py, qy) <= ry) & (ry <= np.maximum(py, qy))
+
+    #the segments are tested in batches so the segments by other segments table stays around a million entries
+    batchSize = max(1, 1000000 // len(otherSegments))
+    for start in range(0, len(segments), batchSize):
+        ax, ay, bx, by = [segments[start:start + batchSize, i][:, None] for i in range(4)]
+
+        o1 = orientation(ax, ay, bx, by, cx, cy)
+        o2 = orientation(ax, ay, bx, by, dx, dy)
+        o3 = orientation(cx, cy, dx, dy, ax, ay)
+        o4 = orientation(cx, cy, dx, dy, bx, by)
+
+        crossing = ((o1 != o2) & (o3 != o4)) | \
+                   ((o1 == 0) & onSegment(ax, ay, bx, by, cx, cy)) | ((o2 == 0) & onSegment(ax, ay, bx, by, dx, dy)) | \
+                   ((o3 == 0) & onSegment(cx, cy, dx, dy, ax, ay)) | ((o4 == 0) & onSegment(cx, cy, dx, dy, bx, by))
+
+        touching[start:start + batchSize] = crossing.any(axis=1)
+
+    return touching
+
+def intersectsMany(geometries, otherGeometry):
+    """geometriesIntersect for a list of ESRI JSON geometries against one other geometry, returns a list of booleans,
+    with numpy each step runs over every geometry at once"""
+    if np is None:
+        return [geometriesIntersect(geometry, otherGeometry) for geometry in geometries]
+
+    matches = [False] * len(geometries)
+    otherEnvelope = esrigeometry.getEnvelope(otherGeometry)
+    if otherEnvelope is None:
+        return matches
+    otherKind, otherParts = esrigeometry.getParts(otherGeometry)
+    otherParts = [part for part in otherParts if part]
+
+    candidates = []
+    for i, geometry in enumerate(geometries):
+        envelope = esrigeometry.getEnvelope(geometry)
+        if envelope is not None and envelopesIntersect(envelope, otherEnvelope):
+            kind, parts = esrigeometry.getParts(geometry)
+            candidates.append((i, envelope, kind, [part for part in parts if part]))
+
+    #the first vertex of every part of every candidate inside the other polygon, in one test
+    if otherKind == esrigeometry.POLYGON:
+        owners = [i for i, envelope, kind, parts in candidates for part in parts]
+        inside = pointsInPolygon([part[0][0] for candidate in candidates for part in candidate[3]],
+                                 [part[0][1] for candidate in candidates for part in candidate[3]], otherParts)
+        for i, isInside in zip(owners, inside):
+            if isInside:
+                matches[i] = True
+
+    #the other geometry inside a candidate polygon
+    for i, envelope, kind, parts in candidates:
+        if not matches[i] and kind == esrigeometry.POLYGON:
+            matches[i] = any(pointsInPolygon([part[0][0] for part in otherParts], [part[0][1] for part in otherParts], parts))
+
+    #otherwise an edge has to touch an edge, every candidate edge near the other geometry against its edges near the candidates
+    candidates = [candidate for candidate in candidates if not matches[candidate[0]]]
+    if not candidates:
+        return matches
+
+    owners = []
+    segments = []
+    for i, envelope, kind, parts in candidates:
+        for start, end in getSegments(kind, parts, otherEnvelope):
+            owners.append(i)
+            segments.append((start[0], start[1], end[0], end[1]))
+
+    candidatesEnvelope = (min(candidate[1][0] for candidate in candidates), min(candidate[1][1] for candidate in candidates),
+                          max(candidate[1][2] for candidate in candidates), max(candidate[1][3] for candidate in candidates))
+    otherSegments = [(start[0], start[1], end[0], end[1]) for start, end in getSegments(otherKind, otherParts, candidatesEnvelope)]
+
+    touching = segmentsTouchAny(np.asarray(segments, dtype=float).reshape(-1, 4), np.asarray(otherSegments, dtype=float).reshape(-1, 4))
+    for i, isTouching in zip(owners, touching):
+        if isTouching:
+            matches[i] = True
+
+    return matches
+
+def envelopesIntersect(envelope, otherEnvelope):
+    return (envelope[0] <= otherEnvelope[2] and envelope[2] >= otherEnvelope[0] and
+            envelope[1] <= otherEnvelope[3] and envelope[3] >= otherEnvelope[1])
+
+def packNodes(envelopes, items, capacity):
+    """packs items (with their envelopes) into nodes of up to capacity using Sort-Tile-Recursive,
+    returns each node as (xmin, ymin, xmax, ymax, items)"""
+    nodeCount = int(math.ceil(len(items) / float(capacity)))
+    sliceSize = int(math.ceil(math.sqrt(nodeCount))) * capacity
+
+    #sorted by the middle of each envelope, across in slices and then up each slice
+    byX = sorted(items, key=lambda item: envelopes[item][0] + envelopes[item][2])
+
+    nodes = []
+    for sliceStart in range(0, len(byX), sliceSize):
+        byY = sorted(byX[sliceStart:sliceStart + sliceSize], key=lambda item: envelopes[item][1] + envelopes[item][3])
+
+        for nodeStart in range(0, len(byY), capacity):
+            children = byY[nodeStart:nodeStart + capacity]
+            nodes.append((min(envelopes[child][0] for child in children),
+                          min(envelopes[child][1] for child in children),
+                          max(envelopes[child][2] for child in children),
+                          max(envelopes[child][3] for child in children),
+                          children))
+
+    return nodes
+
+#This class is the features of a .geojson file, read one at a time from where they
+#sit in the file, so a loaded index neither holds nor parses the whole file
+
+class FeatureFile():
+
+    def __init__(self, path, offsets):
+        """offsets are the [start, end] byte offsets of each feature in the file"""
+        self.path = path
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.read([i])[0]
+
+    def __iter__(self):
+        return iter(self.read(range(len(self.offsets))))
+
+    def read(self, positions):
+        """returns the features at the positions, with the file opened once"""
+        features = []
+        with open(self.path, 'rb') as geoJSONFile:
+            for i in positions:
+                start, end = self.offsets[i]
+                geoJSONFile.seek(start)
+                features.append(json.loads(geoJSONFile.read(end - start).decode('utf-8')))
+        return features
+
+#This class is the index over a list of features, searches give back the positions
+#of the matching features in that list
+
+class SpatialIndex():
+
+    def __init__(self, features, capacity=NODE_CAPACITY, levels=None, envelopes=None):
+        """features can be geoJSON features, ESRI JSON features, getFeaturesWithGeometry rows, or a FeatureFile,
+        levels and envelopes are a saved tree and the feature envelopes it was built from"""
+        self.features = features
+        self.capacity = capacity
+
+        #a saved index has the envelopes already, the geometries are then only read for the features a search needs
+        self.allGeometries = None
+        if envelopes is None:
+            self.allGeometries = [getGeometry(feature) for feature in features]
+            envelopes = [esrigeometry.getEnvelope(geometry) for geometry in self.allGeometries]
+        self.envelopes = [tuple(envelope) if envelope is not None else None for envelope in envelopes]
+
+        self.levels = levels if levels is not None else self.build()
+
+    @property
+    def geometries(self):
+        """the ESRI JSON geometry of every feature, read the first time they are needed"""
+        if self.allGeometries is None:
+            self.allGeometries = [getGeometry(feature) for feature in self.features]
+        return self.allGeometries
+
+    def getGeometries(self, positions):
+        """the ESRI JSON geometries of the features at the positions"""
+        if self.allGeometries is not None:
+            return [self.allGeometries[i] for i in positions]
+        return [getGeometry(feature) for feature in self.getFeatures(positions)]
+
+    def build(self):
+        """packs the feature envelopes into the tree, returns its levels from the leaves up"""
+        levels = []
+        envelopes = self.envelopes
+        items = [i for i, envelope in enumerate(envelopes) if envelope is not None] #features with no geometry arent indexed
+
+        while items:
+            nodes = packNodes(envelopes, items, self.capacity)
+            levels.append(nodes)
+            if len(nodes) == 1:
+                break
+
+            #the next level up packs these nodes by their own envelopes
+            envelopes = [node[:4] for node in nodes]
+            items = list(range(len(nodes)))
+
+        return levels
+
+    def __len__(self):
+        return len(self.features)
+
+    def search(self, envelope):
+        """returns the positions of the features whose envelope overlaps (xmin, ymin, xmax, ymax)"""
+        if not self.levels:
+            return []
+
+        xmin, ymin, xmax, ymax = envelope
+
+        #walk down from the root, only opening nodes that overlap, the leaves hold feature positions
+        candidates = range(len(self.levels[-1]))
+        for nodes in reversed(self.levels):
+            children = []
+            for i in candidates:
+                node = nodes[i]
+                if node[0] <= xmax and node[2] >= xmin and node[1] <= ymax and node[3] >= ymin:
+                    children.extend(node[4])
+            candidates = children
+
+        return sorted(i for i in candidates if envelopesIntersect(self.envelopes[i], envelope))
+
+    def containing(self, x, y):
+        """returns the positions of the polygon features that contain the point"""
+        candidates = self.search((x, y, x, y))
+
+        matches = []
+        for i, geometry in zip(candidates, self.getGeometries(candidates)):
+            kind, parts = esrigeometry.getParts(geometry)
+            if kind == esrigeometry.POLYGON and pointsInPolygon([x], [y], parts)[0]:
+                matches.append(i)
+
+        return matches
+
+    def intersecting(self, geometry):
+        """returns the positions of the features that touch or overlap an ESRI JSON (or geoJSON) geometry"""
+        if geometry and "type" in geometry:
+            geometry = fromGeoJSONGeometry(geometry)
+
+        envelope = esrigeometry.getEnvelope(geometry)
+        if envelope is None:
+            return []
+
+        candidates = self.search(envelope)
+        return [i for i, isMatch in zip(candidates, intersectsMany(self.getGeometries(candidates), geometry)) if isMatch]
+
+    def getFeatures(self, positions):
+        """returns the features at the positions a search gave back"""
+        if isinstance(self.features, FeatureFile):
+            return self.features.read(positions)
+        return [self.features[i] for i in positions]
+
+    def save(self, indexPath, source=None):
+        """writes the tree to a file, source is the size and modified time of the file the features came from,
+        the feature offsets are saved too when the features are a FeatureFile"""
+        indexData = {"version": INDEX_VERSION,
+                     "source": source,
+                     "featureCount": len(self.features),
+                     "capacity": self.capacity,
+                     "levels": self.levels,
+                     "envelopes": self.envelopes,
+                     "offsets": self.features.offsets if isinstance(self.features, FeatureFile) else None}
+
+        tempPath = indexPath + ".tmp"
+        with open(tempPath, 'w') as indexFile:
+            json.dump(indexData, indexFile)
+        os.replace(tempPath, indexPath)
+
+def getSourceStamp(path):
+    """the size and modified time of a file, an index saved with a different stamp is out of date"""
+    status = os.stat(path)
+    return [status.st_size, status.st_mtime]
+
+def readGeoJSONFeatures(path):
+    """reads the features of a .geojson file, either a FeatureCollection or one feature per line (GeoJSONSeq)"""
+    with open(path) as geoJSONFile:
+        text = geoJSONFile.read()
+
+    try:
+        data = json.loads(text)
+    except ValueError:
+        #more than one JSON document, so one feature per line
+        return [json.loads(line.lstrip("\x1e")) for line in text.splitlines() if line.strip()]
+
+    return data["features"] if data.get("type") == "FeatureCollection" else [data]
+
+def scanGeoJSONFile(path):
+    """finds the features of a .geojson file (a FeatureCollection, or GeoJSONSeq with one feature per line) in one
+    pass, returns the [start, end] byte offsets and the envelope of each one without keeping the features"""
+    with open(path, 'rb') as geoJSONFile:
+        #latin-1 turns every byte into one character, so positions in the text are byte offsets in the file, text
+        #values come out garbled but only the coordinates are used here
+        text = geoJSONFile.read().decode('latin-1')
+
+    offsets = []
+    envelopes = []
+
+    def skip(position):
+        while position < len(text) and text[position] in ' \t\n\r\x1e,':
+            position += 1
+        return position
+
+    def addFeature(feature, start, end):
+        offsets.append([start, end])
+        envelopes.append(esrigeometry.getEnvelope(getGeometry(feature)))
+
+    try:
+        position = skip(0)
+        while position < len(text):
+            #walk the keys of each top level object, the features of a FeatureCollection are decoded one at a time
+            #and any other object is a feature in its own right
+            start = position
+            if text[position] != '{':
+                raise ValueError("expected an object at byte " + str(position))
+            position = skip(position + 1)
+
+            document = {}
+            isCollection = False
+            while text[position] != '}':
+                key, position = decoder.raw_decode(text, position)
+                position = skip(position)
+                if text[position] != ':':
+                    raise ValueError("expected : at byte " + str(position))
+                position = skip(position + 1)
+
+                if key == "features" and text[position] == '[':
+                    isCollection = True
+                    position = skip(position + 1)
+                    while text[position] != ']':
+                        feature, end = decoder.raw_decode(text, position)
+                        addFeature(feature, position, end)
+                        position = skip(end)
+                    position = skip(position + 1)
+                else:
+                    document[key], position = decoder.raw_decode(text, position)
+                    position = skip(position)
+
+            position += 1
+            if not isCollection:
+                addFeature(document, start, position)
+            position = skip(position)
+    except IndexError:
+        raise ValueError(path + " ends part way through a feature")
+
+    return offsets, envelopes
+
+def indexFeatures(features, capacity=NODE_CAPACITY):
+    """builds a SpatialIndex over a list of features, or over a geoJSON FeatureCollection"""
+    if isinstance(features, dict):
+        features = features["features"]
+    return SpatialIndex(features, capacity)
+
+def indexGeoJSONFile(path, indexPath=None, capacity=NODE_CAPACITY):
+    """returns a SpatialIndex over a .geojson file, the tree, envelopes and feature offsets are saved beside it
+    (path + '.sidx') and reused while the file is unchanged, the features are read from the file as they are needed"""
+    if indexPath is None:
+        indexPath = path + ".sidx"
+
+    source = getSourceStamp(path)
+
+    if os.path.exists(indexPath):
+        try:
+            with open(indexPath) as indexFile:
+                indexData = json.load(indexFile)
+
+            if indexData.get("version") == INDEX_VERSION and indexData.get("source") == source and indexData.get("offsets") is not None:
+                return SpatialIndex(FeatureFile(path, indexData["offsets"]), indexData["capacity"],
+                                    [[tuple(node) for node in nodes] for nodes in indexData["levels"]], indexData["envelopes"])
+        except ValueError:
+            pass #a damaged index is just built again
+
+        print("Spatial index " + indexPath + " is out of date, rebuilding...")
+
+    offsets, envelopes = scanGeoJSONFile(path)
+    index = SpatialIndex(FeatureFile(path, offsets), capacity, envelopes=envelopes)
+    index.save(indexPath, source)
+
+    return index
+
+def joinPointsToPolygons(points, polygons):
+    """returns, for each feature in the points index, the position of the first polygon in the polygons index that
+    contains it (None if none does), features that arent points are placed by their centroid"""
+    locations = [esrigeometry.getCentroid(geometry) for geometry in points.geometries]
+    matches = [None] * len(points)
+
+    for i, geometry in enumerate(polygons.geometries):
+        kind, parts = esrigeometry.getParts(geometry)
+        if kind != esrigeometry.POLYGON or polygons.envelopes[i] is None:
+            continue
+
+        #only the points still unplaced and inside the polygon's envelope need testing, all at once
+        candidates = [j for j in points.search(polygons.envelopes[i]) if matches[j] is None and locations[j] is not None]
+        inside = pointsInPolygon([locations[j]["x"] for j in candidates], [locations[j]["y"] for j in candidates], parts)
+
+        for j, isInside in zip(candidates, inside):
+            if isInside:
+                matches[j] = i
+
+    return matches
@@ -0,0 +1,752 @@
+import datetime
+import re
+import time
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None #where clauses are still evaluated without numpy, one row at a time
+
+#This module reads the SQL-92 subset ArcGIS where clauses are written in (comparisons,
+#IN, LIKE, BETWEEN, IS NULL, AND/OR/NOT, + - * /, UPPER/LOWER, DATE and TIMESTAMP
+#literals) so a query can be answered from a layer that is already stored locally,
+#such as a FeatureTable or a restsync snapshot, instead of going back to the server.
+#The clause is parsed once into a tree of tuples. Against a FeatureTable each part of
+#the tree is worked out for a whole column at once with numpy: number columns are
+#compared as arrays and text columns, which are dictionary encoded, are tested once
+#per distinct value and the answer is spread back over the rows by their codes.
+#NULL follows SQL's three valued logic, a comparison with NULL is neither true nor
+#false and only rows where the whole clause is true are kept. A FieldIndex on a
+#field lets =, IN, BETWEEN and range tests in the top level AND pick their rows
+#straight out of the index.
+
+KEYWORDS = ('AND', 'OR', 'NOT', 'IN', 'LIKE', 'ESCAPE', 'IS', 'NULL', 'BETWEEN', 'DATE', 'TIMESTAMP', 'TRUE', 'FALSE',
+            'CURRENT_DATE', 'CURRENT_TIMESTAMP')
+
+FUNCTIONS = {'UPPER': lambda value: value.upper(),
+             'LOWER': lambda value: value.lower(),
+             'TRIM': lambda value: value.strip(),
+             'CHAR_LENGTH': len}
+
+COMPARISONS = ('=', '<>', '!=', '<', '<=', '>', '>=')
+
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<number>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<operator><>|!=|<=|>=|[=<>(),+\-*/])
+  )""", re.VERBOSE)
+
+def tokenize(text):
+    """splits a where clause into (kind, value) tokens"""
+    tokens = []
+    position = 0
+    text = text.rstrip()
+
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise ValueError("Can't read the where clause at: " + text[position:position + 20])
+        position = match.end()
+
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            tokens.append(('value', float(value) if ('.' in value or 'e' in value.lower()) else int(value)))
+        elif kind == 'string':
+            tokens.append(('string', value[1:-1].replace("''", "'")))
+        elif kind == 'quoted':
+            tokens.append(('name', value[1:-1].replace('""', '"')))
+        elif kind == 'name' and value.upper() in KEYWORDS:
+            tokens.append(('keyword', value.upper()))
+        else:
+            tokens.append((kind, value))
+
+    return tokens
+
+def toEpochMilliseconds(text):
+    """reads a DATE or TIMESTAMP literal as milliseconds since the epoch (UTC), the way ArcGIS stores dates"""
+    for dateFormat in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y"):
+        try:
+            moment = datetime.datetime.strptime(text.strip(), dateFormat)
+        except ValueError:
+            continue
+        return int(round(moment.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000))
+
+    raise ValueError("Can't read the date " + repr(text))
+
+#This class turns the tokens into the tree, with the usual precedence (OR, then AND,
+#then NOT, then the predicates, then + -, then * /)
+
+class Parser():
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return (None, None)
+
+    def accept(self, kind, value=None):
+        """takes the next token if it matches, returns it or None"""
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return token
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            found = self.peek()[1]
+            raise ValueError("Expected " + str(value or kind) + " but found " + (repr(found) if found is not None else "the end") + " in " + repr(self.text))
+        return token
+
+    def parse(self):
+        tree = self.parseOr()
+        if self.position < len(self.tokens):
+            raise ValueError("Unexpected " + repr(self.peek()[1]) + " in " + repr(self.text))
+        return tree
+
+    def parseOr(self):
+        tree = self.parseAnd()
+        while self.accept('keyword', 'OR'):
+            tree = ('or', tree, self.parseAnd())
+        return tree
+
+    def parseAnd(self):
+        tree = self.parseNot()
+        while self.accept('keyword', 'AND'):
+            tree = ('and', tree, self.parseNot())
+        return tree
+
+    def parseNot(self):
+        if self.accept('keyword', 'NOT'):
+            return ('not', self.parseNot())
+        return self.parsePredicate()
+
+    def parsePredicate(self):
+        #a bracket can hold a whole condition, or just start a value such as (POP / AREA) > 10, try it as a value first
+        if self.peek() == ('operator', '('):
+            start = self.position
+            try:
+                return self.parseComparison()
+            except ValueError:
+                self.position = start
+                self.expect('operator', '(')
+                tree = self.parseOr()
+                self.expect('operator', ')')
+                return tree
+
+        return self.parseComparison()
+
+    def parseComparison(self):
+        left = self.parseSum()
+
+        negated = bool(self.accept('keyword', 'NOT'))
+
+        if self.accept('keyword', 'IN'):
+            self.expect('operator', '(')
+            values = [self.parseSum()]
+            while self.accept('operator', ','):
+                values.append(self.parseSum())
+            self.expect('operator', ')')
+            return ('in', left, values, negated)
+
+        if self.accept('keyword', 'LIKE'):
+            pattern = self.parseSum()
+            escape = None
+            if self.accept('keyword', 'ESCAPE'):
+                escape = self.expect('string')[1]
+            return ('like', left, pattern, escape, negated)
+
+        if self.accept('keyword', 'BETWEEN'):
+            low = self.parseSum()
+            self.expect('keyword', 'AND')
+            high = self.parseSum()
+            return ('between', left, low, high, negated)
+
+        if negated:
+            raise ValueError("Expected IN, LIKE or BETWEEN after NOT in " + repr(self.text))
+
+        if self.accept('keyword', 'IS'):
+            negated = bool(self.accept('keyword', 'NOT'))
+            self.expect('keyword', 'NULL')
+            return ('isnull', left, negated)
+
+        token = self.peek()
+        if token[0] == 'operator' and token[1] in COMPARISONS:
+            self.position += 1
+            operator = '<>' if token[1] == '!=' else token[1]
+            return ('compare', operator, left, self.parseSum())
+
+        #a value on its own, e.g. a TRUE/FALSE or 1 = 1 written as just 1
+        if left[0] == 'constant':
+            return ('compare', '=', left, ('constant', True)) if isinstance(left[1], bool) else ('compare', '<>', left, ('constant', 0))
+
+        raise ValueError("Expected a comparison after " + repr(self.tokens[self.position - 1][1]) + " in " + repr(self.text))
+
+    def parseSum(self):
+        tree = self.parseProduct()
+        while True:
+            token = self.accept('operator', '+') or self.accept('operator', '-')
+            if token is None:
+                return tree
+            tree = ('arithmetic', token[1], tree, self.parseProduct())
+
+    def parseProduct(self):
+        tree = self.parseFactor()
+        while True:
+            token = self.accept('operator', '*') or self.accept('operator', '/')
+            if token is None:
+                return tree
+            tree = ('arithmetic', token[1], tree, self.parseFactor())
+
+    def parseFactor(self):
+        token = self.peek()
+        kind, value = token
+
+        if kind == 'operator' and value == '-':
+            self.position += 1
+            return ('arithmetic', '-', ('constant', 0), self.parseFactor())
+
+        if kind == 'operator' and value == '(':
+            self.position += 1
+            tree = self.parseSum()
+            self.expect('operator', ')')
+            return tree
+
+        if kind in ('value', 'string'):
+            self.position += 1
+            return ('constant', value)
+
+        if kind == 'keyword':
+            self.position += 1
+            if value in ('DATE', 'TIMESTAMP'):
+                return ('constant', toEpochMilliseconds(self.expect('string')[1]))
+            if value == 'NULL':
+                return ('constant', None)
+            if value in ('TRUE', 'FALSE'):
+                return ('constant', value == 'TRUE')
+            if value == 'CURRENT_TIMESTAMP':
+                return ('constant', int(time.time() * 1000))
+            if value == 'CURRENT_DATE':
+                return ('constant', int(time.time() // 86400 * 86400000))
+            raise ValueError("Unexpected " + value + " in " + repr(self.text))
+
+        if kind == 'name':
+            self.position += 1
+            if value.upper() in FUNCTIONS and self.accept('operator', '('):
+                argument = self.parseSum()
+                self.expect('operator', ')')
+                return ('function', value.upper(), argument)
+            return ('field', value)
+
+        raise ValueError("Expected a value but found " + (repr(value) if value is not None else "the end") + " in " + repr(self.text))
+
+def parseWhere(text):
+    """parses a where clause into its tree, raises ValueError if it cant be read"""
+    if text is None or not text.strip():
+        return ('constant', True)
+    return Parser(text).parse()
+
+#the rules for single values, shared by the row by row and the column evaluators,
+#each gives back True, False or None (unknown, when a NULL is involved)
+
+def compareValues(operator, left, right):
+    if left is None or right is None:
+        return None
+
+    try:
+        if operator == '=':
+            return left == right
+        if operator == '<>':
+            return left != right
+        if operator == '<':
+            return left < right
+        if operator == '<=':
+            return left <= right
+        if operator == '>':
+            return left > right
+        return left >= right
+    except TypeError:
+        return None #e.g. text against a number, which the server would refuse
+
+def inValues(value, values):
+    if value is None:
+        return None
+    if value in values:
+        return True
+    return None if None in values else False
+
+def likeToRegex(pattern, escape=None):
+    """turns a LIKE pattern into a compiled regular expression, % is any run of characters and _ any one"""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        character = pattern[i]
+        if escape and character == escape and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+
+        if character == '%':
+            parts.append('.*')
+        elif character == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(character))
+        i += 1
+
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+def likeMatch(value, regex):
+    if value is None or regex is None:
+        return None
+    if not isinstance(value, str):
+        value = str(value)
+    return regex.match(value) is not None
+
+def arithmeticValues(operator, left, right):
+    if left is None or right is None:
+        return None
+
+    try:
+        if operator == '+':
+            return left + right
+        if operator == '-':
+            return left - right
+        if operator == '*':
+            return left * right
+        return left / right
+    except (TypeError, ZeroDivisionError):
+        return None
+
+def applyFunction(name, value):
+    if value is None or not isinstance(value, str):
+        return None if value is None else (FUNCTIONS[name](str(value)) if name != 'CHAR_LENGTH' else len(str(value)))
+    return FUNCTIONS[name](value)
+
+def notValue(value):
+    return None if value is None else not value
+
+def andValues(left, right):
+    if left is False or right is False:
+        return False
+    if left is None or right is None:
+        return None
+    return True
+
+def orValues(left, right):
+    if left is True or right is True:
+        return True
+    if left is None or right is None:
+        return None
+    return False
+
+def getLikeRegex(tree, pattern):
+    """the regular expression for a LIKE whose pattern is a constant, None if it isnt text"""
+    return likeToRegex(pattern, tree[3]) if isinstance(pattern, str) else None
+
+def evaluateRow(tree, row):
+    """works out a tree for one row (a dictionary of attributes with lower case names), True, False or None"""
+    node = tree[0]
+
+    if node == 'constant':
+        return tree[1]
+    if node == 'field':
+        return row.get(tree[1].lower())
+    if node == 'function':
+        return applyFunction(tree[1], evaluateRow(tree[2], row))
+    if node == 'arithmetic':
+        return arithmeticValues(tree[1], evaluateRow(tree[2], row), evaluateRow(tree[3], row))
+    if node == 'compare':
+        return compareValues(tree[1], evaluateRow(tree[2], row), evaluateRow(tree[3], row))
+    if node == 'in':
+        result = inValues(evaluateRow(tree[1], row), [evaluateRow(value, row) for value in tree[2]])
+        return notValue(result) if tree[3] else result
+    if node == 'like':
+        pattern = evaluateRow(tree[2], row)
+        result = likeMatch(evaluateRow(tree[1], row), getLikeRegex(tree, pattern))
+        return notValue(result) if tree[4] else result
+    if node == 'between':
+        value = evaluateRow(tree[1], row)
+        result = andValues(compareValues('>=', value, evaluateRow(tree[2], row)), compareValues('<=', value, evaluateRow(tree[3], row)))
+        return notValue(result) if tree[4] else result
+    if node == 'isnull':
+        isNull = evaluateRow(tree[1], row) is None
+        return not isNull if tree[2] else isNull
+    if node == 'not':
+        return notValue(evaluateRow(tree[1], row))
+    if node == 'and':
+        left = evaluateRow(tree[1], row)
+        if left is False:
+            return False
+        return andValues(left, evaluateRow(tree[2], row))
+    if node == 'or':
+        left = evaluateRow(tree[1], row)
+        if left is True:
+            return True
+        return orValues(left, evaluateRow(tree[2], row))
+
+    raise ValueError("Unknown where clause node " + str(node))
+
+#the column evaluator works on operands, each one of
+#  ('constant', value)
+#  ('numbers', values, nulls)        numpy arrays from a number column
+#  ('codes', codes, distinctValues)  a dictionary encoded text column, code -1 is NULL
+#  ('objects', values)               a list of values, None for NULL
+#and conditions come back as a pair of numpy masks (true, false), a row in neither is unknown
+
+def getColumnOperand(column):
+    """returns the operand for a FeatureTable column without copying its data"""
+    typeName = type(column).__name__
+
+    if typeName == 'NumberColumn':
+        values = np.frombuffer(column.values, dtype=np.dtype(column.typeCode)) if len(column.values) else np.zeros(0, dtype=np.dtype(column.typeCode))
+        nulls = np.frombuffer(column.nulls, dtype=np.uint8).astype(bool) if column.nulls is not None else np.zeros(len(values), dtype=bool)
+        return ('numbers', values, nulls)
+
+    if typeName == 'TextColumn':
+        codes = np.frombuffer(column.codes, dtype=np.dtype(column.codes.typecode)) if len(column.codes) else np.zeros(0, dtype=int)
+        return ('codes', codes, column.distinctValues)
+
+    return ('objects', column.toList())
+
+def toObjects(operand, rowCount):
+    """returns an operand as a list of values"""
+    kind = operand[0]
+    if kind == 'constant':
+        return [operand[1]] * rowCount
+    if kind == 'numbers':
+        values = operand[1].tolist()
+        return [None if isNull else value for value, isNull in zip(values, operand[2].tolist())]
+    if kind == 'codes':
+        distinctValues = operand[2]
+        return [None if code < 0 else distinctValues[code] for code in operand[1].tolist()]
+    return operand[1]
+
+def toMasks(results):
+    """turns a list of True/False/None into the (true, false) masks"""
+    return (np.fromiter((result is True for result in results), dtype=bool, count=len(results)),
+            np.fromiter((result is False for result in results), dtype=bool, count=len(results)))
+
+def applyPredicate(operand, predicate, rowCount):
+    """works out a single value predicate over an operand, once per distinct value where the column allows"""
+    kind = operand[0]
+
+    if kind == 'constant':
+        result = predicate(operand[1])
+        return np.full(rowCount, result is True), np.full(rowCount, result is False)
+
+    if kind == 'codes':
+        codes, distinctValues = operand[1], operand[2]
+        distinctTrue, distinctFalse = toMasks([predicate(value) for value in distinctValues] + [predicate(None)])
+        #code -1 (NULL) picks the extra last entry
+        positions = np.where(codes < 0, len(distinctValues), codes)
+        return distinctTrue[positions], distinctFalse[positions]
+
+    return toMasks([predicate(value) for value in toObjects(operand, rowCount)])
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+NUMPY_COMPARISONS = {'=': np.equal, '<>': np.not_equal, '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal} if np is not None else {}
+
+class ColumnEvaluator():
+
+    def __init__(self, table):
+        self.table = table
+        self.rowCount = len(table)
+        self.columns = {name.lower(): column for name, column in zip(table.fieldNames, table.columns)}
+
+    def value(self, tree):
+        """returns the operand for a value expression"""
+        node = tree[0]
+
+        if node == 'constant':
+            return tree
+
+        if node == 'field':
+            column = self.columns.get(tree[1].lower())
+            if column is None:
+                raise ValueError("Field " + tree[1] + " isnt in the table")
+            return getColumnOperand(column)
+
+        if node == 'function':
+            operand = self.value(tree[2])
+            if operand[0] == 'constant':
+                return ('constant', applyFunction(tree[1], operand[1]))
+            if operand[0] == 'codes':
+                #applied once per distinct value, the codes stay the same
+                return ('codes', operand[1], [applyFunction(tree[1], value) for value in operand[2]])
+            return ('objects', [applyFunction(tree[1], value) for value in toObjects(operand, self.rowCount)])
+
+        if node == 'arithmetic':
+            left = self.value(tree[2])
+            right = self.value(tree[3])
+            operator = tree[1]
+
+            if left[0] == 'constant' and right[0] == 'constant':
+                return ('constant', arithmeticValues(operator, left[1], right[1]))
+
+            #number columns and number constants are worked out as arrays, a NULL on either side gives NULL
+            if all(operand[0] == 'numbers' or (operand[0] == 'constant' and isNumber(operand[1])) for operand in (left, right)):
+                leftValues, leftNulls = (left[1], left[2]) if left[0] == 'numbers' else (left[1], False)
+                rightValues, rightNulls = (right[1], right[2]) if right[0] == 'numbers' else (right[1], False)
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    if operator == '+':
+                        values = np.add(leftValues, rightValues)
+                    elif operator == '-':
+                        values = np.subtract(leftValues, rightValues)
+                    elif operator == '*':
+                        values = np.multiply(leftValues, rightValues)
+                    else:
+                        values = np.true_divide(leftValues, rightValues)
+
+                #dividing by zero gives NULL, the same as one row at a time
+                nulls = np.logical_or(leftNulls, rightNulls)
+                if operator == '/':
+                    nulls = nulls | np.equal(rightValues, 0)
+                return ('numbers', values, np.broadcast_to(nulls, values.shape).copy())
+
+            leftValues = toObjects(left, self.rowCount)
+            rightValues = toObjects(right, self.rowCount)
+            return ('objects', [arithmeticValues(operator, a, b) for a, b in zip(leftValues, rightValues)])
+
+        #a condition used as a value
+        true, false = self.condition(tree)
+        return ('objects', [True if isTrue else (False if isFalse else None) for isTrue, isFalse in zip(true.tolist(), false.tolist())])
+
+    def condition(self, tree):
+        """returns the (true, false) masks for a condition"""
+        node = tree[0]
+        rowCount = self.rowCount
+
+        if node == 'and':
+            leftTrue, leftFalse = self.condition(tree[1])
+            rightTrue, rightFalse = self.condition(tree[2])
+            return leftTrue & rightTrue, leftFalse | rightFalse
+
+        if node == 'or':
+            leftTrue, leftFalse = self.condition(tree[1])
+            rightTrue, rightFalse = self.condition(tree[2])
+            return leftTrue | rightTrue, leftFalse & rightFalse
+
+        if node == 'not':
+            true, false = self.condition(tree[1])
+            return false, true
+
+        if node == 'isnull':
+            operand = self.value(tree[1])
+            if operand[0] == 'numbers':
+                true = operand[2].copy()
+            else:
+                true, false = applyPredicate(operand, lambda value: value is None, rowCount)
+            return (~true, true) if tree[2] else (true, ~true)
+
+        if node == 'compare':
+            operator = tree[1]
+            left = self.value(tree[2])
+            right = self.value(tree[3])
+
+            #numbers against numbers are compared as arrays
+            if all(operand[0] == 'numbers' or (operand[0] == 'constant' and isNumber(operand[1])) for operand in (left, right)) and 'numbers' in (left[0], right[0]):
+                leftValues, leftNulls = (left[1], left[2]) if left[0] == 'numbers' else (left[1], False)
+                rightValues, rightNulls = (right[1], right[2]) if right[0] == 'numbers' else (right[1], False)
+
+                known = ~np.broadcast_to(np.logical_or(leftNulls, rightNulls), (rowCount,))
+                with np.errstate(invalid='ignore'):
+                    result = NUMPY_COMPARISONS[operator](leftValues, rightValues)
+                return result & known, ~result & known
+
+            #a column against a constant is tested once per distinct value (or value)
+            if right[0] == 'constant':
+                constant = right[1]
+                return applyPredicate(left, lambda value: compareValues(operator, value, constant), rowCount)
+            if left[0] == 'constant':
+                constant = left[1]
+                return applyPredicate(right, lambda value: compareValues(operator, constant, value), rowCount)
+
+            return toMasks([compareValues(operator, a, b) for a, b in zip(toObjects(left, rowCount), toObjects(right, rowCount))])
+
+        if node == 'in':
+            operand = self.value(tree[1])
+            values = [self.value(value) for value in tree[2]]
+
+            if all(value[0] == 'constant' for value in values):
+                constants = [value[1] for value in values]
+
+                if operand[0] == 'numbers' and constants and all(isNumber(constant) for constant in constants):
+                    result = np.isin(operand[1], constants)
+                    true, false = result & ~operand[2], ~result & ~operand[2]
+                else:
+                    constantSet = set(constant for constant in constants if constant is not None)
+                    hasNull = None in constants
+
+                    def predicate(value):
+                        if value is None:
+                            return None
+                        try:
+                            if value in constantSet:
+                                return True
+                        except TypeError:
+                            return None
+                        return None if hasNull else False
+
+                    true, false = applyPredicate(operand, predicate, rowCount)
+            else:
+                columns = [toObjects(value, rowCount) for value in values]
+                true, false = toMasks([inValues(value, [column[i] for column in columns])
+                                       for i, value in enumerate(toObjects(operand, rowCount))])
+
+            return (false, true) if tree[3] else (true, false)
+
+        if node == 'like':
+            operand = self.value(tree[1])
+            pattern = self.value(tree[2])
+
+            if pattern[0] == 'constant':
+                regex = getLikeRegex(tree, pattern[1])
+                true, false = applyPredicate(operand, lambda value: likeMatch(value, regex), rowCount)
+            else:
+                true, false = toMasks([likeMatch(value, getLikeRegex(tree, patternValue))
+                                       for value, patternValue in zip(toObjects(operand, rowCount), toObjects(pattern, rowCount))])
+
+            return (false, true) if tree[4] else (true, false)
+
+        if node == 'between':
+            lowTrue, lowFalse = self.condition(('compare', '>=', tree[1], tree[2]))
+            highTrue, highFalse = self.condition(('compare', '<=', tree[1], tree[3]))
+            true, false = lowTrue & highTrue, lowFalse | highFalse
+            return (false, true) if tree[4] else (true, false)
+
+        #a value used as a condition, e.g. a TRUE constant
+        operand = self.value(tree)
+        return applyPredicate(operand, lambda value: None if value is None else bool(value), rowCount)
+
+def getConjuncts(tree):
+    """returns the conditions joined by the top level ANDs"""
+    if tree[0] == 'and':
+        return getConjuncts(tree[1]) + getConjuncts(tree[2])
+    return [tree]
+
+def getRowAttributes(table, i):
+    """one row of a FeatureTable as a dictionary with lower case field names, without its geometry"""
+    return {name.lower(): column.get(i) for name, column in zip(table.fieldNames, table.columns)}
+
+def getAttributes(row):
+    """the attributes of an ESRI JSON feature, a geoJSON feature, or a plain attribute dictionary, with lower case names"""
+    if isinstance(row.get('attributes'), dict):
+        row = row['attributes']
+    elif isinstance(row.get('properties'), dict):
+        row = row['properties']
+    return {str(name).lower(): value for name, value in row.items()}
+
+#This class keeps the rows of one FeatureTable field by value, so an equality or
+#range test on it doesnt need to look at every row
+
+class FieldIndex():
+
+    def __init__(self, table, fieldName):
+        self.fieldName = fieldName
+        self.positions = {}
+
+        values = table.columns[[name.lower() for name in table.fieldNames].index(fieldName.lower())].toList()
+        for i, value in enumerate(values):
+            if value is not None:
+                self.positions.setdefault(value, []).append(i)
+
+        #the sorted values for ranges, only when they can all be compared with each other
+        try:
+            self.sortedValues = sorted(self.positions)
+        except TypeError:
+            self.sortedValues = None
+
+    def lookup(self, tree):
+        """returns the set of rows a condition on this field could be true for, None if the index cant answer it"""
+        node = tree[0]
+
+        if node == 'compare' and tree[2][0] == 'field' and tree[2][1].lower() == self.fieldName.lower() and tree[3][0] == 'constant':
+            operator, value = tree[1], tree[3][1]
+            if value is None:
+                return set()
+            if operator == '=':
+                return set(self.positions.get(value, ()))
+            if operator == '<>' or self.sortedValues is None:
+                return None
+
+            try:
+                if operator == '<':
+                    keys = self.sortedValues[:bisect_left(self.sortedValues, value)]
+                elif operator == '<=':
+                    keys = self.sortedValues[:bisect_right(self.sortedValues, value)]
+                elif operator == '>':
+                    keys = self.sortedValues[bisect_right(self.sortedValues, value):]
+                else:
+                    keys = self.sortedValues[bisect_left(self.sortedValues, value):]
+            except TypeError:
+                return None
+
+            return set(position for key in keys for position in self.positions[key])
+
+        if node == 'in' and not tree[3] and tree[1][0] == 'field' and tree[1][1].lower() == self.fieldName.lower() and all(value[0] == 'constant' for value in tree[2]):
+            positions = set()
+            for value in tree[2]:
+                try:
+                    positions.update(self.positions.get(value[1], ()))
+                except TypeError:
+                    return None
+            return positions
+
+        if node == 'between' and not tree[4] and tree[1][0] == 'field' and tree[1][1].lower() == self.fieldName.lower():
+            low = self.lookup(('compare', '>=', tree[1], tree[2]))
+            high = self.lookup(('compare', '<=', tree[1], tree[3]))
+            if low is None or high is None:
+                return None
+            return low & high
+
+        return None
+
+#This class is a parsed where clause, ready to be tested against local features
+
+class WhereClause():
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = parseWhere(text)
+
+    def matches(self, row):
+        """checks one feature (ESRI JSON, geoJSON, or an attribute dictionary), True only if the clause is true for it"""
+        return evaluateRow(self.tree, getAttributes(row)) is True
+
+    def filter(self, rows):
+        """returns the features in a list that match"""
+        return [row for row in rows if self.matches(row)]
+
+    def filterTable(self, table, indexes=None):
+        """returns the positions of the FeatureTable rows that match, indexes is a list of FieldIndex for the table"""
+
+        #an index on a field in the top level AND narrows the rows down, then only those rows are checked
+        candidates = None
+        for condition in getConjuncts(self.tree):
+            for index in indexes or []:
+                positions = index.lookup(condition)
+                if positions is not None:
+                    candidates = positions if candidates is None else candidates & positions
+                    break
+
+        if candidates is not None:
+            return [i for i in sorted(candidates) if evaluateRow(self.tree, getRowAttributes(table, i)) is True]
+
+        if np is None:
+            return [i for i in range(len(table)) if evaluateRow(self.tree, getRowAttributes(table, i)) is True]
+
+        true, false = ColumnEvaluator(table).condition(self.tree)
+        return np.flatnonzero(true).tolist()
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None #not on Windows, the peak memory column is left empty there
+
+from .context import gtatr as gt, esrigeometry, RESTDownloader
+from .mockserver import MockFeatureService, MockLayer
+
+#This script times the RESTConnector methods and RESTDownloader paths against the
+#mock feature service in mockserver.py. Run it from the repository folder:
+#
+#   python -m tests.benchmark                               all scenarios
+#   python -m tests.benchmark --scenarios getFeatures,json  some of them
+#   python -m tests.benchmark --save baseline.json          keep the numbers
+#   python -m tests.benchmark --compare baseline.json       exit 1 on a regression
+#   python -m tests.benchmark --geometry                    numpy against pure Python polygon conversion
+#
+#Each scenario runs in its own process, so its peak memory is its own, while the
+#service runs in this one. It reports features per second, the 50th and 99th
+#percentile query latency as the client saw it (time to the response, the body
+#of a streamed response is read after that), the query requests made, the bytes
+#the service sent and the peak resident memory of the scenario's process.
+
+#the service's layers, points first then polygons
+POINTS = 0
+POLYGONS = 1
+
+#the area getFeaturesFromServiceByGeometry asks for, about half the layer
+QUERY_ENVELOPE = {'xmin': -120.0, 'ymin': 30.0, 'xmax': -100.0, 'ymax': 45.0}
+
+#the scenarios each return the number of features they got, they are given the connector, the layer's URL,
+#the service's layer URLs (for the batch) and a folder for their output
+
+def countFeatures(RConnect, layerURL, layerURLs, workDirectory):
+    return RConnect.getFeatureCount(layerURL + "/query?", "1=1")
+
+def readObjectIDs(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getObjectIDs(layerURL + "/query?", "1=1"))
+
+def readFeatures(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getFeatures(layerURL + "/query?", "*", "1=1"))
+
+def readTableData(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getTableData(layerURL + "/query?", "*", "1=1"))
+
+def readBatches(strategy):
+    def readWithStrategy(RConnect, layerURL, layerURLs, workDirectory):
+        return sum(len(features) for features in RConnect.iterFeatureBatches(layerURL + "/query?", "*", "1=1", returnGeometry=True, strategy=strategy))
+    return readWithStrategy
+
+def readFeatureTable(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getFeatureTable(layerURL + "/query?", "*", "1=1", returnGeometry=True))
+
+def readFeaturesWithGeometry(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getFeaturesWithGeometry(layerURL + "/query?", "*", "1=1"))
+
+def readPBF(RConnect, layerURL, layerURLs, workDirectory):
+    RConnect.setPBF(True)
+    return readFeaturesWithGeometry(RConnect, layerURL, layerURLs, workDirectory)
+
+def readStreamedJSON(RConnect, layerURL, layerURLs, workDirectory):
+    RConnect.setJSONDecoding(incremental=True)
+    return readFeaturesWithGeometry(RConnect, layerURL, layerURLs, workDirectory)
+
+def readDisplayProfile(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getFeaturesWithGeometry(layerURL + "/query?", "*", "1=1", profile="display"))
+
+def readGeoJSON(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getFeaturesAsGeoJSON(layerURL + "/query?", "*", "1=1")["features"])
+
+def readByGeometry(RConnect, layerURL, layerURLs, workDirectory):
+    return len(RConnect.getFeaturesFromServiceByGeometry(layerURL + "/query?", "1=1", QUERY_ENVELOPE, "esriGeometryEnvelope",
+                                                         "esriSpatialRelIntersects", "*"))
+
+def downloadGeoJSON(processes=0):
+    def download(RConnect, layerURL, layerURLs, workDirectory):
+        return RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, layerURL, "1=1", "*", os.path.join(workDirectory, "out.geojson"), processes=processes)
+    return download
+
+def downloadCSV(RConnect, layerURL, layerURLs, workDirectory):
+    return RESTDownloader.downloadFeaturesAsCSV(RConnect, layerURL, "1=1", "*", os.path.join(workDirectory, "out.csv"))
+
+def syncGeoJSON(RConnect, layerURL, layerURLs, workDirectory):
+    #the first run downloads everything, the second finds nothing changed
+    outName = os.path.join(workDirectory, "out.geojson")
+    RESTDownloader.syncFeaturesAsGeoJSON(RConnect, layerURL, "1=1", "*", outName)
+    return RESTDownloader.syncFeaturesAsGeoJSON(RConnect, layerURL, "1=1", "*", outName)["total"]
+
+def downloadBatch(RConnect, layerURL, layerURLs, workDirectory):
+    inputcsv = os.path.join(workDirectory, "maplinks.csv")
+    with open(inputcsv, 'w') as csvFile:
+        csvFile.write("OutName,MapServerLink\n")
+        for i, URL in enumerate(layerURLs):
+            csvFile.write(os.path.join(workDirectory, "layer" + str(i)) + "," + URL + "\n")
+
+    return sum(row["featureCount"] or 0 for row in RESTDownloader.batchDownloadFromCSV(inputcsv))
+
+#name: (layer, scenario)
+SCENARIOS = {'getFeatureCount': (POINTS, countFeatures),
+             'getObjectIDs': (POINTS, readObjectIDs),
+             'getFeatures': (POINTS, readFeatures),
+             'getTableData': (POINTS, readTableData),
+             'iterFeatureBatches-oids': (POINTS, readBatches('oids')),
+             'iterFeatureBatches-oidRanges': (POINTS, readBatches('oidRanges')),
+             'iterFeatureBatches-pages': (POINTS, readBatches('pages')),
+             'getFeatureTable': (POINTS, readFeatureTable),
+             'getFeaturesAsGeoJSON': (POINTS, readGeoJSON),
+             'getFeaturesFromServiceByGeometry': (POINTS, readByGeometry),
+             'downloadFeaturesAsCSV': (POINTS, downloadCSV),
+             'syncFeaturesAsGeoJSON': (POINTS, syncGeoJSON),
+             'getFeaturesWithGeometry': (POLYGONS, readFeaturesWithGeometry),
+             'pbf': (POLYGONS, readPBF),
+             'streamedJSON': (POLYGONS, readStreamedJSON),
+             'displayProfile': (POLYGONS, readDisplayProfile),
+             'downloadFeaturesAsGeoJSON': (POLYGONS, downloadGeoJSON()),
+             'downloadFeaturesAsGeoJSON-processes': (POLYGONS, downloadGeoJSON(processes=2)),
+             'batchDownloadFromCSV': (POINTS, downloadBatch)}
+
+#what is compared against a baseline, and which way is worse
+METRICS = [('featuresPerSecond', 'lower'), ('peakRSSMB', 'higher'), ('bytesSent', 'higher'), ('queries', 'higher')]
+
+#the geometry comparison converts these polygons, the States file copied a few times and a made up layer with many holes
+STATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'States.geojson')
+
+def makeHoleyPolygons(count=200, outerRings=6, holes=12):
+    """polygons of several round outer rings, each with a ring of small holes in it"""
+    def circle(x, y, radius, vertices, clockwise):
+        ring = [[x + radius * math.cos(2 * math.pi * i / vertices), y + radius * math.sin(2 * math.pi * i / vertices)] for i in range(vertices)]
+        if clockwise:
+            ring.reverse()
+        return ring + [list(ring[0])]
+
+    geometries = []
+    for i in range(count):
+        rings = []
+        for j in range(outerRings):
+            rings.append(circle(j * 10, i, 4, 200, True))
+            rings.extend(circle(j * 10 + 2.5 * math.cos(k), i + 2.5 * math.sin(k), 0.5, 20, False) for k in range(holes))
+        geometries.append({'rings': rings})
+
+    return geometries
+
+def compareGeometryEngines(copies=20, repeats=5):
+    """times esrigeometry's numpy GeometryArray against converting one geometry at a time, returns {name: result}"""
+    with open(STATES_PATH) as statesFile:
+        states = json.load(statesFile)
+
+    #the geoJSON rings are clockwise, as ESRI outer rings are
+    stateRings = [{'rings': [ring for polygon in ([feature['geometry']['coordinates']] if feature['geometry']['type'] == 'Polygon'
+                                                    else feature['geometry']['coordinates']) for ring in polygon]}
+                  for feature in states['features']]
+
+    def best(convert, geometries):
+        seconds = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            convert(geometries)
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    results = {}
+    for name, geometries in [('States x' + str(copies), stateRings * copies), ('holes', makeHoleyPolygons())]:
+        python = best(lambda geometries: [esrigeometry.toGeoJSONGeometry(geometry) for geometry in geometries], geometries)
+        numpy = best(lambda geometries: esrigeometry.GeometryArray(geometries).toGeoJSON(), geometries) if esrigeometry.np is not None else None
+        results[name] = {'vertices': sum(len(ring) for geometry in geometries for ring in geometry['rings']),
+                         'python': python,
+                         'numpy': numpy,
+                         'speedup': python / numpy if numpy else None}
+
+    return results
+
+def printGeometryResults(results):
+    print("polygons".ljust(14) + "".join(title.rjust(12) for title in ('vertices', 'python s', 'numpy s', 'speedup')))
+    for name, result in results.items():
+        print(name.ljust(14) + "".join(formatValue(result[key], 3).rjust(12) for key in ('vertices', 'python', 'numpy', 'speedup')))
+
+def percentile(values, share):
+    """the nearest rank percentile of a list, None if it is empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(share * len(values))) - 1)]
+
+def getPeakRSS():
+    """the peak resident memory of this process in MB, None where it cant be read"""
+
+    #getrusage carries the parent's peak over into a new process on Linux, the high water mark of its own memory doesnt
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux gives kilobytes, macOS bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def measureScenario(name, baseURL, layerURLs, tokenURL=None, workers=4, verbose=False):
+    """runs one scenario in this process, returns its timings"""
+    layer, scenario = SCENARIOS[name]
+
+    #time every query the scenario sends, on every connector (the batch download makes its own)
+    latencies = []
+    sendRequest = gt.RESTConnector.sendRequest
+    def timedRequest(self, URL, HEADERS, PARAMS, method='GET', stream=False):
+        requestStart = time.perf_counter()
+        r = sendRequest(self, URL, HEADERS, PARAMS, method=method, stream=stream)
+        if URL.rstrip('?').endswith('/query'):
+            latencies.append(time.perf_counter() - requestStart)
+        return r
+
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+
+        gt.RESTConnector.sendRequest = timedRequest
+        stack.callback(setattr, gt.RESTConnector, 'sendRequest', sendRequest)
+
+        RConnect = gt.RESTConnector(baseURL, maxWorkers=workers)
+        if tokenURL:
+            RConnect.getRESTToken("benchmark", "benchmark", tokenURL)
+        else:
+            RConnect.setToken("")
+
+        workDirectory = stack.enter_context(tempfile.TemporaryDirectory())
+        start = time.perf_counter()
+        featureCount = scenario(RConnect, layerURLs[layer], layerURLs, workDirectory)
+        seconds = time.perf_counter() - start
+        RConnect.close()
+
+    return {'features': featureCount,
+            'seconds': seconds,
+            'featuresPerSecond': featureCount / seconds if featureCount and seconds else 0.0,
+            'p50ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p99ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'peakRSSMB': getPeakRSS()}
+
+def runScenario(name, baseURL, layerURLs, tokenURL, workers, verbose, results):
+    """the scenario process, puts its timings (or the error) on the results queue"""
+    try:
+        results.put(measureScenario(name, baseURL, layerURLs, tokenURL, workers, verbose))
+    except Exception as ex:
+        results.put({'error': type(ex).__name__ + ": " + str(ex)})
+
+def runBenchmarks(names=None, featureCount=20000, vertices=64, maxRecordCount=2000, latency=0.0, errorRate=0.0,
+                  tokenExpiration=None, workers=4, separateProcesses=True, verbose=False):
+    """starts the mock service and runs the scenarios one after the other, returns {name: result}"""
+    names = names or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise ValueError("Unknown scenarios " + ", ".join(unknown) + ", expected some of " + ", ".join(SCENARIOS))
+
+    #polygons are much heavier, so there are fewer of them
+    layers = [MockLayer(featureCount, 'point', maxRecordCount=maxRecordCount, latency=latency, errorRate=errorRate),
+              MockLayer(max(1, featureCount // 4), 'polygon', vertices=vertices, maxRecordCount=maxRecordCount, latency=latency, errorRate=errorRate)]
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    with MockFeatureService(layers, tokenExpiration=tokenExpiration) as service:
+        layerURLs = [service.layerURL(i) for i in range(len(layers))]
+        tokenURL = service.tokenURL if tokenExpiration is not None else None
+
+        for name in names:
+            service.resetStatistics()
+
+            if separateProcesses:
+                queue = context.Queue()
+                process = context.Process(target=runScenario, args=(name, service.baseURL, layerURLs, tokenURL, workers, verbose, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+            else:
+                result = measureScenario(name, service.baseURL, layerURLs, tokenURL, workers, verbose)
+
+            result.update(service.getStatistics())
+            results[name] = result
+
+    return results
+
+def formatValue(value, digits=1):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return str(round(value, digits))
+    return str(value)
+
+def printResults(results):
+    columns = [('features', 'features'), ('seconds', 'seconds'), ('featuresPerSecond', 'features/s'), ('p50ms', 'p50 ms'),
+               ('p99ms', 'p99 ms'), ('queries', 'queries'), ('bytesSent', 'MB sent'), ('peakRSSMB', 'peak RSS MB')]
+
+    nameWidth = max(len(name) for name in results) + 2
+    print("scenario".ljust(nameWidth) + "".join(title.rjust(12) for key, title in columns))
+
+    for name, result in results.items():
+        if 'error' in result:
+            print(name.ljust(nameWidth) + "failed - " + result['error'])
+            continue
+
+        values = []
+        for key, title in columns:
+            value = result.get(key)
+            if key == 'bytesSent':
+                value = value / (1024.0 * 1024.0)
+            values.append(formatValue(value, 2 if key in ('seconds', 'bytesSent') else 1))
+        print(name.ljust(nameWidth) + "".join(value.rjust(12) for value in values))
+
+def compareResults(results, baseline, tolerance=0.2):
+    """returns a line for every metric that got more than tolerance worse than the baseline"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+
+        if 'error' in result:
+            regressions.append(name + " failed - " + result['error'])
+            continue
+
+        for metric, worse in METRICS:
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+
+            change = (new - old) / float(old)
+            if (worse == 'lower' and change < -tolerance) or (worse == 'higher' and change > tolerance):
+                regressions.append(name + " " + metric + " " + formatValue(float(old), 2) + " -> " + formatValue(float(new), 2) +
+                                   " (" + ("+" if change > 0 else "") + str(round(change * 100)) + "%)")
+
+    return regressions
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Times GTATR against a local mock ArcGIS feature service")
+    parser.add_argument("--scenarios", help="comma separated scenario names, all of them by default: " + ", ".join(SCENARIOS))
+    parser.add_argument("--features", type=int, default=20000, help="point features (the polygon layer gets a quarter as many)")
+    parser.add_argument("--vertices", type=int, default=64, help="vertices in each polygon")
+    parser.add_argument("--max-record-count", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the service waits before each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the queries that fail and have to be retried")
+    parser.add_argument("--token-expiration", type=float, help="seconds each token lasts, the layers need a token if this is given")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--in-process", action="store_true", help="run the scenarios in this process, the peak memory is then the whole run's")
+    parser.add_argument("--verbose", action="store_true", help="show the library's progress messages")
+    parser.add_argument("--save", help="write the results to this .json file")
+    parser.add_argument("--compare", help="a .json file from --save to check the results against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than the baseline a metric can get, 0.2 is 20%%")
+    parser.add_argument("--geometry", action="store_true", help="only time the numpy polygon conversion against pure Python")
+    options = parser.parse_args(arguments)
+
+    if options.geometry:
+        printGeometryResults(compareGeometryEngines())
+        return 0
+
+    names = [name.strip() for name in options.scenarios.split(",")] if options.scenarios else None
+    settings = {'featureCount': options.features, 'vertices': options.vertices, 'maxRecordCount': options.max_record_count,
+                'latency': options.latency, 'errorRate': options.error_rate, 'tokenExpiration': options.token_expiration,
+                'workers': options.workers}
+
+    results = runBenchmarks(names, separateProcesses=not options.in_process, verbose=options.verbose, **settings)
+    printResults(results)
+
+    if options.save:
+        with open(options.save, 'w') as saveFile:
+            json.dump({'settings': settings, 'results': results}, saveFile, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+
+        if baseline.get('settings') != settings:
+            print("Warning - the baseline was run with different settings: " + json.dumps(baseline.get('settings')))
+
+        regressions = compareResults(results, baseline['results'], options.tolerance)
+        if regressions:
+            print("Regressions against " + options.compare + ":")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+
+        print("No regressions against " + options.compare)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,17 @@
 
 import sys
 import os
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'GTATR')))
 
-import sample
+#the GTATR modules import each other by name, so their folder goes on the path
+import gtatr
+import esrigeometry
+import esrijson
+import esripbf
+import featuretable
+import whereclause
+import spatialindex
+import RESTDownloader
+import restcache
+import restsync
+import restspool
@@ -0,0 +1,855 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#This module is a stand in for an ArcGIS feature service, for the tests and the
+#benchmarks. It serves generated point, line or polygon layers from a local
+#HTTP server with the parts of the REST API the library uses: service and layer
+#info, queries (where, outFields, paging, object IDs, counts, extents,
+#statistics, spatial filters, json/geojson/pbf), extractChanges and token
+#generation. Latency, a maxRecordCount, random errors and token expiry can be
+#set per service/layer, and it counts the requests and bytes it sends.
+#
+#It doesnt use any of the GTATR modules, where clauses and spatial filters are
+#answered by the small evaluators below, so a bug in the library cant hide
+#itself by being in the mock as well. Anything outside what they understand is
+#answered with a 400 error, like a server would.
+
+GEOMETRY_TYPES = {'point': 'esriGeometryPoint',
+                  'polyline': 'esriGeometryPolyline',
+                  'polygon': 'esriGeometryPolygon'}
+
+#the extent the generated features are spread over
+EXTENT = {'xmin': -120.0, 'ymin': 30.0, 'xmax': -80.0, 'ymax': 45.0, 'spatialReference': {'wkid': 4326}}
+
+FIELDS = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID', 'alias': 'OBJECTID'},
+          {'name': 'NAME', 'type': 'esriFieldTypeString', 'alias': 'NAME', 'length': 50},
+          {'name': 'VALUE', 'type': 'esriFieldTypeDouble', 'alias': 'VALUE'},
+          {'name': 'CATEGORY', 'type': 'esriFieldTypeString', 'alias': 'CATEGORY', 'length': 10},
+          {'name': 'EDITED', 'type': 'esriFieldTypeDate', 'alias': 'EDITED'}]
+
+#This class is one generated layer, the features are made from a seed so every run gets the same ones
+
+class MockLayer():
+
+    def __init__(self, featureCount=1000, geometryType='point', vertices=16, maxRecordCount=1000, latency=0.0, errorRate=0.0,
+                 supportsPagination=True, supportsStatistics=True, supportsPBF=True, seed=1):
+        """geometryType is point, polyline or polygon, vertices the number of points in each line or polygon ring,
+        latency the seconds every request waits before it is answered and errorRate the share of queries that fail"""
+        self.geometryType = geometryType
+        self.vertices = vertices
+        self.maxRecordCount = maxRecordCount
+        self.latency = latency
+        self.errorRate = errorRate
+        self.supportsPagination = supportsPagination
+        self.supportsStatistics = supportsStatistics
+        self.supportsPBF = supportsPBF
+        self.errorRandom = random.Random(seed + 1)
+        self.generator = random.Random(seed)
+        self.lock = threading.Lock()
+
+        #change tracking, every edit bumps serverGen and the features remember the generation they were added
+        #and last changed in, deletes are kept as OID: generation
+        self.serverGen = 1
+        self.generations = {}
+        self.deleted = {}
+
+        self.features = []
+        self.addFeatures(featureCount, bumpGen=False)
+
+    def addFeatures(self, count, bumpGen=True):
+        """adds generated features after the last object ID, returns their object IDs"""
+        with self.lock:
+            if bumpGen:
+                self.serverGen += 1
+
+            firstOID = max([feature['attributes']['OBJECTID'] for feature in self.features] + list(self.deleted) + [0]) + 1
+            features = list(self.features)
+            for OID in range(firstOID, firstOID + count):
+                x = EXTENT['xmin'] + self.generator.random() * (EXTENT['xmax'] - EXTENT['xmin'])
+                y = EXTENT['ymin'] + self.generator.random() * (EXTENT['ymax'] - EXTENT['ymin'])
+                attributes = {'OBJECTID': OID,
+                              'NAME': 'Feature ' + str(OID),
+                              'VALUE': round(self.generator.random() * 1000, 3),
+                              'CATEGORY': 'ABC'[OID % 3],
+                              'EDITED': 1600000000000 + OID * 1000}
+                features.append({'attributes': attributes, 'geometry': makeGeometry(self.geometryType, x, y, self.vertices)})
+                self.generations[OID] = (self.serverGen, self.serverGen)
+
+            self.features = features #swapped in whole, so a query running now keeps the list it started with
+
+        return list(range(firstOID, firstOID + count))
+
+    def getInfo(self):
+        """the layer's JSON description, what a request to the layer URL returns"""
+        queryFormats = 'JSON, geoJSON' + (', PBF' if self.supportsPBF else '')
+        return {'currentVersion': 11.1,
+                'id': 0,
+                'name': 'Mock ' + self.geometryType + 's',
+                'type': 'Feature Layer',
+                'geometryType': GEOMETRY_TYPES[self.geometryType],
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': self.maxRecordCount,
+                'supportedQueryFormats': queryFormats,
+                'supportsStatistics': self.supportsStatistics,
+                'advancedQueryCapabilities': {'supportsPagination': self.supportsPagination,
+                                              'supportsStatistics': self.supportsStatistics,
+                                              'supportsReturningGeometryCentroid': False},
+                'extent': EXTENT,
+                'editFieldsInfo': {'editDateField': 'EDITED'},
+                'fields': FIELDS}
+
+    def editFeatures(self, OIDs, editTime=None):
+        """changes the VALUE of the features and stamps them as edited, for the sync code"""
+        editTime = int((editTime or time.time()) * 1000)
+        with self.lock:
+            self.serverGen += 1
+            features = []
+            for feature in self.features:
+                OID = feature['attributes']['OBJECTID']
+                if OID in OIDs:
+                    attributes = dict(feature['attributes'], VALUE=feature['attributes']['VALUE'] + 1, EDITED=editTime)
+                    feature = dict(feature, attributes=attributes)
+                    self.generations[OID] = (self.generations[OID][0], self.serverGen)
+                features.append(feature)
+            self.features = features
+
+    def deleteFeatures(self, OIDs):
+        """removes features from the layer"""
+        with self.lock:
+            self.serverGen += 1
+            for feature in self.features:
+                if feature['attributes']['OBJECTID'] in OIDs:
+                    self.deleted[feature['attributes']['OBJECTID']] = self.serverGen
+            self.features = [feature for feature in self.features if feature['attributes']['OBJECTID'] not in OIDs]
+
+    def selectFeatures(self, PARAMS):
+        """the features a query's where clause and spatial filter pick out, in OID order"""
+        with self.lock:
+            features = self.features
+
+        where = (PARAMS.get('where') or '1=1').strip()
+        if where != '1=1':
+            predicate = parseWhere(where)
+            features = [feature for feature in features if predicate(feature['attributes']) is True]
+
+        if PARAMS.get('geometry'):
+            queryGeometry = parseGeometry(PARAMS['geometry'])
+            relation = getSpatialRelation(PARAMS.get('spatialRel') or 'esriSpatialRelIntersects')
+            features = [feature for feature in features if relation(feature['geometry'], queryGeometry)]
+
+        return features
+
+    def extractChanges(self, where, serverGen):
+        """the adds, updates and deletes since serverGen, as the features part of an extractChanges response"""
+        with self.lock:
+            features, generations, deleted = self.features, dict(self.generations), dict(self.deleted)
+
+        predicate = parseWhere(where) if where.strip() != '1=1' else (lambda attributes: True)
+        adds, updates = [], []
+        for feature in features:
+            added, changed = generations[feature['attributes']['OBJECTID']]
+            if changed > serverGen and predicate(feature['attributes']) is True:
+                (adds if added > serverGen else updates).append(feature)
+
+        return {'adds': adds, 'updates': updates, 'deleteIds': sorted(OID for OID, gen in deleted.items() if gen > serverGen)}
+
+    def query(self, PARAMS):
+        """answers a query, returns the response dictionary"""
+        features = self.selectFeatures(PARAMS)
+        outFormat = PARAMS.get('f', 'json').lower()
+
+        if PARAMS.get('returnCountOnly') == 'true':
+            response = {'count': len(features)}
+            if PARAMS.get('returnExtentOnly') == 'true':
+                response['extent'] = getExtent(features)
+            return response
+
+        if PARAMS.get('returnExtentOnly') == 'true':
+            return {'extent': getExtent(features)}
+
+        if PARAMS.get('returnIdsOnly') == 'true':
+            return {'objectIdFieldName': 'OBJECTID', 'objectIds': [feature['attributes']['OBJECTID'] for feature in features]}
+
+        if PARAMS.get('outStatistics'):
+            return {'features': [{'attributes': getStatistics(features, json.loads(PARAMS['outStatistics']))}]}
+
+        #paging, then the transfer limit
+        offset = int(PARAMS.get('resultOffset') or 0)
+        recordCount = min(int(PARAMS.get('resultRecordCount') or self.maxRecordCount), self.maxRecordCount)
+        page = features[offset:offset + recordCount]
+        exceeded = len(features) > offset + recordCount
+
+        fieldNames = [field['name'] for field in FIELDS]
+        outFields = PARAMS.get('outFields') or '*'
+        if outFields.strip() != '*':
+            requested = [name.strip().lower() for name in outFields.split(',')]
+            fieldNames = [name for name in fieldNames if name.lower() in requested or name == 'OBJECTID']
+
+        returnGeometry = PARAMS.get('returnGeometry', 'true') == 'true'
+        precision = PARAMS.get('geometryPrecision')
+
+        results = []
+        for feature in page:
+            result = {'attributes': {name: feature['attributes'][name] for name in fieldNames}}
+            if returnGeometry:
+                result['geometry'] = roundGeometry(feature['geometry'], int(precision)) if precision else feature['geometry']
+            results.append(result)
+
+        if outFormat == 'geojson':
+            response = {'type': 'FeatureCollection',
+                        'features': [{'type': 'Feature', 'id': result['attributes']['OBJECTID'], 'geometry': toGeoJSON(result.get('geometry')),
+                                      'properties': result['attributes']} for result in results]}
+            if exceeded:
+                response['properties'] = {'exceededTransferLimit': True}
+            return response
+
+        response = {'objectIdFieldName': 'OBJECTID',
+                    'geometryType': GEOMETRY_TYPES[self.geometryType],
+                    'spatialReference': {'wkid': 4326},
+                    'fields': [field for field in FIELDS if field['name'] in fieldNames],
+                    'features': results}
+        if exceeded:
+            response['exceededTransferLimit'] = True
+        return response
+
+#This class runs the mock layers on a local HTTP server, use it with a with block
+#(or start/stop), the layer URLs are layerURL(0), layerURL(1) ...
+
+class MockFeatureService():
+
+    def __init__(self, layers, tokenExpiration=None, chunked=False):
+        """layers is a list of MockLayer, tokenExpiration the seconds a token lasts (None serves the layers without tokens),
+        chunked sends the bodies with chunked transfer encoding and no Content-Length, like a streaming server"""
+        self.layers = layers
+        self.tokenExpiration = tokenExpiration
+        self.chunked = chunked
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.resetStatistics()
+
+    def resetStatistics(self):
+        """zeros the request and byte counters"""
+        with self.lock:
+            self.requestCount = 0
+            self.queryCount = 0
+            self.errorCount = 0
+            self.tokenCount = 0
+            self.bytesSent = 0
+
+    def getStatistics(self):
+        """the counters as a dictionary"""
+        with self.lock:
+            return {'requests': self.requestCount,
+                    'queries': self.queryCount,
+                    'errors': self.errorCount,
+                    'tokens': self.tokenCount,
+                    'bytesSent': self.bytesSent}
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), makeHandler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def baseURL(self):
+        """the URL RESTConnector is made with, like https://myserver/arcgis"""
+        return 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/arcgis'
+
+    @property
+    def tokenURL(self):
+        return self.baseURL + '/tokens/generateToken'
+
+    @property
+    def serviceURL(self):
+        return self.baseURL + '/rest/services/Mock/FeatureServer'
+
+    def layerURL(self, index=0):
+        return self.serviceURL + '/' + str(index)
+
+    def expireTokens(self):
+        """makes every token handed out so far invalid"""
+        with self.lock:
+            self.tokens = {}
+
+    def generateToken(self, PARAMS):
+        with self.lock:
+            self.tokenCount += 1
+            token = 'token' + str(self.tokenCount) + '.' + hashlib.md5(str(time.time()).encode()).hexdigest()[:8]
+            expires = time.time() + self.tokenExpiration
+            self.tokens[token] = expires
+
+        return {'token': token, 'expires': int(expires * 1000), 'ssl': False}
+
+    def checkToken(self, PARAMS, headers):
+        """True if the request has a token that hasnt expired (or no token is needed)"""
+        if self.tokenExpiration is None:
+            return True
+
+        token = PARAMS.get('token') or (headers.get('Authorization') or '').replace('Bearer', '').strip()
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def getInfo(self):
+        """the service's JSON description, with the change tracking generation of each layer"""
+        return {'currentVersion': 11.1,
+                'capabilities': 'Query,ChangeTracking',
+                'layers': [{'id': i, 'name': layer.getInfo()['name']} for i, layer in enumerate(self.layers)],
+                'changeTrackingInfo': {'layerServerGens': [{'id': i, 'serverGen': layer.serverGen} for i, layer in enumerate(self.layers)]}}
+
+    def extractChanges(self, PARAMS):
+        """the changes to the layers since the generations asked about, always answered synchronously"""
+        sinceGens = {str(gen['id']): gen['serverGen'] for gen in json.loads(PARAMS.get('layerServerGens') or '[]')}
+        layerQueries = json.loads(PARAMS.get('layerQueries') or '{}')
+
+        edits, layerServerGens = [], []
+        for layerId in json.loads(PARAMS.get('layers') or '[]'):
+            layer = self.layers[int(layerId)]
+            where = (layerQueries.get(str(layerId)) or {}).get('where') or '1=1'
+            serverGen = layer.serverGen #read first, an edit made while answering turns up next time
+            edits.append({'id': int(layerId), 'features': layer.extractChanges(where, sinceGens.get(str(layerId), 0))})
+            layerServerGens.append({'id': int(layerId), 'serverGen': serverGen})
+
+        return {'layerServerGens': layerServerGens, 'edits': edits}
+
+    def handle(self, path, PARAMS, headers):
+        """answers one request, returns (status, extra headers, body)"""
+        with self.lock:
+            self.requestCount += 1
+
+        if path.endswith('/generateToken'):
+            return 200, {}, json.dumps(self.generateToken(PARAMS)).encode()
+
+        parts = path.rstrip('/').split('/')
+        isQuery = parts[-1] == 'query'
+        if isQuery:
+            parts = parts[:-1]
+
+        if not self.checkToken(PARAMS, headers):
+            return 200, {}, json.dumps({'error': {'code': 498, 'message': 'Invalid Token', 'details': []}}).encode()
+
+        try:
+            if parts[-1] == 'FeatureServer':
+                return 200, {}, json.dumps(self.getInfo()).encode()
+            if parts[-1] == 'extractChanges':
+                return 200, {}, json.dumps(self.extractChanges(PARAMS)).encode()
+            layer = self.layers[int(parts[-1])]
+        except (ValueError, IndexError, KeyError):
+            return 200, {}, json.dumps({'error': {'code': 400, 'message': 'Invalid URL', 'details': []}}).encode()
+
+        if layer.latency:
+            time.sleep(layer.latency)
+
+        if not isQuery:
+            return 200, {}, json.dumps(layer.getInfo()).encode()
+
+        with self.lock:
+            self.queryCount += 1
+
+        #the failures a busy server gives, all of them are worth trying again
+        if layer.errorRate:
+            with layer.lock:
+                failed = layer.errorRandom.random() < layer.errorRate
+                kind = layer.errorRandom.choice(['503', '429', 'json'])
+            if failed:
+                with self.lock:
+                    self.errorCount += 1
+                if kind == 'json':
+                    return 200, {}, json.dumps({'error': {'code': 500, 'message': 'Unable to complete operation.', 'details': []}}).encode()
+                return int(kind), {'Retry-After': '0'}, b''
+
+        try:
+            response = layer.query(PARAMS)
+        except ValueError as ex:
+            return 200, {}, json.dumps({'error': {'code': 400, 'message': 'Unable to perform query. ' + str(ex), 'details': []}}).encode()
+
+        if PARAMS.get('f', 'json').lower() == 'pbf' and 'features' in response and layer.supportsPBF:
+            return 200, {'Content-Type': 'application/x-protobuf'}, encodeFeatureCollection(response, GEOMETRY_TYPES[layer.geometryType])
+
+        return 200, {}, json.dumps(response).encode()
+
+def makeHandler(service):
+
+    class MockHandler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1' #keep alive, like a real server
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            URL = urlparse(self.path)
+            self.respond(URL.path, URL.query)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self.respond(urlparse(self.path).path, self.rfile.read(length).decode())
+
+        def respond(self, path, queryString):
+            PARAMS = {key: values[0] for key, values in parse_qs(queryString, keep_blank_values=True).items()}
+            try:
+                status, headers, body = service.handle(path, PARAMS, self.headers)
+            except Exception as ex:
+                status, headers, body = 500, {}, json.dumps({'error': {'code': 500, 'message': str(ex), 'details': []}}).encode()
+
+            #an unchanged response to a conditional request is a 304 with no body
+            ETag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if status == 200 and self.headers.get('If-None-Match') == ETag:
+                status, body = 304, b''
+
+            self.send_response(status)
+            self.send_header('Content-Type', headers.pop('Content-Type', 'application/json'))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('ETag', ETag)
+            if service.chunked and status != 304:
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for start in range(0, len(body), 8192):
+                    self.wfile.write(('%x' % len(body[start:start + 8192])).encode() + b'\r\n' + body[start:start + 8192] + b'\r\n')
+                self.wfile.write(b'0\r\n\r\n')
+            else:
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            with service.lock:
+                service.bytesSent += len(body)
+
+    return MockHandler
+
+def makeGeometry(geometryType, x, y, vertices):
+    """a point, a zigzag line or a closed ring (clockwise, as ESRI outer rings are) around x, y"""
+    if geometryType == 'point':
+        return {'x': x, 'y': y}
+
+    if geometryType == 'polyline':
+        return {'paths': [[[x + 0.001 * i, y + (0.001 if i % 2 else 0.0)] for i in range(vertices)]]}
+
+    ring = [[x + 0.01 * math.cos(-2 * math.pi * i / vertices), y + 0.01 * math.sin(-2 * math.pi * i / vertices)] for i in range(vertices)]
+    ring.append(list(ring[0]))
+    return {'rings': [ring]}
+
+
+#The where clauses the mock understands, a fixed set that covers what the library
+#sends: 1=1, a field or literal compared to another (= <> != > >= < <=), IN and
+#NOT IN lists, IS [NOT] NULL, AND, OR, NOT and brackets. Literals are numbers,
+#'text' ('' for a quote) and TIMESTAMP 'YYYY-MM-DD HH:MM:SS' (compared as the
+#milliseconds dates are stored in). Comparing with a null is unknown (None),
+#and only the features the clause is True for are selected.
+
+WHERE_TOKEN = re.compile(r"\s*(?:(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|('(?:[^']|'')*')|([A-Za-z_][A-Za-z0-9_]*)|(<>|!=|>=|<=|=|<|>|\(|\)|,))")
+
+COMPARISONS = {'=': lambda a, b: a == b, '<>': lambda a, b: a != b, '!=': lambda a, b: a != b,
+               '>': lambda a, b: a > b, '>=': lambda a, b: a >= b, '<': lambda a, b: a < b, '<=': lambda a, b: a <= b}
+
+FIELD_NAMES = {field['name'].upper(): field['name'] for field in FIELDS}
+
+def tokenizeWhere(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = WHERE_TOKEN.match(text, position)
+        if not match:
+            raise ValueError("Unsupported where clause near: " + text[position:position + 20])
+        number, string, word, symbol = match.groups()
+        if number is not None:
+            tokens.append(('literal', float(number) if any(c in number for c in '.eE') else int(number)))
+        elif string is not None:
+            tokens.append(('literal', string[1:-1].replace("''", "'")))
+        elif word is not None:
+            tokens.append(('word', word.upper()))
+        else:
+            tokens.append(('symbol', symbol))
+        position = match.end()
+    return tokens
+
+def parseWhere(text):
+    """compiles a where clause into a function of a feature's attributes that returns True, False or None"""
+    tokens = tokenizeWhere(text)
+    position = [0]
+
+    def peek(offset=0):
+        i = position[0] + offset
+        return tokens[i] if i < len(tokens) else (None, None)
+
+    def take(kind=None, value=None):
+        token = peek()
+        if token[0] is None or (kind and token[0] != kind) or (value is not None and token[1] != value):
+            raise ValueError("Unsupported where clause: " + text)
+        position[0] += 1
+        return token
+
+    def isWord(value, offset=0):
+        return peek(offset) == ('word', value)
+
+    def parseOr():
+        left = parseAnd()
+        while isWord('OR'):
+            take()
+            left = anyOf(left, parseAnd())
+        return left
+
+    def parseAnd():
+        left = parseNot()
+        while isWord('AND'):
+            take()
+            left = allOf(left, parseNot())
+        return left
+
+    def parseNot():
+        if isWord('NOT'):
+            take()
+            inner = parseNot()
+            return lambda attributes: None if inner(attributes) is None else not inner(attributes)
+        return parsePredicate()
+
+    def parseOperand():
+        kind, value = take()
+        if kind == 'literal':
+            return lambda attributes: value
+        if kind == 'word' and value == 'TIMESTAMP':
+            timestamp = take('literal')[1]
+            milliseconds = calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')) * 1000
+            return lambda attributes: milliseconds
+        if kind == 'word' and value in FIELD_NAMES:
+            name = FIELD_NAMES[value]
+            return lambda attributes: attributes.get(name)
+        raise ValueError("Unknown field or value in where clause: " + str(value))
+
+    def parsePredicate():
+        if peek() == ('symbol', '('):
+            take()
+            inner = parseOr()
+            take('symbol', ')')
+            return inner
+
+        operand = parseOperand()
+
+        if isWord('IS'):
+            take()
+            negated = isWord('NOT')
+            if negated:
+                take()
+            take('word', 'NULL')
+            return lambda attributes: (operand(attributes) is None) != negated
+
+        if isWord('IN') or (isWord('NOT') and isWord('IN', 1)):
+            negated = isWord('NOT')
+            if negated:
+                take()
+            take()
+            take('symbol', '(')
+            values = [take('literal')[1]]
+            while peek() == ('symbol', ','):
+                take()
+                values.append(take('literal')[1])
+            take('symbol', ')')
+            values = set(values)
+
+            def inList(attributes):
+                value = operand(attributes)
+                return None if value is None else (value in values) != negated
+            return inList
+
+        kind, symbol = take('symbol')
+        if symbol not in COMPARISONS:
+            raise ValueError("Unsupported operator in where clause: " + symbol)
+        compare = COMPARISONS[symbol]
+        other = parseOperand()
+
+        def comparison(attributes):
+            a, b = operand(attributes), other(attributes)
+            if a is None or b is None:
+                return None
+            if isinstance(a, str) != isinstance(b, str):
+                raise ValueError("Cannot compare text with a number in where clause: " + text)
+            return compare(a, b)
+        return comparison
+
+    predicate = parseOr()
+    if position[0] != len(tokens):
+        raise ValueError("Unsupported where clause: " + text)
+    return predicate
+
+def allOf(left, right):
+    def both(attributes):
+        a, b = left(attributes), right(attributes)
+        if a is False or b is False:
+            return False
+        return None if a is None or b is None else True
+    return both
+
+def anyOf(left, right):
+    def either(attributes):
+        a, b = left(attributes), right(attributes)
+        if a is True or b is True:
+            return True
+        return None if a is None or b is None else False
+    return either
+
+#The spatial filter, worked out on the whole geometry of every feature. A query
+#geometry is an envelope, a point or a polygon, and spatialRel is one of
+#Intersects, EnvelopeIntersects (IndexIntersects is the same here), Contains
+#(the query geometry contains the feature) or Within (the query geometry is
+#within the feature). Touching the boundary counts as intersecting.
+
+def getSpatialRelation(spatialRel):
+    relations = {'esriSpatialRelIntersects': intersects,
+                 'esriSpatialRelEnvelopeIntersects': envelopeIntersects,
+                 'esriSpatialRelIndexIntersects': envelopeIntersects,
+                 'esriSpatialRelContains': lambda feature, query: covers(query, feature),
+                 'esriSpatialRelWithin': lambda feature, query: covers(feature, query)}
+    if spatialRel not in relations:
+        raise ValueError("Unsupported spatialRel " + spatialRel)
+    return relations[spatialRel]
+
+def parseGeometry(text):
+    """the query geometry, an envelope, point or polygon as JSON or xmin,ymin,xmax,ymax, returned as a point or polygon"""
+    if text.lstrip().startswith('{'):
+        geometry = json.loads(text)
+    else:
+        geometry = dict(zip(['xmin', 'ymin', 'xmax', 'ymax'], [float(value) for value in text.split(',')]))
+
+    if 'xmin' in geometry:
+        xmin, ymin, xmax, ymax = geometry['xmin'], geometry['ymin'], geometry['xmax'], geometry['ymax']
+        return {'rings': [[[xmin, ymin], [xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin]]]}
+    if 'x' in geometry or 'rings' in geometry:
+        return geometry
+    raise ValueError("Unsupported query geometry")
+
+def getVertices(geometry):
+    if 'x' in geometry:
+        return [(geometry['x'], geometry['y'])]
+    return [(position[0], position[1]) for part in (geometry.get('paths') or geometry.get('rings') or []) for position in part]
+
+def getEdges(geometry):
+    edges = []
+    for part in geometry.get('paths') or geometry.get('rings') or []:
+        edges.extend(((a[0], a[1]), (b[0], b[1])) for a, b in zip(part[:-1], part[1:]))
+    return edges
+
+def getBounds(geometry):
+    vertices = getVertices(geometry)
+    if not vertices:
+        return None
+    xs, ys = [x for x, y in vertices], [y for x, y in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def boundsOverlap(a, b):
+    return a is not None and b is not None and a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def side(p, q, r):
+    value = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+    return (value > 0) - (value < 0)
+
+def onEdge(p, q, r):
+    """r lies on the segment p-q"""
+    return side(p, q, r) == 0 and min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+
+def edgesTouch(a, b, c, d):
+    """segments a-b and c-d share at least one point"""
+    if side(a, b, c) != side(a, b, d) and side(c, d, a) != side(c, d, b):
+        return True
+    return onEdge(a, b, c) or onEdge(a, b, d) or onEdge(c, d, a) or onEdge(c, d, b)
+
+def edgesCross(a, b, c, d):
+    """segments a-b and c-d cross each other at a point inside both"""
+    return side(a, b, c) * side(a, b, d) < 0 and side(c, d, a) * side(c, d, b) < 0
+
+def locatePoint(x, y, polygon):
+    """1 inside the polygon, 0 on its boundary, -1 outside, holes count by the even-odd rule"""
+    inside = False
+    for a, b in getEdges(polygon):
+        if onEdge(a, b, (x, y)):
+            return 0
+        if (a[1] > y) != (b[1] > y) and x < a[0] + (y - a[1]) * (b[0] - a[0]) / (b[1] - a[1]):
+            inside = not inside
+    return 1 if inside else -1
+
+def envelopeIntersects(geometry, queryGeometry):
+    return boundsOverlap(getBounds(geometry), getBounds(queryGeometry))
+
+def intersects(geometry, queryGeometry):
+    if not envelopeIntersects(geometry, queryGeometry):
+        return False
+
+    #one inside the other, or an edge of one touching an edge of the other
+    for polygon, other in ((queryGeometry, geometry), (geometry, queryGeometry)):
+        if 'rings' in polygon and any(locatePoint(x, y, polygon) >= 0 for x, y in getVertices(other)):
+            return True
+
+    edges = getEdges(geometry) or [(vertex, vertex) for vertex in getVertices(geometry)]
+    queryEdges = getEdges(queryGeometry) or [(vertex, vertex) for vertex in getVertices(queryGeometry)]
+    return any(edgesTouch(a, b, c, d) for a, b in edges for c, d in queryEdges)
+
+def covers(polygon, geometry):
+    """geometry is inside the polygon, its vertices can lie on the boundary but no edge can cross out of it"""
+    if 'rings' not in polygon or not envelopeIntersects(geometry, polygon):
+        return False
+    if any(locatePoint(x, y, polygon) < 0 for x, y in getVertices(geometry)):
+        return False
+    if any(edgesCross(a, b, c, d) for a, b in getEdges(geometry) for c, d in getEdges(polygon)):
+        return False
+
+    #an edge running along the boundary can still leave through a concave corner, its middle tells
+    return all(locatePoint((a[0] + b[0]) / 2.0, (a[1] + b[1]) / 2.0, polygon) >= 0 for a, b in getEdges(geometry))
+
+def getExtent(features):
+    bounds = [getBounds(feature['geometry']) for feature in features]
+    bounds = [bound for bound in bounds if bound]
+    if not bounds:
+        return None
+
+    xmins, ymins, xmaxs, ymaxs = zip(*bounds)
+    return {'xmin': min(xmins), 'ymin': min(ymins), 'xmax': max(xmaxs), 'ymax': max(ymaxs), 'spatialReference': {'wkid': 4326}}
+
+def toGeoJSON(geometry):
+    """a generated geometry as geoJSON, rings are reversed to run counter clockwise"""
+    if not geometry:
+        return None
+    if 'x' in geometry:
+        return {'type': 'Point', 'coordinates': [geometry['x'], geometry['y']]}
+    if 'paths' in geometry:
+        if len(geometry['paths']) == 1:
+            return {'type': 'LineString', 'coordinates': geometry['paths'][0]}
+        return {'type': 'MultiLineString', 'coordinates': geometry['paths']}
+    return {'type': 'Polygon', 'coordinates': [list(reversed(ring)) for ring in geometry['rings']]}
+
+def getStatistics(features, statistics):
+    summary = {'min': min, 'max': max, 'count': len, 'sum': sum}
+
+    attributes = {}
+    for statistic in statistics:
+        values = [feature['attributes'][statistic['onStatisticField']] for feature in features]
+        values = [value for value in values if value is not None]
+        attributes[statistic['outStatisticFieldName']] = summary[statistic['statisticType']](values) if values or statistic['statisticType'] == 'count' else None
+
+    return attributes
+
+def roundGeometry(geometry, precision):
+    if 'x' in geometry:
+        return {'x': round(geometry['x'], precision), 'y': round(geometry['y'], precision)}
+    key = 'paths' if 'paths' in geometry else 'rings'
+    return {key: [[[round(x, precision), round(y, precision)] for x, y in part] for part in geometry[key]]}
+
+#The FeatureCollectionPBuffer encoding of a query response, the reverse of what
+#esripbf reads (attributes, quantized geometry and exceededTransferLimit)
+
+PBF_FIELD_TYPES = {'esriFieldTypeInteger': 1, 'esriFieldTypeDouble': 3, 'esriFieldTypeString': 4, 'esriFieldTypeDate': 5, 'esriFieldTypeOID': 6}
+PBF_GEOMETRY_TYPES = {'esriGeometryPoint': 0, 'esriGeometryPolyline': 2, 'esriGeometryPolygon': 3}
+
+#the quantization grid, upper left origin
+PBF_SCALE = 1e-9
+PBF_ORIGIN = (-180.0, 90.0)
+
+def encodeVarint(value):
+    value &= (1 << 64) - 1
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+def encodeZigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def encodeKey(fieldNumber, wireType):
+    return encodeVarint((fieldNumber << 3) | wireType)
+
+def encodeMessage(fieldNumber, content):
+    return encodeKey(fieldNumber, 2) + encodeVarint(len(content)) + content
+
+def encodeInteger(fieldNumber, value):
+    return encodeKey(fieldNumber, 0) + encodeVarint(value)
+
+def encodeDouble(fieldNumber, value):
+    return encodeKey(fieldNumber, 1) + struct.pack('<d', value)
+
+def encodeValue(value):
+    if value is None:
+        return b''
+    if isinstance(value, bool):
+        return encodeInteger(9, int(value))
+    if isinstance(value, str):
+        return encodeMessage(1, value.encode('utf-8'))
+    if isinstance(value, float):
+        return encodeDouble(3, value)
+    if value < 0:
+        return encodeInteger(8, encodeZigzag(value))
+    return encodeInteger(6, value)
+
+def encodeGeometry(geometry):
+    if 'x' in geometry:
+        parts, lengths = [[[geometry['x'], geometry['y']]]], []
+    else:
+        parts = geometry.get('paths') or geometry.get('rings')
+        lengths = [len(part) for part in parts]
+
+    #coordinates are deltas from the one before on the quantization grid
+    coordinates = []
+    previousX = previousY = 0
+    for part in parts:
+        for x, y in part:
+            gridX = round((x - PBF_ORIGIN[0]) / PBF_SCALE)
+            gridY = round((PBF_ORIGIN[1] - y) / PBF_SCALE)
+            coordinates.append(encodeZigzag(gridX - previousX))
+            coordinates.append(encodeZigzag(gridY - previousY))
+            previousX, previousY = gridX, gridY
+
+    content = b''
+    if lengths:
+        content += encodeMessage(2, b''.join(encodeVarint(length) for length in lengths))
+    return content + encodeMessage(3, b''.join(encodeVarint(coordinate) for coordinate in coordinates))
+
+def encodeFeatureCollection(response, geometryType):
+    """encodes a json query response as f=pbf"""
+    fields = response['fields']
+
+    result = encodeMessage(1, b'OBJECTID') + encodeInteger(7, PBF_GEOMETRY_TYPES[geometryType])
+    if response.get('exceededTransferLimit'):
+        result += encodeInteger(9, 1)
+
+    transform = encodeInteger(1, 0) + encodeMessage(2, encodeDouble(1, PBF_SCALE) + encodeDouble(2, PBF_SCALE)) + \
+                encodeMessage(3, encodeDouble(1, PBF_ORIGIN[0]) + encodeDouble(2, PBF_ORIGIN[1]))
+    result += encodeMessage(12, transform)
+
+    for field in fields:
+        result += encodeMessage(13, encodeMessage(1, field['name'].encode('utf-8')) + encodeInteger(2, PBF_FIELD_TYPES.get(field['type'], 4)))
+
+    for feature in response['features']:
+        content = b''.join(encodeMessage(1, encodeValue(feature['attributes'].get(field['name']))) for field in fields)
+        if feature.get('geometry'):
+            content += encodeMessage(2, encodeGeometry(feature['geometry']))
+        result += encodeMessage(15, content)
+
+    return encodeMessage(1, b'1.0') + encodeMessage(2, encodeMessage(1, result))
@@ -1,15 +1,704 @@
 # -*- coding: utf-8 -*-
 
-from .context import sample
+from .context import gtatr, featuretable, restcache, restspool, restsync, spatialindex, RESTDownloader
+from .mockserver import MockFeatureService, MockLayer, EXTENT
+from . import benchmark
 
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import math
+import os
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 
 class AdvancedTestSuite(unittest.TestCase):
-    """Advanced test cases."""
+    """Advanced test cases, against the mock feature service."""
 
-    def test_thoughts(self):
-        self.assertIsNone(sample.hmm())
+    @classmethod
+    def setUpClass(cls):
+        cls.service = MockFeatureService([MockLayer(1200, 'point', maxRecordCount=250),
+                                          MockLayer(150, 'polygon', vertices=12, maxRecordCount=40)]).start()
+        cls.pointsURL = cls.service.layerURL(0)
+        cls.polygonsURL = cls.service.layerURL(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.stop()
+
+    def setUp(self):
+        self.workDirectory = tempfile.mkdtemp()
+
+        #the library reports its progress with print
+        self.quiet = contextlib.redirect_stdout(io.StringIO())
+        self.quiet.__enter__()
+
+    def tearDown(self):
+        self.quiet.__exit__(None, None, None)
+        shutil.rmtree(self.workDirectory)
+
+    def getConnector(self, service=None):
+        RConnect = gtatr.RESTConnector((service or self.service).baseURL)
+        RConnect.setToken("")
+        RConnect.setRetryPolicy(gtatr.RetryPolicy(backoffFactor=0.01, maxBackoff=0.05))
+        return RConnect
+
+    def getOIDs(self, features):
+        return sorted(feature['attributes']['OBJECTID'] for feature in features)
+
+    def test_feature_count(self):
+        RConnect = self.getConnector()
+        self.assertEqual(RConnect.getFeatureCount(self.pointsURL + "/query?", "1=1"), 1200)
+        self.assertEqual(RConnect.getFeatureCount(self.pointsURL + "/query?", "CATEGORY = 'A' AND OBJECTID <= 30"), 10)
+
+    def test_mock_where_clauses(self):
+        #the mock answers where clauses itself, checked here against the features directly
+        layer = self.service.layers[0]
+        self.assertEqual([feature['attributes']['OBJECTID'] for feature in layer.selectFeatures({'where': "OBJECTID <= 20 AND (CATEGORY = 'A' OR VALUE > 900)"})],
+                         [feature['attributes']['OBJECTID'] for feature in layer.features[:20]
+                          if feature['attributes']['CATEGORY'] == 'A' or feature['attributes']['VALUE'] > 900])
+
+        RConnect = self.getConnector()
+        self.assertEqual(RConnect.getFeatureCount(self.pointsURL + "/query?", "NAME LIKE 'Feature%'"), None)
+
+    def test_failed_object_id_query(self):
+        RConnect = self.getConnector()
+        self.assertEqual(RConnect.getObjectIDs(self.pointsURL + "/query?", "OBJECTID < 0"), [])
+        self.assertEqual(list(RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", "OBJECTID < 0", strategy='oids')), [])
+
+        #a query the server cant answer is an error, not an empty layer
+        with self.assertRaises(gtatr.RESTError):
+            RConnect.getObjectIDs(self.pointsURL + "/query?", "NAME LIKE 'Feature%'")
+        with self.assertRaises(gtatr.RESTError):
+            list(RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", "NAME LIKE 'Feature%'", strategy='oids'))
+
+    def test_strategies_get_every_feature(self):
+        RConnect = self.getConnector()
+        for strategy in ['auto', 'oids', 'oidRanges', 'pages']:
+            features = [feature for batch in RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", "1=1", returnGeometry=True, strategy=strategy)
+                        for feature in batch]
+            self.assertEqual(self.getOIDs(features), list(range(1, 1201)), strategy)
+
+    def test_oid_chunks_keep_or_queries_inside(self):
+        RConnect = self.getConnector()
+        queryText = "CATEGORY = 'A' OR CATEGORY = 'B'"
+        features = [feature for batch in RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", queryText, strategy='oids') for feature in batch]
+
+        self.assertEqual(self.getOIDs(features), [OID for OID in range(1, 1201) if OID % 3 != 2])
+
+    def test_strategies_agree_on_or_queries(self):
+        RConnect = self.getConnector()
+        queryText = "CATEGORY = 'A' OR CATEGORY = 'B'"
+
+        def getStrategyOIDs(strategy):
+            return self.getOIDs(feature for batch in RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", queryText, strategy=strategy)
+                                for feature in batch)
+
+        expected = getStrategyOIDs('pages')
+        self.assertEqual(len(expected), 800)
+        for strategy in ['auto', 'oids', 'oidRanges', 'single']:
+            OIDs = getStrategyOIDs(strategy)
+            self.assertEqual(len(OIDs), len(expected), strategy)
+            self.assertEqual(OIDs, expected, strategy)
+
+    def test_oid_chunk_splits_stop(self):
+        #a server that ignores the where clause keeps sending the first features, the chunk can never be finished
+        class IgnoresWhereLayer(MockLayer):
+            def selectFeatures(self, PARAMS):
+                return MockLayer.selectFeatures(self, dict(PARAMS, where='1=1'))
+
+        with MockFeatureService([IgnoresWhereLayer(500, maxRecordCount=100)]) as service:
+            RConnect = self.getConnector(service)
+            with self.assertRaises(gtatr.RESTError):
+                list(RConnect.iterFeatureBatches(service.layerURL(0) + "/query?", "*", "1=1", strategy='oids'))
+
+    def test_table_without_count_or_object_ids(self):
+        #an old style table, no object IDs, no paging and no returnCountOnly
+        class PlainTableLayer(MockLayer):
+            def getInfo(self):
+                info = dict(MockLayer.getInfo(self), type='Table')
+                del info['objectIdField'], info['geometryType']
+                return info
+
+            def query(self, PARAMS):
+                if PARAMS.get('returnCountOnly') == 'true' or PARAMS.get('returnIdsOnly') == 'true':
+                    raise ValueError("not supported")
+                return MockLayer.query(self, PARAMS)
+
+        with MockFeatureService([PlainTableLayer(80, maxRecordCount=100, supportsPagination=False)]) as service:
+            RConnect = self.getConnector(service)
+            self.assertEqual(RConnect.planQuery(service.layerURL(0) + "/query?", "1=1").strategy, 'single')
+
+            features = RConnect.getTableData(service.layerURL(0) + "/query?", "*", "1=1")
+            self.assertEqual(sorted(feature['OBJECTID'] for feature in features), list(range(1, 81)))
+
+    def test_feature_table(self):
+        RConnect = self.getConnector()
+        features = RConnect.getFeaturesWithGeometry(self.polygonsURL + "/query?", "*", "1=1")
+        table = RConnect.getFeatureTable(self.polygonsURL + "/query?", "*", "1=1", returnGeometry=True)
+
+        self.assertEqual(table.to_dicts(), features)
+        self.assertEqual(table[10:20].to_dicts(), features[10:20])
+        self.assertEqual(table[-1], features[-1])
+        self.assertEqual([type(column).__name__ for column in table.columns], ['NumberColumn', 'TextColumn', 'NumberColumn', 'TextColumn', 'NumberColumn'])
+
+        #the columns take a fraction of the memory the dictionaries do
+        def deepSize(value):
+            if isinstance(value, dict):
+                return sys.getsizeof(value) + sum(deepSize(key) + deepSize(item) for key, item in value.items())
+            if isinstance(value, list):
+                return sys.getsizeof(value) + sum(deepSize(item) for item in value)
+            return sys.getsizeof(value)
+        self.assertLess(table.nbytes() * 3, deepSize(features))
+
+        #without the layer's field list the column types come from the first chunk
+        batches = [[{'attributes': {name: value for name, value in feature.items() if name != 'geometry'}} for feature in features[i:i + 40]]
+                   for i in range(0, len(features), 40)]
+        untyped = featuretable.FeatureTable()
+        for batch in batches:
+            untyped.append(batch)
+        self.assertEqual([type(column).__name__ for column in untyped.columns], ['NumberColumn', 'TextColumn', 'NumberColumn', 'TextColumn', 'NumberColumn'])
+        self.assertEqual(untyped.to_dicts(), [batchFeature['attributes'] for batch in batches for batchFeature in batch])
+
+        #a value that doesnt fit its typed column turns the column into a list, keeping what was already there
+        untyped.append([{'attributes': dict(batches[0][0]['attributes'], VALUE='n/a')}])
+        self.assertEqual(type(untyped.columns[2]).__name__, 'ListColumn')
+        self.assertEqual(untyped.column('VALUE')[-2:], [features[-1]['VALUE'], 'n/a'])
+
+    def test_pbf_and_json_agree(self):
+        RConnect = self.getConnector()
+        RConnect.setPBF(True)
+        fromPBF = RConnect.getFeaturesWithGeometry(self.polygonsURL + "/query?", "*", "1=1")
+        RConnect.setPBF(False)
+        fromJSON = RConnect.getFeaturesWithGeometry(self.polygonsURL + "/query?", "*", "1=1")
+
+        self.assertEqual(len(fromPBF), 150)
+        for PBFFeature, JSONFeature in zip(fromPBF, fromJSON):
+            self.assertEqual(PBFFeature['NAME'], JSONFeature['NAME'])
+            self.assertAlmostEqual(PBFFeature['geometry']['rings'][0][3][0], JSONFeature['geometry']['rings'][0][3][0], places=6)
+
+    def test_output_profiles(self):
+        RConnect = self.getConnector()
+
+        #the mock layer cant send centroids, so they are worked out from the generalized rings
+        features = sorted(RConnect.getFeaturesWithGeometry(self.polygonsURL + "/query?", "*", "OBJECTID <= 20", profile='centroid'),
+                          key=lambda feature: feature['OBJECTID'])
+        self.assertEqual([feature['OBJECTID'] for feature in features], list(range(1, 21)))
+        for feature, layerFeature in zip(features, self.service.layers[1].features):
+            ring = layerFeature['geometry']['rings'][0][:-1]
+            self.assertAlmostEqual(feature['geometry']['x'], sum(x for x, y in ring) / len(ring), places=4)
+            self.assertAlmostEqual(feature['geometry']['y'], sum(y for x, y in ring) / len(ring), places=4)
+
+        #the display precision reaches the server
+        features = RConnect.getFeaturesWithGeometry(self.polygonsURL + "/query?", "*", "OBJECTID <= 5", profile=gtatr.OutputProfile("coarse", geometryPrecision=2))
+        for feature in features:
+            for x, y in feature['geometry']['rings'][0]:
+                self.assertEqual((round(x, 2), round(y, 2)), (x, y))
+
+    def test_errors_are_retried(self):
+        with MockFeatureService([MockLayer(600, maxRecordCount=100, errorRate=0.3)]) as service:
+            RConnect = self.getConnector(service)
+            features = list(RConnect.iterFeatures(service.layerURL(0) + "/query?", "*", "1=1", strategy='pages'))
+
+            self.assertEqual(sorted(feature['OBJECTID'] for feature in features), list(range(1, 601)))
+            self.assertGreater(service.getStatistics()['errors'], 0)
+
+    def test_streamed_errors_are_retried(self):
+        #a chunked body has no Content-Length, the error bodies are found by the streaming decoder
+        with MockFeatureService([MockLayer(600, maxRecordCount=100, errorRate=0.3)], tokenExpiration=3600, chunked=True) as service:
+            RConnect = self.getConnector(service)
+            RConnect.setJSONDecoding(incremental=True)
+            RConnect.getRESTToken("user", "password", service.tokenURL)
+
+            service.expireTokens()
+            features = list(RConnect.iterFeatures(service.layerURL(0) + "/query?", "*", "1=1", strategy='pages'))
+
+            self.assertEqual(sorted(feature['OBJECTID'] for feature in features), list(range(1, 601)))
+            self.assertGreater(service.getStatistics()['errors'], 0)
+
+    def test_expired_token_is_refreshed(self):
+        with MockFeatureService([MockLayer(500, maxRecordCount=100)], tokenExpiration=3600) as service:
+            RConnect = self.getConnector(service)
+            RConnect.getRESTToken("user", "password", service.tokenURL)
+
+            service.expireTokens()
+            features = list(RConnect.iterFeatures(service.layerURL(0) + "/query?", "*", "1=1"))
+
+            self.assertEqual(len(features), 500)
+            self.assertEqual(service.getStatistics()['tokens'], 2)
+
+    def test_query_by_envelope(self):
+        RConnect = self.getConnector()
+        envelope = {'xmin': -110.0, 'ymin': 35.0, 'xmax': -95.0, 'ymax': 40.0}
+        features = RConnect.getFeaturesFromServiceByGeometry(self.pointsURL + "/query?", "1=1", envelope, "esriGeometryEnvelope",
+                                                             "esriSpatialRelIntersects", "*", maxDepth=3)
+
+        expected = [feature['attributes']['OBJECTID'] for feature in self.service.layers[0].features
+                    if -110 <= feature['geometry']['x'] <= -95 and 35 <= feature['geometry']['y'] <= 40]
+        self.assertEqual(sorted(feature['OBJECTID'] for feature in features), sorted(expected))
+
+    def test_query_by_concave_polygon(self):
+        #a U on its side, the tiles split it through the gap between the arms
+        polygon = {'rings': [[[-120, 30], [-120, 35], [-90, 35], [-90, 40], [-120, 40], [-120, 45], [-80, 45], [-80, 30], [-120, 30]]]}
+
+        #short lines along the arms, and one in the gap on the tile border that the clipped tiles touch
+        layer = MockLayer(0, 'polyline', maxRecordCount=10)
+        lines = [[[-100, 36], [-100, 39]]] + [[[x, y], [x + 0.5, y]] for x in range(-118, -82, 3) for y in (32, 42, 43)]
+        layer.features = [{'attributes': {'OBJECTID': OID, 'NAME': 'Line ' + str(OID), 'VALUE': 0.0, 'CATEGORY': 'A', 'EDITED': None},
+                           'geometry': {'paths': [line]}} for OID, line in enumerate(lines, 1)]
+
+        with MockFeatureService([layer]) as service:
+            RConnect = self.getConnector(service)
+            features = RConnect.getFeaturesFromServiceByGeometry(service.layerURL(0) + "/query?", "1=1", polygon, "esriGeometryPolygon",
+                                                                 "esriSpatialRelIntersects", "*", maxDepth=3)
+
+        self.assertEqual(sorted(feature['OBJECTID'] for feature in features), list(range(2, len(lines) + 1)))
+        self.assertNotIn('geometry', features[0])
+
+    def test_long_polygon_filters_are_posted(self):
+        #a detailed circle is too long for a URL, including on the object ID requests of the smallest tiles
+        polygon = {'rings': [[[round(-100 + 8 * math.cos(2 * math.pi * i / 200), 6), round(37.5 + 6 * math.sin(2 * math.pi * i / 200), 6)]
+                              for i in range(200)] + [[-92.0, 37.5]]]}
+        spatialParameters = {'geometry': json.dumps(polygon), 'geometryType': 'esriGeometryPolygon', 'spatialRel': 'esriSpatialRelIntersects'}
+        self.assertGreater(len(spatialParameters['geometry']), gtatr.maxGETGeometryLength)
+        expected = [feature['attributes']['OBJECTID'] for feature in self.service.layers[0].selectFeatures(spatialParameters)]
+
+        RConnect = self.getConnector()
+        with mock.patch.object(RConnect, 'sendRequest', wraps=RConnect.sendRequest) as sendRequest:
+            features = RConnect.getFeaturesFromServiceByGeometry(self.pointsURL + "/query?", "1=1", polygon, "esriGeometryPolygon",
+                                                                 "esriSpatialRelIntersects", "*", maxDepth=0)
+
+        self.assertEqual(sorted(feature['OBJECTID'] for feature in features), sorted(expected))
+        methods = [call.kwargs.get('method', 'GET') for call in sendRequest.call_args_list if len(str(call.args[2].get('geometry') or '')) > gtatr.maxGETGeometryLength]
+        self.assertGreater(len(methods), 1)
+        self.assertEqual(set(methods), {'POST'})
+
+    def test_nested_workers_keep_their_connections(self):
+        #the tiles at maxDepth each download by object ID on their own workers, with the bodies streamed
+        with MockFeatureService([MockLayer(4000, 'point', maxRecordCount=100, latency=0.01)]) as service:
+            RConnect = self.getConnector(service)
+            RConnect.setJSONDecoding(incremental=True)
+
+            with self.assertNoLogs('urllib3.connectionpool', level='WARNING'):
+                features = RConnect.getFeaturesFromServiceByGeometry(service.layerURL(0) + "/query?", "1=1", EXTENT, "esriGeometryEnvelope",
+                                                                     "esriSpatialRelIntersects", "*", maxDepth=1)
+            self.assertEqual(len(features), 4000)
+
+    def test_spatial_filter_is_used_to_plan(self):
+        RConnect = self.getConnector()
+        spatialParameters = {'geometry': json.dumps({'xmin': -110.0, 'ymin': 35.0, 'xmax': -95.0, 'ymax': 40.0}),
+                             'geometryType': 'esriGeometryEnvelope', 'spatialRel': 'esriSpatialRelIntersects'}
+        expected = [feature['attributes']['OBJECTID'] for feature in self.service.layers[0].selectFeatures(spatialParameters)]
+
+        for strategy in ['oids', 'oidRanges', 'pages']:
+            self.service.resetStatistics()
+            features = [feature for batch in RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", "1=1", additionalParameters=spatialParameters,
+                                                                         strategy=strategy) for feature in batch]
+            self.assertEqual(self.getOIDs(features), expected, strategy)
+
+            #planned from the features in the envelope, not the whole layer
+            self.assertLessEqual(self.service.getStatistics()['queries'], 3, strategy)
+
+    def test_response_cache(self):
+        cache = restcache.ResponseCache(os.path.join(self.workDirectory, "cache.sqlite"))
+        try:
+            RConnect = self.getConnector()
+            RConnect.setCache(cache)
+            self.service.resetStatistics()
+
+            #the second count is read from the cache, nothing is sent
+            self.assertEqual(RConnect.getFeatureCount(self.pointsURL + "/query?", "1=1"), 1200)
+            self.assertEqual(RConnect.getFeatureCount(self.pointsURL + "/query?", "1=1"), 1200)
+            self.assertEqual(self.service.getStatistics()['requests'], 1)
+            self.assertEqual(cache.hits, 1)
+
+            #once stale it is revalidated, the server answers 304 and the stored body is used
+            cache.setTTL(self.pointsURL, 0.05)
+            time.sleep(0.1)
+            bytesSent = self.service.getStatistics()['bytesSent']
+            self.assertEqual(RConnect.getFeatureCount(self.pointsURL + "/query?", "1=1"), 1200)
+            self.assertEqual(self.service.getStatistics()['requests'], 2)
+            self.assertEqual(self.service.getStatistics()['bytesSent'], bytesSent)
+            self.assertEqual(cache.hits, 2)
+
+            #a time to live of 0 turns the cache off for the layer
+            cache.setTTL(self.pointsURL, 0)
+            RConnect.getFeatureCount(self.pointsURL + "/query?", "1=1")
+            self.assertEqual(self.service.getStatistics()['requests'], 3)
+            self.assertEqual(cache.hits, 2)
+        finally:
+            cache.close()
+
+    def test_response_cache_key_and_eviction(self):
+        cache = restcache.ResponseCache(os.path.join(self.workDirectory, "cache.sqlite"), maxBytes=250)
+        try:
+            #the token changes every run, so it isnt part of the key
+            self.assertEqual(cache.makeKey(self.pointsURL + "/query", {'where': '1=1', 'token': 'first'}),
+                             cache.makeKey(self.pointsURL + "/query?", {'token': 'second', 'where': '1=1 '}))
+            self.assertNotEqual(cache.makeKey(self.pointsURL + "/query", {'where': '1=1'}),
+                                cache.makeKey(self.pointsURL + "/query", {'where': '1=0'}))
+
+            def store(name):
+                r = requests.Response()
+                r.status_code = 200
+                r._content = name.encode() * 100
+                cache.store(self.pointsURL + "/query", {'where': name}, r)
+
+            #a read makes "a" the most recently used, so "b" goes when "c" pushes the cache over its size
+            store("a")
+            store("b")
+            time.sleep(0.01)
+            self.assertIsNotNone(cache.getFresh(self.pointsURL + "/query", {'where': 'a'}))
+            store("c")
+            self.assertEqual([cache.getFresh(self.pointsURL + "/query", {'where': name}) is not None for name in "abc"], [True, False, True])
+            self.assertLessEqual(cache.totalBytes, 250)
+        finally:
+            cache.close()
+
+    def test_spool_resumes(self):
+        RConnect = self.getConnector()
+        spoolDir = os.path.join(self.workDirectory, "points.spool")
+
+        def download(queryText="1=1"):
+            self.service.resetStatistics()
+            features = [feature for batch in RConnect.iterFeatureBatches(self.pointsURL + "/query?", "*", queryText, spool=restspool.ChunkSpool(spoolDir))
+                        for feature in batch]
+            return self.getOIDs(features), self.service.getStatistics()['queries']
+
+        expected = list(range(1, 1201))
+        OIDs, firstQueries = download()
+        self.assertEqual(OIDs, expected)
+
+        #every chunk is in the manifest with its range, count and checksum
+        spool = restspool.ChunkSpool(spoolDir)
+        chunks = sorted(spool.manifest['chunks'], key=lambda chunk: chunk['start'])
+        self.assertEqual(sum(chunk['count'] for chunk in chunks), 1200)
+        self.assertGreater(len(chunks), 2)
+        for chunk in chunks:
+            with open(os.path.join(spoolDir, chunk['file']), 'rb') as chunkFile:
+                self.assertEqual(hashlib.sha256(chunkFile.read()).hexdigest(), chunk['checksum'])
+
+        #nothing left to fetch, then only a chunk whose file went missing
+        OIDs, queries = download()
+        self.assertEqual(OIDs, expected)
+        self.assertLess(queries, firstQueries)
+
+        os.remove(os.path.join(spoolDir, chunks[1]['file']))
+        OIDs, resumedQueries = download()
+        self.assertEqual(OIDs, expected)
+        self.assertEqual(resumedQueries, queries + 1)
+
+        #a chunk changed on disk fails its checksum and is dropped, so the next run fetches it again
+        chunkPath = os.path.join(spoolDir, chunks[0]['file'])
+        with open(chunkPath, 'rb') as chunkFile:
+            body = chunkFile.read()
+        with open(chunkPath, 'wb') as chunkFile:
+            chunkFile.write(body.replace(b'Feature', b'feature', 1))
+        with self.assertRaises(IOError):
+            download()
+        OIDs, resumedQueries = download()
+        self.assertEqual(OIDs, expected)
+        self.assertEqual(resumedQueries, queries + 1)
+
+        #a different query doesnt reuse the spool
+        OIDs, queries = download("OBJECTID <= 100")
+        self.assertEqual(OIDs, list(range(1, 101)))
+        self.assertEqual(restspool.ChunkSpool(spoolDir).featureCount(), 100)
+
+    def test_sync_layer(self):
+        layer = MockLayer(300, 'point', maxRecordCount=100)
+        snapshotPath = os.path.join(self.workDirectory, "points.snapshot")
+
+        def sync(**kwargs):
+            summary = restsync.syncLayer(RConnect, service.layerURL(0), "1=1", "*", snapshotPath, **kwargs)
+            return [summary[key] for key in ("mode", "added", "updated", "deleted", "total")]
+
+        def snapshotFeatures():
+            snapshot = restsync.LayerSnapshot(snapshotPath)
+            try:
+                return [feature['attributes'] for batch in snapshot.iterBatches() for feature in batch]
+            finally:
+                snapshot.close()
+
+        with MockFeatureService([layer]) as service:
+            RConnect = self.getConnector(service)
+            self.assertEqual(sync(), ["full", 300, 0, 0, 300])
+
+            #the changes since the last serverGen come from extractChanges
+            layer.editFeatures([5, 6, 7])
+            layer.deleteFeatures([10, 11])
+            layer.addFeatures(4)
+            self.assertEqual(sync(), ["extractChanges", 4, 3, 2, 302])
+
+            #without it the edit dates find the edits and the object IDs on the server find the deletes
+            layer.editFeatures([20], editTime=time.time() + 60)
+            layer.deleteFeatures([30])
+            self.assertEqual(sync(useExtractChanges=False), ["editDate", 0, 1, 1, 301])
+
+            #a feature added with an old edit date is missed by the dates but found by the object IDs
+            [OID] = layer.addFeatures(1)
+            self.assertEqual(sync(useExtractChanges=False), ["editDate", 1, 0, 0, 302])
+            self.assertIn(OID, [attributes['OBJECTID'] for attributes in snapshotFeatures()])
+
+            self.assertEqual(snapshotFeatures(), [feature['attributes'] for feature in layer.features])
+
+            #the changes keep to the requested fields, so every feature in the output has the same properties
+            outName = os.path.join(self.workDirectory, "names.geojson")
+            RESTDownloader.syncFeaturesAsGeoJSON(RConnect, service.layerURL(0), "1=1", "NAME", outName)
+            layer.editFeatures([5])
+            layer.addFeatures(1)
+            self.assertEqual(RESTDownloader.syncFeaturesAsGeoJSON(RConnect, service.layerURL(0), "1=1", "NAME", outName)["mode"], "extractChanges")
+            with open(outName) as geoJSONFile:
+                properties = [feature['properties'] for feature in json.load(geoJSONFile)['features']]
+            self.assertEqual(set(tuple(sorted(featureProperties)) for featureProperties in properties), {('EDITED', 'NAME', 'OBJECTID')})
+
+    def test_snapshot_query(self):
+        RConnect = self.getConnector()
+        snapshotPath = os.path.join(self.workDirectory, "points.snapshot")
+        restsync.syncLayer(RConnect, self.pointsURL, "1=1", "*", snapshotPath)
+
+        snapshot = restsync.LayerSnapshot(snapshotPath)
+        try:
+            for indexes in ([], ['CATEGORY', 'OBJECTID']):
+                for fieldName in indexes:
+                    snapshot.createIndex(fieldName)
+
+                #the snapshot answers the same where clauses the server does
+                for queryText in ["CATEGORY = 'A' AND VALUE > 500", "OBJECTID IN (3, 5, 700) OR (OBJECTID >= 1190 AND NOT CATEGORY = 'B')",
+                                  "CATEGORY <> 'C' AND OBJECTID < 40", "NAME = 'Feature 12'"]:
+                    expected = RConnect.getFeaturesWithGeometry(self.pointsURL + "/query?", "*", queryText)
+                    local = [dict(feature['attributes'], geometry=feature['geometry']) for feature in snapshot.query(queryText)]
+                    self.assertEqual(sorted(local, key=lambda feature: feature['OBJECTID']), sorted(expected, key=lambda feature: feature['OBJECTID']), queryText)
+
+            self.assertEqual(sorted(snapshot.indexes), ['category', 'objectid'])
+        finally:
+            snapshot.close()
+
+    def test_download_geojson(self):
+        RConnect = self.getConnector()
+        outName = os.path.join(self.workDirectory, "polygons.geojson")
+
+        self.assertEqual(RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, self.polygonsURL, "1=1", "*", outName), 150)
+        with open(outName) as geoJSONFile:
+            geoJSON = json.load(geoJSONFile)
+
+        self.assertEqual(len(geoJSON['features']), 150)
+        self.assertEqual(geoJSON['features'][0]['geometry']['type'], 'Polygon')
+
+    def test_download_geojson_sequence(self):
+        RConnect = self.getConnector()
+        collection = os.path.join(self.workDirectory, "polygons.geojson")
+        sequence = os.path.join(self.workDirectory, "polygons.geojsons")
+
+        RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, self.polygonsURL, "1=1", "*", collection)
+        self.assertEqual(RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, self.polygonsURL, "1=1", "*", sequence, sequence=True), 150)
+
+        #one feature per line, each after a record separator
+        with open(sequence) as sequenceFile:
+            lines = sequenceFile.read().split("\n")
+        self.assertEqual(lines[-1], "")
+        self.assertEqual(len(lines[:-1]), 150)
+        for line in lines[:-1]:
+            self.assertEqual(line[0], "\x1e")
+            self.assertEqual(json.loads(line[1:])['type'], 'Feature')
+
+        self.assertEqual(spatialindex.readGeoJSONFeatures(sequence), spatialindex.readGeoJSONFeatures(collection))
+
+        #the writer on its own, a single feature is still a sequence
+        single = os.path.join(self.workDirectory, "single.geojsons")
+        with RESTDownloader.GeoJSONWriter(single, sequence=True) as writer:
+            writer.writeFeatures(spatialindex.readGeoJSONFeatures(collection)[:1])
+        self.assertEqual(spatialindex.readGeoJSONFeatures(single), spatialindex.readGeoJSONFeatures(collection)[:1])
+
+    def test_download_builds_index(self):
+        RConnect = self.getConnector()
+        for sequence in (False, True):
+            outName = os.path.join(self.workDirectory, "polygons" + str(sequence) + ".geojson")
+            RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, self.polygonsURL, "1=1", "*", outName, sequence=sequence, buildIndex=True)
+            self.assertTrue(os.path.exists(outName + ".sidx"))
+
+            #the saved index is reused, the output isnt scanned again
+            with mock.patch.object(spatialindex, 'scanGeoJSONFile', side_effect=AssertionError("file was scanned again")):
+                index = spatialindex.indexGeoJSONFile(outName)
+
+            features = spatialindex.readGeoJSONFeatures(outName)
+            envelope = {'xmin': EXTENT['xmin'], 'ymin': EXTENT['ymin'],
+                        'xmax': (EXTENT['xmin'] + EXTENT['xmax']) / 2, 'ymax': (EXTENT['ymin'] + EXTENT['ymax']) / 2}
+            expected = [position for position, feature in enumerate(features)
+                        if spatialindex.geometriesIntersect(spatialindex.getGeometry(feature), envelope)]
+            self.assertGreater(len(expected), 0)
+            self.assertEqual(index.intersecting(envelope), expected)
+            self.assertEqual(index.getFeatures(expected), [features[position] for position in expected])
+
+    def test_download_geojson_on_processes(self):
+        RConnect = self.getConnector()
+        inline = os.path.join(self.workDirectory, "inline.geojson")
+        pipelined = os.path.join(self.workDirectory, "pipelined.geojson")
+
+        RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, self.polygonsURL, "1=1", "*", inline)
+        RESTDownloader.downloadFeaturesAsGeoJSON(RConnect, self.polygonsURL, "1=1", "*", pipelined, processes=2)
+
+        with open(inline) as inlineFile, open(pipelined) as pipelinedFile:
+            self.assertEqual(inlineFile.read(), pipelinedFile.read())
+
+    def test_pipeline_stops_fetching_when_writing_fails(self):
+        closed = threading.Event()
+
+        def batches():
+            try:
+                for i in range(50):
+                    yield self.service.layers[1].features[:10]
+            finally:
+                closed.set()
+
+        outName = os.path.join(self.workDirectory, "failed.geojson")
+        with mock.patch.object(RESTDownloader.GeoJSONWriter, 'writeText', side_effect=IOError("disk full")):
+            with self.assertRaises(IOError):
+                RESTDownloader.writeGeoJSONPipeline(batches(), outName, processes=1)
+
+        #the fetch thread has finished and closed the download before the error comes back
+        self.assertTrue(closed.is_set())
+
+    def test_download_csv(self):
+        RConnect = self.getConnector()
+        outName = os.path.join(self.workDirectory, "points.csv")
+
+        self.assertEqual(RESTDownloader.downloadFeaturesAsCSV(RConnect, self.pointsURL, "VALUE > 500", "*", outName),
+                         len([feature for feature in self.service.layers[0].features if feature['attributes']['VALUE'] > 500]))
+
+        def readCSV(outName):
+            with open(outName, newline='') as csvFile:
+                return list(csv.reader(csvFile))
+
+        #the layer's field order, then the point x/y and the geometry
+        rows = readCSV(outName)
+        self.assertEqual(rows[0], ['OBJECTID', 'NAME', 'VALUE', 'CATEGORY', 'EDITED', 'ConvertedX', 'ConvertedY', 'geometry'])
+        first = [feature for feature in self.service.layers[0].features if feature['attributes']['VALUE'] > 500][0]
+        x, y = first['geometry']['x'], first['geometry']['y']
+        self.assertEqual(rows[1][0], str(first['attributes']['OBJECTID']))
+        self.assertEqual(rows[1][5:], [str(x), str(y), "POINT (" + str(x) + " " + str(y) + ")"])
+
+        #only the requested fields, in the layer's order, and the geometry as ESRI JSON or left out
+        RESTDownloader.downloadFeaturesAsCSV(RConnect, self.pointsURL, "OBJECTID <= 3", "VALUE, NAME", outName, geometryFormat="json")
+        rows = readCSV(outName)
+        self.assertEqual(rows[0], ['NAME', 'VALUE', 'ConvertedX', 'ConvertedY', 'geometry'])
+        self.assertEqual(json.loads(rows[1][4]), self.service.layers[0].features[0]['geometry'])
+
+        RESTDownloader.downloadFeaturesAsCSV(RConnect, self.pointsURL, "OBJECTID <= 3", "NAME", outName, geometryFormat=None)
+        self.assertEqual(readCSV(outName)[0], ['NAME', 'ConvertedX', 'ConvertedY'])
+
+        #a table is written chunk by chunk without any geometry
+        self.assertEqual(RESTDownloader.downloadFeaturesAsCSV(RConnect, self.pointsURL, "1=1", "OBJECTID, NAME", outName, isDataTable=True), 1200)
+        rows = readCSV(outName)
+        self.assertEqual(rows[0], ['OBJECTID', 'NAME'])
+        self.assertEqual(len(rows), 1201)
+
+    def test_download_csv_polygons(self):
+        outer = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+        hole = [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]]
+        island = [[20, 0], [20, 5], [25, 5], [25, 0], [20, 0]]
+        layer = MockLayer(0, 'polygon')
+        layer.features = [{'attributes': {'OBJECTID': 1, 'NAME': 'Square', 'VALUE': 1.5, 'CATEGORY': 'A', 'EDITED': None},
+                           'geometry': {'rings': [outer, hole]}},
+                          {'attributes': {'OBJECTID': 2, 'NAME': 'Two', 'VALUE': 2.5, 'CATEGORY': 'B', 'EDITED': None},
+                           'geometry': {'rings': [outer, island]}}]
+
+        outName = os.path.join(self.workDirectory, "polygons.csv")
+        with MockFeatureService([layer]) as service:
+            RESTDownloader.downloadFeaturesAsCSV(self.getConnector(service), service.layerURL(0), "1=1", "*", outName)
+
+        with open(outName, newline='') as csvFile:
+            rows = list(csv.reader(csvFile))
+        self.assertEqual(rows[0], ['OBJECTID', 'NAME', 'VALUE', 'CATEGORY', 'EDITED', 'geometry'])
+        self.assertEqual(rows[1], ['1', 'Square', '1.5', 'A', '', "POLYGON ((0 0, 0 10, 10 10, 10 0, 0 0), (2 2, 4 2, 4 4, 2 4, 2 2))"])
+        self.assertEqual(rows[2][5], "MULTIPOLYGON (((0 0, 0 10, 10 10, 10 0, 0 0)), ((20 0, 20 5, 25 5, 25 0, 20 0)))")
+
+    def test_batch_download(self):
+        inputcsv = os.path.join(self.workDirectory, "maplinks.csv")
+        with open(inputcsv, 'w') as csvFile:
+            csvFile.write("OutName,MapServerLink,Priority\n")
+            csvFile.write(os.path.join(self.workDirectory, "points") + "," + self.pointsURL + ",\n")
+            csvFile.write(os.path.join(self.workDirectory, "polygons") + "," + self.polygonsURL + ",1\n")
+
+        summary = RESTDownloader.batchDownloadFromCSV(inputcsv, summaryPath=os.path.join(self.workDirectory, "summary.csv"))
+
+        self.assertEqual([(row['status'], row['featureCount']) for row in summary], [('done', 1200), ('done', 150)])
+        self.assertTrue(os.path.exists(os.path.join(self.workDirectory, "summary.csv")))
+
+    def test_batch_where_and_fields(self):
+        inputcsv = os.path.join(self.workDirectory, "maplinks.csv")
+        outName = os.path.join(self.workDirectory, "points")
+        with open(inputcsv, 'w') as csvFile:
+            csvFile.write("OutName,MapServerLink,Priority,Where,Fields\n")
+            csvFile.write(outName + "," + self.pointsURL + ",,CATEGORY = 'A',\"OBJECTID, NAME\"\n")
+            csvFile.write(",," + self.polygonsURL + ",,\n") #rows without an OutName are skipped
+
+        jobs = RESTDownloader.readBatchCSV(inputcsv)
+        self.assertEqual([(job.fileName, job.queryText, job.attributes, job.spoolDir) for job in jobs],
+                         [(outName + ".geojson", "CATEGORY = 'A'", "OBJECTID, NAME", None)])
+
+        RESTDownloader.runBatch(jobs)
+        with open(outName + ".geojson") as geojsonFile:
+            features = json.load(geojsonFile)['features']
+
+        expected = self.getConnector().getFeatures(self.pointsURL + "/query?", "OBJECTID", "CATEGORY = 'A'")
+        self.assertEqual(jobs[0].featureCount, len(expected))
+        self.assertEqual(sorted(feature['properties']['OBJECTID'] for feature in features), sorted(feature['OBJECTID'] for feature in expected))
+        self.assertTrue(all(set(feature['properties']) == {'OBJECTID', 'NAME'} for feature in features))
+
+    def test_batch_order_and_host_limit(self):
+        started = []
+        running = {}
+        mostRunning = {}
+        lock = threading.Lock()
+
+        def fakeDownload(RConnect, URL, queryText, attributes, outName, spoolDir=None):
+            host = URL.split("/")[2]
+            with lock:
+                started.append(os.path.basename(outName))
+                running[host] = running.get(host, 0) + 1
+                mostRunning[host] = max(mostRunning.get(host, 0), running[host])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            return 1
+
+        def makeJobs():
+            return [RESTDownloader.BatchJob(os.path.join(self.workDirectory, name), "http://" + host + "/arcgis/rest/services/Layer/MapServer/0", priority=priority)
+                    for name, host, priority in [("a", "one.example.com", 0), ("b", "one.example.com", 2), ("c", "one.example.com", 1),
+                                                 ("d", "two.example.com", 0), ("e", "one.example.com", 3)]]
+
+        with mock.patch.object(RESTDownloader, 'downloadFeaturesAsGeoJSON', fakeDownload):
+            #one job at a time runs them by priority, then in the order of the .csv
+            jobs = RESTDownloader.runBatch(makeJobs(), maxJobs=1, estimateSize=False)
+            self.assertEqual(started, ["e", "b", "c", "a", "d"])
+            self.assertTrue(all(job.status == "done" for job in jobs))
+
+            #a busy host holds its other jobs back, while a job on another host goes ahead of them
+            del started[:]
+            RESTDownloader.runBatch(makeJobs(), maxJobs=3, maxJobsPerHost=2, estimateSize=False)
+            self.assertEqual(mostRunning, {"one.example.com": 2, "two.example.com": 1})
+            self.assertEqual(started[:3], ["e", "b", "d"])
+
+    def test_benchmark_runs(self):
+        results = benchmark.runBenchmarks(['getFeatureCount', 'getFeatures'], featureCount=300, separateProcesses=False)
+
+        self.assertEqual(results['getFeatures']['features'], 300)
+        self.assertGreater(results['getFeatures']['bytesSent'], 0)
+        self.assertEqual(benchmark.compareResults(results, results), [])
+
+        #a slower run is a regression
+        slower = dict(results['getFeatures'], featuresPerSecond=results['getFeatures']['featuresPerSecond'] / 2)
+        self.assertEqual(len(benchmark.compareResults({'getFeatures': slower}, results)), 1)
 
 
 if __name__ == '__main__':
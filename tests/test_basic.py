@@ -1,16 +1,294 @@
 # -*- coding: utf-8 -*-
 
-from .context import sample
+from .context import gtatr, esrigeometry, esrijson, whereclause, featuretable, spatialindex
 
+import email.utils
+import io
+import json
+import os
+import random
+import requests
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 
 class BasicTestSuite(unittest.TestCase):
-    """Basic test cases."""
+    """Basic test cases, no service needed."""
 
-    def test_absolute_truth_and_meaning(self):
-        assert True
+    def test_point_and_polygon_to_geojson(self):
+        self.assertEqual(esrigeometry.toGeoJSONGeometry({'x': 1.5, 'y': 2.5}), {'type': 'Point', 'coordinates': [1.5, 2.5]})
+
+        #a clockwise outer ring with a counter clockwise hole is one polygon with a hole
+        outer = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+        hole = [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]]
+        geometry = esrigeometry.toGeoJSONGeometry({'rings': [outer, hole]})
+        self.assertEqual(geometry['type'], 'Polygon')
+        self.assertEqual(len(geometry['coordinates']), 2)
+
+    def test_empty_geometry(self):
+        self.assertEqual(esrigeometry.toGeoJSONGeometries([None, {'x': 1, 'y': 2}])[0], None)
+
+    def test_geometry_array_matches_group_rings(self):
+        #an L shaped outer ring with a hole in its notch, inside the box but outside the ring, which makes it an outer ring
+        outer = [[0, 0], [0, 10], [4, 10], [4, 4], [10, 4], [10, 0], [0, 0]]
+        notch = [[6, 6], [8, 6], [8, 8], [6, 8], [6, 6]]
+        hole = [[1, 1], [2, 1], [2, 2], [1, 2], [1, 1]]
+
+        #a hole with an island in it that has a hole of its own, the island's hole goes to the island
+        square = [[0, 0], [0, 20], [20, 20], [20, 0], [0, 0]]
+        pond = [[2, 2], [18, 2], [18, 18], [2, 18], [2, 2]]
+        island = [[5, 5], [5, 15], [15, 15], [15, 5], [5, 5]]
+        lake = [[8, 8], [12, 8], [12, 12], [8, 12], [8, 8]]
+
+        generator = random.Random(3)
+        geometries = [{'rings': [outer, notch, hole]}, {'rings': [lake, square, island, pond]}, {'rings': [notch]}, None, {'x': 1, 'y': 2},
+                      {'paths': [[[0, 0], [1, 1]]]}, {'rings': [[[0, 0], [0, 1], [1, 0]]]}]
+        for i in range(200):
+            x, y = generator.uniform(0, 50), generator.uniform(0, 50)
+            rings = [[[x, y], [x, y + 10], [x + 10, y + 10], [x + 10, y], [x, y]]]
+            for j in range(generator.randint(0, 4)):
+                holeX, holeY = generator.uniform(x - 5, x + 12), generator.uniform(y - 5, y + 12)
+                rings.append([[holeX, holeY], [holeX + 1, holeY], [holeX + 1, holeY + 1], [holeX, holeY + 1], [holeX, holeY]])
+            geometries.append({'rings': rings})
+
+        self.assertEqual(esrigeometry.GeometryArray(geometries).toGeoJSON(), [esrigeometry.toGeoJSONGeometry(geometry) for geometry in geometries])
+        self.assertEqual(esrigeometry.toGeoJSONGeometry({'rings': [outer, notch, hole]})['type'], 'MultiPolygon')
+
+    def test_clip_polygon(self):
+        square = {'rings': [[[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]]}
+        clipped = esrigeometry.clipPolygon(square, (5, 5, 20, 20))
+        self.assertEqual(esrigeometry.getEnvelope(clipped), (5, 5, 10, 10))
+
+    def test_feature_stream_matches_json(self):
+        body = {'objectIdFieldName': 'OBJECTID',
+                'features': [{'attributes': {'OBJECTID': i, 'NAME': u'café ' + str(i)}, 'geometry': {'x': i * 0.5, 'y': -i}} for i in range(50)],
+                'exceededTransferLimit': True}
+        content = json.dumps(body).encode('utf-8')
+
+        #split the body so values and multi byte characters are cut across chunks
+        chunks = [content[i:i + 7] for i in range(0, len(content), 7)]
+        self.assertEqual(esrijson.FeatureStream(chunks).readAll(), body)
+        self.assertEqual(esrijson.loads(content), body)
+
+    def test_feature_stream_error_body(self):
+        content = json.dumps({'error': {'code': 498, 'message': 'Invalid Token', 'details': []}}).encode('utf-8')
+        with self.assertRaises(esrijson.ServiceError) as context:
+            esrijson.FeatureStream([content[:10], content[10:]]).readAll()
+        self.assertEqual(context.exception.error['code'], 498)
+
+    def test_streamed_error_check_leaves_body(self):
+        #a streamed response with no Content-Length isnt read to look for an error
+        r = requests.Response()
+        r.status_code = 200
+        r.raw = io.BytesIO(b'{"features": []}' + b' ' * 10000)
+        self.assertIsNone(gtatr.getArcGISError(r))
+        self.assertEqual(r.raw.tell(), 0)
+
+        #a small body that has been read is still checked
+        r = requests.Response()
+        r.status_code = 200
+        r.raw = io.BytesIO(b'{"error": {"code": 503, "message": "busy"}}')
+        r.content
+        self.assertEqual(gtatr.getArcGISError(r)['code'], 503)
+
+    def makeResponse(self, status, body=b'', headers=None):
+        r = requests.Response()
+        r.status_code = status
+        r.headers.update(headers or {})
+        r.raw = io.BytesIO(body)
+        r.content
+        return r
+
+    def test_retry_policy(self):
+        retryPolicy = gtatr.RetryPolicy(backoffFactor=1.0, maxBackoff=10.0, jitter=False)
+        self.assertEqual(retryPolicy.shouldRetry(self.makeResponse(503)), "HTTP 503")
+        self.assertEqual(retryPolicy.shouldRetry(self.makeResponse(404)), None)
+        self.assertEqual(retryPolicy.shouldRetry(self.makeResponse(200, b'{"features": []}')), None)
+        self.assertIn("ArcGIS error 500", retryPolicy.shouldRetry(self.makeResponse(200, b'{"error": {"code": 500, "message": "busy"}}')))
+        self.assertEqual(retryPolicy.shouldRetry(None, requests.ConnectionError()), "ConnectionError")
+
+        #the backoff doubles up to the cap
+        self.assertEqual([retryPolicy.getDelay(attempt) for attempt in range(5)], [1.0, 2.0, 4.0, 8.0, 10.0])
+
+        #Retry-After wins, in seconds or as a date, and is capped too
+        self.assertEqual(retryPolicy.getDelay(0, self.makeResponse(429, headers={'Retry-After': '3'})), 3.0)
+        self.assertEqual(retryPolicy.getDelay(0, self.makeResponse(429, headers={'Retry-After': '120'})), 10.0)
+        retryDate = email.utils.formatdate(time.time() + 5, usegmt=True)
+        self.assertAlmostEqual(retryPolicy.getDelay(0, self.makeResponse(503, headers={'Retry-After': retryDate})), 5.0, delta=1.5)
+
+        #full jitter picks anywhere from no wait up to the backoff
+        retryPolicy = gtatr.RetryPolicy(backoffFactor=1.0, maxBackoff=10.0, jitter=True)
+        delays = [retryPolicy.getDelay(3) for i in range(200)]
+        self.assertTrue(all(0 <= delay <= 8.0 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_rate_limiter(self):
+        rateLimiter = gtatr.RateLimiter(20, burst=2)
+
+        #the burst goes straight away, then one request every 1/20 of a second
+        start = time.monotonic()
+        for i in range(6):
+            rateLimiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+        rateLimiter.slowDown()
+        self.assertEqual(rateLimiter.rate, 10)
+        for i in range(20):
+            rateLimiter.speedUp()
+        self.assertEqual(rateLimiter.rate, 20)
+
+    def test_host_limiter_keeps_lowest_limit(self):
+        limiter = gtatr.getHostLimiter("https://limits.example.com/arcgis", 4)
+        self.assertIs(gtatr.getHostLimiter("https://LIMITS.example.com/other", 8), limiter)
+        self.assertEqual(limiter.limit, 4)
+        self.assertIs(gtatr.getHostLimiter("https://limits.example.com/arcgis", 2), limiter)
+        self.assertEqual(limiter.limit, 2)
+
+        #no more than the limit get in at once
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def request():
+            with limiter:
+                with lock:
+                    active.append(1)
+                    peak.append(len(active))
+                time.sleep(0.01)
+                with lock:
+                    active.pop()
+
+        threads = [threading.Thread(target=request) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(peak), 2)
+
+    def test_output_profiles(self):
+        self.assertIs(gtatr.getOutputProfile('display'), gtatr.outputProfiles['display'])
+        self.assertIsNone(gtatr.getOutputProfile(None))
+        profile = gtatr.OutputProfile("custom", geometryPrecision=3)
+        self.assertIs(gtatr.getOutputProfile(profile), profile)
+        with self.assertRaises(ValueError):
+            gtatr.getOutputProfile('tiny')
+
+        #full precision sends nothing extra
+        self.assertEqual(gtatr.getOutputProfile('analysis').getParameters('pbf'), {})
+
+        #quantization only goes with PBF, which comes back with the transform to read it
+        display = gtatr.displayProfile(24000)
+        self.assertEqual(display.geometryPrecision, 6)
+        self.assertAlmostEqual(display.maxAllowableOffset, 24000 * 0.0254 / 96 / 111320.0)
+        self.assertNotIn('quantizationParameters', display.getParameters('json'))
+        quantization = json.loads(display.getParameters('pbf')['quantizationParameters'])
+        self.assertEqual(quantization['tolerance'], display.maxAllowableOffset)
+        self.assertLess(gtatr.displayProfile(1000000).geometryPrecision, display.geometryPrecision)
+
+        #centroids are only asked for when the layer can send them
+        centroid = gtatr.getOutputProfile('centroid')
+        self.assertEqual(centroid.getParameters('json'), {'geometryPrecision': 6, 'maxAllowableOffset': 0.001})
+        self.assertEqual(centroid.getParameters('json', supportsCentroid=True),
+                         {'geometryPrecision': 6, 'maxAllowableOffset': 0.001, 'returnGeometry': 'false', 'returnCentroid': 'true'})
+
+    def test_unknown_json_backend(self):
+        with self.assertRaises(ValueError):
+            esrijson.getBackend('simplejson')
+
+    def test_where_clause(self):
+        features = [{'attributes': {'NAME': 'Texas', 'POP': 10}},
+                    {'attributes': {'NAME': 'Ohio', 'POP': None}},
+                    {'attributes': {'NAME': "O'Hare", 'POP': 3}}]
+
+        def matching(text):
+            return [feature['attributes']['NAME'] for feature in whereclause.WhereClause(text).filter(features)]
+
+        self.assertEqual(matching("POP > 5"), ['Texas'])
+        self.assertEqual(matching("POP IS NULL OR NAME LIKE 'T%'"), ['Texas', 'Ohio'])
+        self.assertEqual(matching("NAME = 'O''Hare'"), ["O'Hare"])
+        self.assertEqual(matching("NOT POP > 5"), ["O'Hare"]) #unknown stays unknown
+
+        with self.assertRaises(ValueError):
+            whereclause.parseWhere("POP >")
+
+    def test_where_clause_on_table(self):
+        fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}, {'name': 'VALUE', 'type': 'esriFieldTypeDouble'}]
+        features = [{'attributes': {'OBJECTID': i, 'VALUE': i % 7 or None}} for i in range(1, 200)]
+        table = featuretable.FeatureTable(fields)
+        table.append(features)
+
+        clause = whereclause.WhereClause("VALUE BETWEEN 2 AND 4 AND OBJECTID < 100")
+        expected = [i for i, feature in enumerate(features) if clause.matches(feature)]
+        self.assertEqual(clause.filterTable(table), expected)
+        self.assertEqual(clause.filterTable(table, [whereclause.FieldIndex(table, 'OBJECTID')]), expected)
+
+    def test_table_empty_parts_geometry(self):
+        square = {'rings': [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}
+        table = featuretable.FeatureTable(geometry=True)
+        table.append([{'attributes': {'OBJECTID': 1}, 'geometry': {'rings': [[]]}},
+                      {'attributes': {'OBJECTID': 2}, 'geometry': {'paths': []}},
+                      {'attributes': {'OBJECTID': 3}, 'geometry': square}])
+        self.assertEqual(table.geometries(), [None, None, square])
+        self.assertEqual(table[1:].geometries(), [None, square])
+
+    def test_spatial_index(self):
+        polygons = [{'type': 'Feature', 'properties': {'id': i},
+                     'geometry': {'type': 'Polygon', 'coordinates': [[[i, 0], [i + 1, 0], [i + 1, 1], [i, 1], [i, 0]]]}} for i in range(20)]
+        index = spatialindex.SpatialIndex(polygons, capacity=4)
+        self.assertEqual([feature['properties']['id'] for feature in index.getFeatures(index.containing(5.5, 0.5))], [5])
+        self.assertEqual(index.containing(5.5, 2), [])
+
+    def test_spatial_index_file(self):
+        features = [{'type': 'Feature', 'properties': {'name': u'Café ' + str(i)},
+                     'geometry': {'type': 'Polygon', 'coordinates': [[[i, 0], [i + 1, 0], [i + 1, 1], [i, 1], [i, 0]]]}} for i in range(50)]
+        workDirectory = tempfile.mkdtemp()
+        try:
+            collectionPath = os.path.join(workDirectory, "collection.geojson")
+            with open(collectionPath, 'w', encoding='utf-8') as geoJSONFile:
+                json.dump({'type': 'FeatureCollection', 'features': features}, geoJSONFile, ensure_ascii=False)
+            sequencePath = os.path.join(workDirectory, "sequence.geojson")
+            with open(sequencePath, 'w', encoding='utf-8') as geoJSONFile:
+                geoJSONFile.write("".join("\x1e" + json.dumps(feature, ensure_ascii=False) + "\n" for feature in features))
+
+            for path in (collectionPath, sequencePath):
+                built = spatialindex.indexGeoJSONFile(path)
+
+                #the saved envelopes and offsets are used, the file isnt read again until a search needs its features
+                with mock.patch.object(spatialindex, 'scanGeoJSONFile', side_effect=AssertionError("file was scanned again")):
+                    loaded = spatialindex.indexGeoJSONFile(path)
+
+                self.assertEqual(loaded.envelopes, built.envelopes)
+                self.assertEqual(loaded.getFeatures(loaded.containing(7.5, 0.5)), [features[7]])
+                self.assertEqual(loaded.intersecting({'xmin': 2.5, 'ymin': 0.5, 'xmax': 4.5, 'ymax': 2}), [2, 3, 4])
+        finally:
+            shutil.rmtree(workDirectory)
+
+    def test_intersects_many_matches_one_at_a_time(self):
+        generator = random.Random(1)
+        geometries = []
+        for i in range(300):
+            x, y, size = generator.uniform(0, 100), generator.uniform(0, 100), generator.uniform(0.5, 4)
+            geometries.append([{'x': x, 'y': y},
+                               {'paths': [[[x, y], [x + size, y - size], [x + size, y + size]]]},
+                               {'rings': [[[x, y], [x, y + size], [x + size, y + size], [x + size, y], [x, y]]]}][i % 3])
+
+        #a concave query polygon, so features sit in its notch as well as inside it
+        query = {'rings': [[[10, 10], [10, 90], [50, 50], [90, 90], [90, 10], [10, 10]]]}
+        self.assertEqual(spatialindex.intersectsMany(geometries, query), [spatialindex.geometriesIntersect(geometry, query) for geometry in geometries])
+
+    def test_chunk_sizer_limits(self):
+        chunkSizer = gtatr.ChunkSizer(chunkSize=100, minChunkSize=10, maxChunkSize=500, maxRecordCount=300)
+        self.assertLessEqual(chunkSizer.nextSize(), 300)
+
+        #slow chunks shrink the size, but never below the minimum
+        for i in range(20):
+            chunkSizer.record(100, 60.0, 1000)
+        self.assertEqual(chunkSizer.nextSize(), 10)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()